@@ -12,5 +12,10 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+os.environ.setdefault('ROOT_URLCONF', 'app.asgi_urls') #Serve the recipe, tag, ingredient and user reads with async views
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from recipe.sse import EventStreamRouter  # noqa: E402 - needs the apps loaded by get_asgi_application()
+
+application = EventStreamRouter(django_application) #Serves the /api/recipe/events/ feed outside of Django's views
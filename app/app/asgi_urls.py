@@ -0,0 +1,41 @@
+"""app URL Configuration for ASGI
+
+The same routes as app/urls.py, with the hot read endpoints replaced by async views
+(core.async_views.async_read_view). app/asgi.py selects this module with the ROOT_URLCONF environment variable
+"""
+from django.urls import path
+
+from app import urls
+from core.async_views import async_read_view
+from recipe import views as recipe_views
+from user import views as user_views
+
+
+urlpatterns = [
+    path(
+        'api/recipe/recipes/',
+        async_read_view(recipe_views.RecipeViewSet.as_view({'get': 'list', 'post': 'create'})),
+        name='async-recipe-list',
+        ),
+    path(
+        'api/recipe/recipes/<int:pk>/', #int, so the router's recipes/import/ and recipes/export/ aren't caught here
+        async_read_view(recipe_views.RecipeViewSet.as_view({
+            'get': 'retrieve',
+            'put': 'update',
+            'patch': 'partial_update',
+            'delete': 'destroy',
+        })),
+        name='async-recipe-detail',
+        ),
+    path(
+        'api/recipe/tags/',
+        async_read_view(recipe_views.TagViewSet.as_view({'get': 'list'})),
+        name='async-tag-list',
+        ),
+    path(
+        'api/recipe/ingredients/',
+        async_read_view(recipe_views.IngredientViewSet.as_view({'get': 'list'})),
+        name='async-ingredient-list',
+        ),
+    path('api/user/me/', async_read_view(user_views.ManageUserView.as_view()), name='async-me'),
+] + urls.urlpatterns #Everything else, and the routes above when they don't match, goes to the sync views
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -46,6 +47,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.timing.ServerTimingMiddleware', #First, so it times everything else
+    'core.db_routing.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -55,7 +58,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'app.urls'
+ROOT_URLCONF = os.environ.get('ROOT_URLCONF', 'app.urls') #app/asgi.py switches to app.asgi_urls
 
 TEMPLATES = [
     {
@@ -86,9 +89,35 @@ DATABASES = {
         'NAME': os.environ.get('DB_NAME'),
         'USER': os.environ.get('DB_USER'),
         'PASSWORD': os.environ.get('DB_PASS'),
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 0)), #Seconds to keep a connection open between requests
     }
 }
 
+# Read replicas of the primary, as comma separated host or host:port in DB_REPLICA_HOSTS, with the same name, user and
+# password. They become the aliases replica1, replica2... Leave it unset for the tests, Django only lets a test query the
+# aliases in its databases, core/tests/test_db_routing.py adds its own stand-ins
+DB_REPLICA_HOSTS = [host for host in os.environ.get('DB_REPLICA_HOSTS', '').split(',') if host]
+for number, host in enumerate(DB_REPLICA_HOSTS, 1):
+    host, _, port = host.partition(':')
+    DATABASES[f'replica{number}'] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': port,
+        'OPTIONS': {'connect_timeout': 2}, #A replica that is down is skipped, instead of holding up requests
+        'TEST': {'MIRROR': 'default'},
+    }
+
+# Shards for the user-owned data, as comma separated host or host:port in DB_SHARD_HOSTS like the replicas. They become
+# the aliases shard1, shard2... and the primary is the first shard
+DB_SHARD_HOSTS = [host for host in os.environ.get('DB_SHARD_HOSTS', '').split(',') if host]
+for number, host in enumerate(DB_SHARD_HOSTS, 1):
+    host, _, port = host.partition(':')
+    DATABASES[f'shard{number}'] = {**DATABASES['default'], 'HOST': host, 'PORT': port, 'TEST': {'MIRROR': 'default'}}
+
+# ShardRouter picks the shard of the sharded models, ReplicaRouter the replica of reads on the primary, including the
+# sharded models of the users on it. The replicas are only of the primary, the reads of the other shards go to the shard
+DATABASE_ROUTERS = ['core.sharding.ShardRouter', 'core.db_routing.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -136,5 +165,148 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 AUTH_USER_MODEL = 'core.User'
 
 REST_FRAMEWORK = {
-    'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema'
-}
\ No newline at end of file
+    'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+}
+
+# Default and largest page size (?page_size=) for the list APIs
+API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE', 100))
+API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE', 1000))
+
+# Recipes validated and saved together by the bulk import endpoint, and the most row errors it returns
+RECIPE_IMPORT_CHUNK_SIZE = int(os.environ.get('RECIPE_IMPORT_CHUNK_SIZE', 500))
+RECIPE_IMPORT_MAX_ERRORS = int(os.environ.get('RECIPE_IMPORT_MAX_ERRORS', 100))
+
+# Recipes read per server-side cursor fetch by the streaming export endpoint
+RECIPE_EXPORT_CHUNK_SIZE = int(os.environ.get('RECIPE_EXPORT_CHUNK_SIZE', 2000))
+
+# Token lookups cached by user.authentication.CachedTokenAuthentication.
+# SHARED_CACHE is an alias from CACHES shared between processes, it's where a revoked token or a changed user reaches
+# the other processes, so without it nothing is cached unless SINGLE_PROCESS says the app runs as 1 process. The
+# shared cache has the users fields but not their password hash
+AUTH_TOKEN_CACHE = {
+    'TTL': int(os.environ.get('AUTH_TOKEN_CACHE_TTL', 30)),
+    'MAX_SIZE': int(os.environ.get('AUTH_TOKEN_CACHE_MAX_SIZE', 10000)),
+    'SHARED_CACHE': os.environ.get('AUTH_TOKEN_SHARED_CACHE') or None,
+    'SINGLE_PROCESS': bool(int(os.environ.get('AUTH_TOKEN_CACHE_SINGLE_PROCESS', 0))),
+}
+
+# Seconds a sync token (/api/recipe/sync/?since=) stays valid. Older tokens get a full sync, and the prune_tombstones
+# command deletes tombstones older than this
+SYNC_TOKEN_MAX_AGE = int(os.environ.get('SYNC_TOKEN_MAX_AGE', 30 * 24 * 60 * 60))
+
+# Server-sent events feed (/api/recipe/events/, ASGI only). HEARTBEAT is the seconds between keep-alive comments.
+# A client more than QUEUE_SIZE events behind gets a reset event instead, BUFFER_SIZE events are kept per process for
+# clients that reconnect with Last-Event-ID. PG_NOTIFY sends the events through Postgres so every process gets them,
+# it's on by default with Postgres. Without it a process only sends the events of the changes it made, so only turn it
+# off when the app runs as 1 process: with more, the clients connected to another process would miss the changes
+EVENTS = {
+    'HEARTBEAT': int(os.environ.get('EVENTS_HEARTBEAT', 15)),
+    'QUEUE_SIZE': int(os.environ.get('EVENTS_QUEUE_SIZE', 100)),
+    'BUFFER_SIZE': int(os.environ.get('EVENTS_BUFFER_SIZE', 1000)),
+    'MAX_CONNECTIONS': int(os.environ.get('EVENTS_MAX_CONNECTIONS', 10000)),
+    'PG_NOTIFY': bool(int(os.environ.get('EVENTS_PG_NOTIFY', DATABASES['default']['ENGINE'].endswith('postgresql')))),
+}
+
+# Caches. 'default' is per process, set SHARED_CACHE_LOCATION (e.g. memcached:11211) to add a 'shared' cache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+if os.environ.get('SHARED_CACHE_LOCATION'):
+    CACHES['shared'] = {
+        'BACKEND': os.environ.get('SHARED_CACHE_BACKEND', 'django.core.cache.backends.memcached.PyMemcacheCache'),
+        'LOCATION': os.environ.get('SHARED_CACHE_LOCATION'),
+    }
+
+# List responses cached by recipe.cache.CachedListMixin until the users data changes, with an ETag from the users data
+# version. CACHE is an alias from CACHES. The versions have to be seen by every process, so with a per-process cache
+# (LocMemCache) or one that stores nothing (DummyCache) neither the cache nor the ETags are used, unless SINGLE_PROCESS
+# says the app runs as 1 process. TTL is in seconds, 0 turns the cache off but keeps the ETags
+RESPONSE_CACHE = {
+    'CACHE': os.environ.get('RESPONSE_CACHE', 'shared' if 'shared' in CACHES else 'default'),
+    'TTL': int(os.environ.get('RESPONSE_CACHE_TTL', 300)),
+    'SINGLE_PROCESS': bool(int(os.environ.get('RESPONSE_CACHE_SINGLE_PROCESS', 0))),
+}
+
+# Safe requests to ROUTES (URL names) read from one of ALIASES, picked round_robin or least_lag (SELECTION), skipping
+# replicas that are down or more than MAX_LAG seconds behind, measured every LAG_CHECK_INTERVAL seconds. A client
+# (token or session) that made a write reads from the primary for the next STICKY_SECONDS, that's recorded in the
+# PIN_CACHE alias from CACHES, which has to be 'shared' when there's more than 1 process. PRIMARY_MODELS are always read
+# from the primary, so a token works as soon as it's created
+READ_REPLICAS = {
+    'ALIASES': [f'replica{number}' for number in range(1, len(DB_REPLICA_HOSTS) + 1)],
+    'SELECTION': os.environ.get('DB_REPLICA_SELECTION', 'round_robin'),
+    'MAX_LAG': float(os.environ.get('DB_REPLICA_MAX_LAG', 2)),
+    'LAG_CHECK_INTERVAL': float(os.environ.get('DB_REPLICA_LAG_CHECK_INTERVAL', 1)),
+    'STICKY_SECONDS': int(os.environ.get('DB_REPLICA_STICKY_SECONDS', 5)),
+    'PIN_CACHE': os.environ.get('DB_REPLICA_PIN_CACHE', 'default'),
+    'PRIMARY_MODELS': ['authtoken.Token'],
+    'ROUTES': [
+        'recipe:recipe-list',
+        'recipe:recipe-detail',
+        'recipe:tag-list',
+        'recipe:tag-detail',
+        'recipe:ingredient-list',
+        'recipe:ingredient-detail',
+        'user:me',
+        'async-recipe-list',
+        'async-recipe-detail',
+        'async-tag-list',
+        'async-ingredient-list',
+        'async-me',
+    ],
+}
+
+# Users are placed on one of SHARDS by a consistent hash of their id, with VNODES points per shard on the ring. After
+# changing SHARDS run the rebalance_shards command to move the users the ring gives to another shard. Where a user
+# lives is cached for PLACEMENT_TTL seconds per process, rebalance_shards waits that long between the steps of a move.
+# Shard n hands out ids from n * ID_BLOCK, so moved rows keep theirs
+SHARDING = {
+    'SHARDS': ['default', *[f'shard{number}' for number in range(1, len(DB_SHARD_HOSTS) + 1)]],
+    'VNODES': 64,
+    'PLACEMENT_TTL': int(os.environ.get('SHARD_PLACEMENT_TTL', 5)),
+    'ID_BLOCK': 2 ** 48,
+}
+
+# Threads the async read views in app/asgi_urls.py run their database work on, which also caps their connections.
+# 0 runs it on the request's own thread instead, like a sync view
+ASYNC_DB_THREADS = int(os.environ.get('ASYNC_DB_THREADS', 20))
+
+# Per-request timings by core.timing.ServerTimingMiddleware. Every request is added to the per-route histograms,
+# SAMPLE_RATE (0 to 1) of them also get the query/serializer breakdown in a Server-Timing header (unless HEADER is 0)
+# and a JSON log line from the core.timing logger. WINDOW is the seconds the recent percentiles cover. At the default
+# 1% the breakdown of a route is still there after a few hundred requests, without a log line for every one
+SERVER_TIMING = {
+    'SAMPLE_RATE': float(os.environ.get('SERVER_TIMING_SAMPLE_RATE', 0.01)),
+    'HEADER': bool(int(os.environ.get('SERVER_TIMING_HEADER', 1))),
+    'WINDOW': int(os.environ.get('SERVER_TIMING_WINDOW', 60)),
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'core.timing': {
+            'handlers': ['console'],
+            #The sampled requests are logged at INFO, the test runner leaves them out so its output stays readable
+            'level': os.environ.get('SERVER_TIMING_LOG_LEVEL', 'WARNING' if sys.argv[1:2] == ['test'] else 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+# Prometheus metrics at /metrics (core.metrics). With more than 1 process, set DIR to a directory they all share. Each
+# process writes its counters there every FLUSH_INTERVAL seconds from its first request and /metrics adds them up,
+# removing the files of processes that have stopped writing. Only the addresses or networks in ALLOWED_IPS
+# (REMOTE_ADDR, so the scraper must not come through the public proxy) and requests with an
+# "Authorization: Bearer <TOKEN>" header can read it, everyone else gets a 404
+METRICS = {
+    'DIR': os.environ.get('METRICS_DIR') or None,
+    'FLUSH_INTERVAL': int(os.environ.get('METRICS_FLUSH_INTERVAL', 5)),
+    'ALLOWED_IPS': [ip for ip in os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip],
+    'TOKEN': os.environ.get('METRICS_TOKEN') or None,
+}
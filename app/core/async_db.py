@@ -0,0 +1,68 @@
+"""
+Run ORM code from async views
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the thread pool the async views use for the database, created on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.ASYNC_DB_THREADS, thread_name_prefix='async-db')
+        return _executor
+
+
+def _run(func, args, kwargs):
+    #The pool threads live outside the request cycle, so they close broken or expired connections themselves,
+    #the same way Django does at the start and end of each request (CONN_MAX_AGE applies as usual)
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_db(func, *args, **kwargs):
+    """Call func(*args, **kwargs) on a database thread and return its result without blocking the event loop"""
+    #Django 3.2 has no async ORM, and the ASGI handler runs every sync view with thread_sensitive=True, which means
+    #on 1 shared thread for the whole process. A pool of ASYNC_DB_THREADS threads lets that many requests wait on
+    #the database at once while the event loop keeps accepting connections
+    if not settings.ASYNC_DB_THREADS:
+        return await sync_to_async(func, thread_sensitive=True)(*args, **kwargs)
+
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context() #Like sync_to_async, so e.g. the requests core.timing timings are recorded
+    return await loop.run_in_executor(get_executor(), functools.partial(context.run, _run, func, args, kwargs))
+
+
+def iter_on_thread(iterable):
+    """Yield the items of iterable, each made on a thread of its own instead of the caller's"""
+    #Django 3.2's ASGI handler iterates a StreamingHttpResponse synchronously on the event loop, where the ORM refuses
+    #to run. Every item is made on the same thread, so a server-side cursor stays on its connection. The event loop
+    #still waits while each item is made, so only use it for streams that query a chunk at a time
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stream-db')
+    iterator = iter(iterable)
+    done = object()
+    try:
+        while True:
+            item = executor.submit(next, iterator, done).result()
+            if item is done:
+                return
+            yield item
+    finally:
+        if hasattr(iterator, 'close'): #Also when the client went away, so the cursor is closed on its own thread
+            executor.submit(iterator.close).result()
+        executor.submit(connections.close_all).result()
+        executor.shutdown()
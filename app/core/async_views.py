@@ -0,0 +1,32 @@
+"""
+Async wrappers for the read endpoints, used when the app is served over ASGI
+"""
+import functools
+
+from asgiref.sync import sync_to_async
+
+from core.async_db import run_db
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def _render(view, request, *args, **kwargs):
+    """Call view and render its response, so the template/JSON rendering also happens off the event loop"""
+    response = view(request, *args, **kwargs)
+    if hasattr(response, 'render') and callable(response.render):
+        response.render()
+    return response
+
+
+def async_read_view(view):
+    """Return an async view that runs view's reads on the database threads and everything else as before"""
+    #The wrapped DRF view still does the authentication (CachedTokenAuthentication), permissions, pagination and
+    #serialization, so responses and errors are exactly the same as the sync API
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method in READ_METHODS:
+            return await run_db(_render, view, request, *args, **kwargs)
+        #Writes keep the default thread the ASGI handler runs sync views on, so they behave as they do today
+        return await sync_to_async(view, thread_sensitive=True)(request, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,197 @@
+"""
+Read replica routing: safe requests to the recipe, tag, ingredient and /me endpoints read from a replica in
+READ_REPLICAS['ALIASES'], everything else (and every write) uses the primary
+"""
+import asyncio
+import contextvars
+import hashlib
+import itertools
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError, connections
+from django.urls import Resolver404, resolve
+
+PRIMARY = 'default'
+PIN_KEY_PREFIX = 'db-pin:'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+#The replica the current request reads from, None for the primary
+_read_alias = contextvars.ContextVar('read_alias', default=None)
+
+#Seconds a replica is behind the primary. 0 when it has replayed everything it received (an idle primary has no new
+#commits, so the time since the last replayed one isn't lag), NULL when it hasn't replayed anything yet
+LAG_SQL = (
+    'SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+)
+
+
+def measure_lag(alias):
+    """Return the seconds the replica alias is behind, or None if it can't be reached"""
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute(LAG_SQL)
+            lag = cursor.fetchone()[0]
+    except DatabaseError:
+        connections[alias].close() #Reconnect at the next check
+        return None
+    return None if lag is None else float(lag)
+
+
+class ReplicaPool:
+    """Picks the replica for a request from the ones that are up and less than MAX_LAG seconds behind"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._lags = {}
+        self._checked = None
+        self._refreshing = False
+
+    def lags(self):
+        """Return {alias: lag} of every replica as last measured, measuring again when that's LAG_CHECK_INTERVAL ago"""
+        #Requests never wait for a measurement: a replica that's down takes connect_timeout to fail, and under ASGI
+        #this runs on the event loop, where the ORM can't. The lags are measured again on a thread of their own, until
+        #the first measurement every read goes to the primary
+        aliases = settings.READ_REPLICAS['ALIASES']
+        with self._lock:
+            stale = (self._checked is None or time.monotonic() - self._checked >= settings.READ_REPLICAS['LAG_CHECK_INTERVAL']
+                     or set(self._lags) != set(aliases))
+            if stale and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(
+                    target=self._refresh_in_background, args=(list(aliases),), name='replica-lag', daemon=True,
+                ).start()
+            return {alias: lag for alias, lag in self._lags.items() if alias in aliases}
+
+    def refresh(self, aliases=None):
+        """Measure the lag of every replica now, on the calling thread, and return {alias: lag}"""
+        aliases = settings.READ_REPLICAS['ALIASES'] if aliases is None else aliases
+        lags = {alias: measure_lag(alias) for alias in aliases} #Without the lock, requests keep using the last lags
+        with self._lock:
+            self._lags = lags
+            self._checked = time.monotonic()
+        return lags
+
+    def _refresh_in_background(self, aliases):
+        try:
+            self.refresh(aliases)
+        finally:
+            connections.close_all() #The connections of this thread, which ends here
+            with self._lock:
+                self._refreshing = False
+
+    def choose(self):
+        """Return the alias to read from, or None when no replica is usable"""
+        usable = {
+            alias: lag for alias, lag in self.lags().items()
+            if lag is not None and lag <= settings.READ_REPLICAS['MAX_LAG']
+        }
+        if not usable:
+            return None
+        if settings.READ_REPLICAS['SELECTION'] == 'least_lag':
+            return min(usable, key=usable.get)
+        aliases = sorted(usable)
+        return aliases[next(self._counter) % len(aliases)]
+
+    def reset(self):
+        """Forget the measured lags, so the next request measures them again"""
+        with self._lock:
+            self._lags = {}
+            self._checked = None
+
+
+pool = ReplicaPool()
+
+
+def get_read_alias():
+    """Return the replica the current request reads from, None for the primary"""
+    return _read_alias.get()
+
+
+class ReplicaRouter:
+    """Send the reads of a request the middleware gave a replica to it, and everything else to the primary"""
+
+    def db_for_read(self, model, **hints):
+        if model._meta.label in settings.READ_REPLICAS['PRIMARY_MODELS']:
+            return PRIMARY
+        return _read_alias.get() or PRIMARY
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True #Every alias has the same data
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY #The replicas get the schema through replication
+
+
+def _client_key(request):
+    """Return the pin key of whoever made request, None if they're anonymous"""
+    client = request.META.get('HTTP_AUTHORIZATION') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if not client:
+        return None
+    return PIN_KEY_PREFIX + hashlib.sha1(client.encode()).hexdigest()
+
+
+def _pin_cache():
+    return caches[settings.READ_REPLICAS['PIN_CACHE']]
+
+
+class ReplicaRoutingMiddleware:
+    """Give safe requests to the READ_REPLICAS['ROUTES'] a replica, unless the client wrote in the last STICKY_SECONDS"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            self._is_coroutine = asyncio.coroutines._is_coroutine #Marks the instance as async for Django
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = _read_alias.set(self.choose(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            _read_alias.reset(token)
+        self.pin(request)
+        return response
+
+    async def __acall__(self, request):
+        token = _read_alias.set(self.choose(request)) #core.async_db.run_db copies it to the database threads
+        try:
+            response = await self.get_response(request)
+        finally:
+            _read_alias.reset(token)
+        self.pin(request)
+        return response
+
+    def choose(self, request):
+        """Return the replica request should read from, None for the primary"""
+        if not settings.READ_REPLICAS['ALIASES'] or request.method not in SAFE_METHODS:
+            return None
+        try:
+            route = resolve(request.path_info).view_name
+        except Resolver404:
+            return None
+        if route not in settings.READ_REPLICAS['ROUTES']:
+            return None
+        key = _client_key(request)
+        if key and _pin_cache().get(key): #Reads their own write, which the replicas may not have yet
+            return None
+        return pool.choose()
+
+    def pin(self, request):
+        """Keep the client of a write request on the primary for STICKY_SECONDS"""
+        if not settings.READ_REPLICAS['ALIASES'] or request.method in SAFE_METHODS:
+            return
+        key = _client_key(request)
+        if key and settings.READ_REPLICAS['STICKY_SECONDS'] > 0:
+            _pin_cache().set(key, True, settings.READ_REPLICAS['STICKY_SECONDS'])
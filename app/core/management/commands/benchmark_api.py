@@ -0,0 +1,395 @@
+"""
+Django command to load test every endpoint of the recipe and user APIs and compare the results with a baseline
+"""
+import json
+import logging
+import platform
+import random
+import re
+import subprocess
+import threading
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+from urllib import error, request as urllib_request
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework.authtoken.models import Token
+
+from core import seeding
+from recipe.sync import current_token
+
+EMAIL = 'benchmark-api-{recipes}@example.com'
+PASSWORD = 'benchmark123'
+QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+HEAVY_REQUESTS = 5 #Requests made to the endpoints that return every recipe of the user (export, full sync)
+MOBILE_FIELDS = 'id,title,price' #What the mobile list view shows, for the ?fields= scenarios
+
+
+class Scenario:
+    """1 endpoint to load, building the request for the i-th call from the seeded data in ctx"""
+
+    def __init__(self, name, build, heavy=False, compare_to=None):
+        self.name = name
+        self.build = build #build(ctx, i) -> (method, path, json body or None)
+        self.heavy = heavy
+        self.compare_to = compare_to #Scenario of the same endpoint with the full response, to report the savings
+
+
+def recipe_detail(recipe_id):
+    return reverse('recipe:recipe-detail', args=[recipe_id])
+
+
+def create_recipe(ctx, i):
+    return 'POST', reverse('recipe:recipe-list'), {
+        'title': f'Benchmark recipe {i}',
+        'time_minutes': 20,
+        'price': '7.50',
+        'tags': [{'name': ctx['hot_tag']}, {'name': f'{ctx["run"]} tag {i}'}],
+        'ingredients': [{'name': ctx['hot_ingredient']}, {'name': f'{ctx["run"]} ingredient {i}'}],
+    }
+
+
+def delete_created(ctx, i):
+    return 'DELETE', recipe_detail(ctx['created'].popleft()), None
+
+
+def import_recipes(ctx, i):
+    recipes = [
+        {'title': f'Imported {i}-{n}', 'time_minutes': 5, 'price': '3.00', 'tags': [{'name': ctx['hot_tag']}]}
+        for n in range(10)
+    ]
+    return 'POST', reverse('recipe:recipe-bulk-import'), recipes
+
+
+def delete_created_tag(ctx, i):
+    return 'DELETE', reverse('recipe:tag-detail', args=[ctx['created_tags'].popleft()]), None
+
+
+SCENARIOS = [
+    Scenario('recipe:recipe-list', lambda ctx, i: ('GET', reverse('recipe:recipe-list'), None)),
+    Scenario('recipe:recipe-list?tags', lambda ctx, i: (
+        'GET', f'{reverse("recipe:recipe-list")}?tags={ctx["hot_tag_id"]}', None,
+    )),
+    Scenario('recipe:recipe-list?q', lambda ctx, i: (
+        'GET', f'{reverse("recipe:recipe-list")}?q={ctx["hot_ingredient"]}', None,
+    )),
+    Scenario('recipe:recipe-detail', lambda ctx, i: ('GET', recipe_detail(ctx['rng'].choice(ctx['recipe_ids'])), None)),
+    Scenario('recipe:recipe-list?fields', lambda ctx, i: (
+        'GET', f'{reverse("recipe:recipe-list")}?fields={MOBILE_FIELDS}', None,
+    ), compare_to='recipe:recipe-list'),
+    Scenario('recipe:recipe-detail?fields', lambda ctx, i: (
+        'GET', f'{recipe_detail(ctx["rng"].choice(ctx["recipe_ids"]))}?fields={MOBILE_FIELDS}', None,
+    ), compare_to='recipe:recipe-detail'),
+    Scenario('recipe:recipe-list POST', create_recipe),
+    Scenario('recipe:recipe-detail PATCH', lambda ctx, i: (
+        'PATCH', recipe_detail(ctx['rng'].choice(ctx['recipe_ids'])), {'title': f'Updated {i}'},
+    )),
+    Scenario('recipe:recipe-detail DELETE', delete_created), #Deletes what the POST scenario created
+    Scenario('recipe:recipe-bulk-import', import_recipes),
+    Scenario('recipe:recipe-export', lambda ctx, i: ('GET', reverse('recipe:recipe-export'), None), heavy=True),
+    Scenario('recipe:tag-list', lambda ctx, i: ('GET', reverse('recipe:tag-list'), None)),
+    Scenario('recipe:tag-list?recipe_count', lambda ctx, i: (
+        'GET', f'{reverse("recipe:tag-list")}?recipe_count=1', None,
+    )),
+    Scenario('recipe:tag-detail PATCH', lambda ctx, i: ( #Any tag but the hot one, the other scenarios use its name
+        'PATCH', reverse('recipe:tag-detail', args=[ctx['rng'].choice(ctx['tag_ids'][1:])]),
+        {'name': f'{ctx["run"]} renamed {i}'},
+    )),
+    Scenario('recipe:tag-detail DELETE', delete_created_tag), #Deletes the tags the POST scenario created
+    Scenario('recipe:ingredient-list', lambda ctx, i: ('GET', reverse('recipe:ingredient-list'), None)),
+    Scenario('recipe:ingredient-list?assigned_only', lambda ctx, i: (
+        'GET', f'{reverse("recipe:ingredient-list")}?assigned_only=1', None,
+    )),
+    Scenario('recipe:ingredient-detail PATCH', lambda ctx, i: (
+        'PATCH', reverse('recipe:ingredient-detail', args=[ctx['rng'].choice(ctx['ingredient_ids'][1:])]),
+        {'name': f'{ctx["run"]} renamed {i}'},
+    )),
+    Scenario('recipe:sync', lambda ctx, i: ('GET', reverse('recipe:sync'), None), heavy=True),
+    Scenario('recipe:sync?since', lambda ctx, i: ('GET', f'{reverse("recipe:sync")}?since={ctx["since"]}', None)),
+    Scenario('user:create', lambda ctx, i: ('POST', reverse('user:create'), {
+        'email': f'{ctx["run"]}-{ctx["recipes"]}-{i}@benchmark.example.com', 'password': PASSWORD, 'name': 'Bench',
+    })),
+    Scenario('user:token', lambda ctx, i: ('POST', reverse('user:token'), {
+        'email': ctx['email'], 'password': PASSWORD,
+    })),
+    Scenario('user:me', lambda ctx, i: ('GET', reverse('user:me'), None)),
+    Scenario('user:me PATCH', lambda ctx, i: ('PATCH', reverse('user:me'), {'name': f'Bench {i}'})),
+]
+
+
+def percentile(values, q):
+    """Return the q (0-100) percentile of values by the nearest-rank method"""
+    ordered = sorted(values)
+    return ordered[max(0, -(-len(ordered) * q // 100) - 1)]
+
+
+class Command(BaseCommand):
+    """Django command to benchmark the REST API"""
+
+    help = 'Seed users with 10/1k/100k recipes, load every endpoint and report latency, throughput and queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipes', type=int, nargs='+', default=[10, 1000, 100000],
+                            help='Recipes of each seeded user, every endpoint is loaded for each of them')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint')
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--scenarios', nargs='+', help='Only run the endpoints with these names')
+        parser.add_argument('--url', help='Base URL of a running server using this database, instead of in-process')
+        parser.add_argument('--no-response-cache', action='store_true', help='Turn the list response cache off')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+        parser.add_argument('--threshold', type=float, default=10, help='%% slower p95 that counts as a regression')
+        parser.add_argument('--fail-on-regression', action='store_true')
+        parser.add_argument('--keep', action='store_true', help="Don't delete the seeded users at the end")
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        if connection.vendor != 'postgresql':
+            raise CommandError('benchmark_api only supports PostgreSQL.')
+        scenarios = SCENARIOS
+        if options['scenarios']:
+            scenarios = [scenario for scenario in SCENARIOS if scenario.name in options['scenarios']]
+            unknown = set(options['scenarios']) - {scenario.name for scenario in scenarios}
+            if unknown:
+                raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))}.')
+
+        overrides = {
+            'SERVER_TIMING': {**settings.SERVER_TIMING, 'SAMPLE_RATE': 1, 'HEADER': True}, #For the query counts
+            'ALLOWED_HOSTS': [*settings.ALLOWED_HOSTS, 'testserver'], #The host of django.test.Client, as in the tests
+            'AUTH_TOKEN_CACHE': {**settings.AUTH_TOKEN_CACHE, 'SINGLE_PROCESS': True}, #In-process is 1 process
+            'RESPONSE_CACHE': {**settings.RESPONSE_CACHE, 'SINGLE_PROCESS': True},
+        }
+        if options['no_response_cache']:
+            overrides['RESPONSE_CACHE']['TTL'] = 0
+        run = uuid.uuid4().hex[:8] #Keeps the names the write endpoints create unique between runs
+        results = {}
+        #The errors are counted in the results instead of logged, and so are the timings core.timing would log
+        quiet = [logging.getLogger(name) for name in ('django.request', 'core.timing')]
+        levels = [logger.level for logger in quiet]
+        for logger in quiet:
+            logger.setLevel(logging.ERROR)
+        with override_settings(**overrides): #Only affects in-process requests, a --url server has its own settings
+            for recipes in options['recipes']:
+                started = time.perf_counter()
+                user = self._seed(recipes, options['seed'])
+                self.stdout.write(f'\n{recipes} recipes: seeded in {time.perf_counter() - started:.1f} s')
+                try:
+                    results[str(recipes)] = self._run_user(user, recipes, run, scenarios, options)
+                finally:
+                    if not options['keep']:
+                        self._delete(user, run)
+        for logger, level in zip(quiet, levels):
+            logger.setLevel(level)
+
+        report = {'meta': self._meta(options), 'results': results}
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(report, indent=2))
+            self.stdout.write(f'\nResults written to {options["output"]}')
+        if options['baseline']:
+            regressions = self._compare(json.loads(Path(options['baseline']).read_text()), report, options['threshold'])
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f'{regressions} endpoints regressed by more than {options["threshold"]}%.')
+
+    def _meta(self, options):
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            'started': timezone.now().isoformat(),
+            'commit': commit,
+            'target': options['url'] or 'in-process',
+            'requests': options['requests'],
+            'concurrency': options['concurrency'],
+            'response_cache': not options['no_response_cache'],
+            'python': platform.python_version(),
+            'django': django.get_version(),
+        }
+
+    def _run_user(self, user, recipes, run, scenarios, options):
+        """Load every scenario for 1 seeded user and return {scenario: stats}"""
+        token = Token.objects.get_or_create(user=user)[0].key
+        tag_ids = list(user.tag_set.order_by('id').values_list('id', flat=True))
+        ingredient_ids = list(user.ingredient_set.order_by('id').values_list('id', flat=True))
+        ctx = {
+            'run': run,
+            'recipes': recipes,
+            'email': user.email,
+            'rng': random.Random(options['seed']),
+            'recipe_ids': list(user.recipe_set.values_list('id', flat=True)),
+            'tag_ids': tag_ids,
+            'ingredient_ids': ingredient_ids,
+            #The seeding makes the lowest ids the most popular
+            'hot_tag_id': tag_ids[0],
+            'hot_tag': user.tag_set.get(pk=tag_ids[0]).name,
+            'hot_ingredient': user.ingredient_set.get(pk=ingredient_ids[0]).name,
+            'since': current_token(),
+            'created': deque(),
+            'created_tags': deque(),
+        }
+        self.stdout.write(
+            f'{"endpoint":<38} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"queries":>8} {"bytes":>9}'
+        )
+        results = {}
+        for scenario in scenarios:
+            total = min(options['requests'], HEAVY_REQUESTS) if scenario.heavy else options['requests']
+            if scenario.name == 'recipe:recipe-detail DELETE':
+                total = min(total, len(ctx['created']))
+            if scenario.name == 'recipe:tag-detail DELETE':
+                total = min(total, len(ctx['created_tags']))
+            stats = self._load(scenario, ctx, token, total, options['concurrency'], options['url'])
+            results[scenario.name] = stats
+            queries = '-' if stats['queries'] is None else f'{stats["queries"]:.1f}'
+            self.stdout.write(
+                f'{scenario.name:<38} {stats["throughput"]:>8.1f} {stats["p50_ms"]:>8.1f} {stats["p95_ms"]:>8.1f} '
+                f'{stats["p99_ms"]:>8.1f} {queries:>8} {stats["bytes"]:>9.0f}'
+                + (f'  {stats["errors"]} errors, e.g. {stats["error"]}' if stats['errors'] else '')
+            )
+        for scenario in scenarios:
+            full = results.get(scenario.compare_to)
+            if full and full['bytes'] and full['p50_ms']:
+                stats = results[scenario.name]
+                self.stdout.write(
+                    f'{scenario.name} against {scenario.compare_to}: '
+                    f'bytes {(stats["bytes"] - full["bytes"]) / full["bytes"] * 100:+.1f}%, '
+                    f'p50 {(stats["p50_ms"] - full["p50_ms"]) / full["p50_ms"] * 100:+.1f}%'
+                )
+        return results
+
+    def _load(self, scenario, ctx, token, total, concurrency, url):
+        """Make total requests for scenario, concurrency at a time, and return their stats"""
+        latencies, queries, sizes, errors = [], [], [], []
+        remaining = iter(range(total))
+        lock = threading.Lock() #Only guards building the next request, ctx is shared by the workers
+
+        def worker():
+            client = Client(HTTP_AUTHORIZATION=f'Token {token}') if not url else None
+            try:
+                while True:
+                    with lock:
+                        i = next(remaining, None)
+                        if i is None:
+                            return
+                        method, path, body = scenario.build(ctx, i)
+                    started = time.perf_counter()
+                    status, content, server_timing = self._request(client, url, token, method, path, body)
+                    latencies.append(time.perf_counter() - started)
+                    sizes.append(len(content))
+                    match = QUERIES.search(server_timing or '')
+                    if match:
+                        queries.append(int(match.group(1)))
+                    if status >= 400:
+                        errors.append(f'{status} {content[:200]!r}')
+                    elif scenario.name == 'recipe:recipe-list POST':
+                        created = json.loads(content)
+                        ctx['created'].append(created['id'])
+                        ctx['created_tags'].extend(tag['id'] for tag in created['tags'][1:])
+            finally:
+                connections.close_all() #The connections of this worker thread
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        latencies = latencies or [0]
+        return {
+            'requests': total,
+            'errors': len(errors),
+            'error': errors[0] if errors else None,
+            'throughput': total / elapsed if elapsed else 0,
+            'mean_ms': sum(latencies) / len(latencies) * 1000,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'queries': sum(queries) / len(queries) if queries else None,
+            'bytes': sum(sizes) / len(sizes) if sizes else 0,
+        }
+
+    def _request(self, client, url, token, method, path, body):
+        """Make 1 request and return the status, body and Server-Timing header"""
+        data = json.dumps(body) if body is not None else None
+        if client is not None:
+            if method == 'GET':
+                response = client.get(path)
+            else:
+                response = getattr(client, method.lower())(path, data=data or '', content_type='application/json')
+            content = b''.join(response.streaming_content) if response.streaming else response.content
+            return response.status_code, content, response.get('Server-Timing')
+
+        headers = {'Content-Type': 'application/json'}
+        if not path.startswith(reverse('user:create')) and not path.startswith(reverse('user:token')):
+            headers['Authorization'] = f'Token {token}'
+        http_request = urllib_request.Request(
+            url.rstrip('/') + path, data=data.encode() if data else None, method=method, headers=headers,
+        )
+        try:
+            with urllib_request.urlopen(http_request) as response:
+                return response.status, response.read(), response.headers.get('Server-Timing')
+        except error.HTTPError as http_error:
+            return http_error.code, http_error.read(), http_error.headers.get('Server-Timing')
+
+    def _seed(self, recipes, seed):
+        """Create a user with recipes recipes, and tags/ingredients where a few are on most recipes"""
+        email = EMAIL.format(recipes=recipes)
+        existing = get_user_model().objects.filter(email=email).first()
+        if existing: #Left over from a run that was killed or used --keep
+            return existing
+
+        tags = max(10, min(500, recipes // 20))
+        #Every name of the vocabularies, the Zipf draws put the first few tags/ingredients on most recipes, like "dinner"
+        #or "salt", and most of the rest on a handful
+        config = seeding.make_config(
+            seed=seed, email=email, password=PASSWORD, recipes_per_user=recipes,
+            tags_per_user=tags, ingredients_per_user=tags * 2, tags_per_recipe=3, ingredients_per_recipe=8,
+            tag_names=tags, ingredient_names=tags * 2,
+        )
+        seeding.seed(config, 1)
+        return get_user_model().objects.get(email=email)
+
+    def _delete(self, user, run):
+        """Delete a seeded user and everything the run created, in SQL so 100k recipes don't go through signals"""
+        seeding.delete_users(get_user_model().objects.filter(pk=user.pk))
+        get_user_model().objects.filter(email__startswith=f'{run}-').delete() #From the user:create scenario
+
+    def _compare(self, baseline, report, threshold):
+        """Print the change of every endpoint against baseline and return how many regressed"""
+        self.stdout.write(f'\nCompared with {baseline["meta"].get("commit")} ({baseline["meta"].get("started")})')
+        regressions = compared = 0
+        for recipes, scenarios in report['results'].items():
+            for name, stats in scenarios.items():
+                before = baseline['results'].get(recipes, {}).get(name)
+                if not before or not before['p95_ms']:
+                    continue
+                compared += 1
+                p95_change = (stats['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+                throughput_change = (
+                    (stats['throughput'] - before['throughput']) / before['throughput'] * 100
+                    if before['throughput'] else 0
+                )
+                regressed = p95_change > threshold
+                regressions += regressed
+                self.stdout.write(
+                    f'{recipes:>7} {name:<38} p95 {p95_change:+7.1f}%  req/s {throughput_change:+7.1f}%'
+                    + ('  REGRESSION' if regressed else '')
+                )
+        if not compared:
+            self.stdout.write('No endpoints were run with the same number of recipes as in the baseline.')
+        return regressions
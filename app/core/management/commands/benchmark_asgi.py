@@ -0,0 +1,118 @@
+"""
+Django command to compare the sync and async read views served over ASGI
+"""
+import asyncio
+import statistics
+import time
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+
+from rest_framework.authtoken.models import Token
+
+from core.models import Recipe
+
+EMAIL = 'benchmark-asgi@example.com'
+URLCONFS = {'sync': 'app.urls', 'async': 'app.asgi_urls'}
+
+
+class Command(BaseCommand):
+    """Django command to benchmark requests/s of the read endpoints under ASGI on 1 process"""
+
+    help = 'Serve the recipe list in-process through the ASGI handler with the sync and the async views'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50])
+        parser.add_argument('--recipes', type=int, default=100, help='Recipes the benchmark user has')
+        parser.add_argument(
+            '--latency', type=float, default=0,
+            help='Milliseconds added to every query, to simulate a database on another host',
+        )
+        parser.add_argument('--path', default='/api/recipe/recipes/')
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        #The requests run on other threads, so the seed data has to be committed, and is deleted again at the end
+        get_user_model().objects.filter(email=EMAIL).delete() #Left over if a previous run was killed
+        user = get_user_model().objects.create_user(EMAIL, 'benchmark123')
+        try:
+            token = Token.objects.create(user=user)
+            Recipe.objects.bulk_create([
+                Recipe(user=user, title=f'Recipe {i}', time_minutes=10, price=Decimal('5.00'))
+                for i in range(options['recipes'])
+            ])
+            delay = options['latency'] / 1000
+
+            def add_latency(sender, connection, **kwargs):
+                connection.execute_wrappers.append(lambda execute, *args: time.sleep(delay) or execute(*args))
+
+            if delay:
+                connection_created.connect(add_latency)
+            try:
+                self._run(token.key, options)
+            finally:
+                connection_created.disconnect(add_latency)
+                connections.close_all()
+        finally:
+            user.delete()
+
+    def _run(self, key, options):
+        self.stdout.write(f'{options["requests"]} x GET {options["path"]}, {options["latency"]} ms added per query')
+        for concurrency in options['concurrency']:
+            for mode, urlconf in URLCONFS.items():
+                with override_settings(ROOT_URLCONF=urlconf):
+                    elapsed, latencies = asyncio.run(
+                        self._benchmark(ASGIHandler(), key, options['path'], options['requests'], concurrency)
+                    )
+                self.stdout.write(
+                    f'concurrency {concurrency:>4} {mode:>5}: {options["requests"] / elapsed:8.1f} req/s, '
+                    f'p50 {statistics.median(latencies) * 1000:7.1f} ms, '
+                    f'max {max(latencies) * 1000:7.1f} ms'
+                )
+
+    async def _benchmark(self, application, key, path, total, concurrency):
+        """Send total requests, concurrency at a time, and return the elapsed time and each request's latency"""
+        latencies = []
+        remaining = iter(range(total))
+
+        async def client():
+            for _ in remaining:
+                started = time.perf_counter()
+                status = await self._request(application, key, path)
+                latencies.append(time.perf_counter() - started)
+                if status != 200:
+                    raise RuntimeError(f'GET {path} returned {status}')
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return time.perf_counter() - started, latencies
+
+    async def _request(self, application, key, path):
+        """Make 1 request straight to the ASGI application and return the status code"""
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'query_string': b'',
+            'headers': [(b'host', b'localhost'), (b'authorization', f'Token {key}'.encode())],
+            'server': ('localhost', 80),
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        await application(scope, receive, send)
+        return messages[0]['status']
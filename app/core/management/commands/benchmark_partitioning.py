@@ -0,0 +1,230 @@
+"""
+Django command to compare the recipe API queries and VACUUM on the plain and the hash partitioned recipe tables
+"""
+import json
+import random
+import re
+import statistics
+import time
+from pathlib import Path
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+from django.test import RequestFactory
+
+from rest_framework.request import Request
+
+from core import partitioning
+from core.management.commands.benchmark_api import percentile
+from core.models import Recipe
+from recipe import views
+from recipe.pagination import (
+    RecipeCursorPagination,
+    NameCursorPagination,
+)
+
+PARTITION_SCAN = re.compile(r' on (core_recipe\w*_p\d+)')
+PAGE_SIZE = RecipeCursorPagination.page_size
+
+
+def view_queryset(viewset, user, action='list', params=None):
+    """Return the queryset a viewset uses for user, so we time exactly what the API runs"""
+    view = viewset(action=action, format_kwarg=None)
+    view.request = Request(RequestFactory().get('/', params))
+    view.request.user = user
+    return view.get_queryset()
+
+
+#(name, build(ctx) -> queryset) of the queries the recipe endpoints make, ctx is 1 sampled user's data
+QUERIES = [
+    ('recipe:recipe-list', lambda ctx: view_queryset(views.RecipeViewSet, ctx['user'])[:PAGE_SIZE]),
+    ('recipe:recipe-list (tags)', lambda ctx: Recipe.tags.through.objects.filter( #What group_by_recipe runs
+        recipe_id__in=ctx['page_ids'], tag__user_id=ctx['user'].pk,
+    ).values_list('recipe_id', 'tag_id', 'tag__name').order_by('tag_id')),
+    ('recipe:recipe-list?tags=', lambda ctx: view_queryset(
+        views.RecipeViewSet, ctx['user'], params={'tags': ctx['tag_id']},
+    )[:PAGE_SIZE]),
+    ('recipe:recipe-list?q=', lambda ctx: view_queryset(
+        views.RecipeViewSet, ctx['user'], params={'q': ctx['word']},
+    )[:PAGE_SIZE]),
+    ('recipe:recipe-detail', lambda ctx: view_queryset( #Evaluating it also runs the tags/ingredients prefetch
+        views.RecipeViewSet, ctx['user'], action='retrieve',
+    ).filter(pk=ctx['recipe_id'])),
+    ('recipe:tag-list?recipe_count=1', lambda ctx: view_queryset(
+        views.TagViewSet, ctx['user'], params={'recipe_count': 1},
+    ).order_by(*NameCursorPagination.ordering)[:PAGE_SIZE]),
+]
+
+
+class Command(BaseCommand):
+    """Django command to benchmark partitioning the recipe tables on the data in the database"""
+
+    help = (
+        'Time the queries of the recipe endpoints for a sample of users and VACUUM after changes to some of them, with '
+        'the plain tables and then with partition_recipes. Seed the data with seed_data first. The tables are locked '
+        'while they\'re converted, and converted back at the end unless --keep'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--partitions', type=int, default=16, help='Partitions of each table')
+        parser.add_argument('--users', type=int, default=50, help='Users to run the queries as')
+        parser.add_argument('--repeat', type=int, default=5, help='Times each query is run for each user')
+        parser.add_argument('--churn-users', type=int, default=20,
+                            help='Users whose recipes are changed before the VACUUM')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--keep', action='store_true', help='Leave the tables partitioned at the end')
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        if connection.vendor != 'postgresql':
+            raise CommandError('benchmark_partitioning only supports PostgreSQL.')
+        if options['partitions'] < 2:
+            raise CommandError('--partitions must be at least 2.')
+        if any(partitioning.partition_counts().values()):
+            raise CommandError('The tables are already partitioned, run partition_recipes --revert first.')
+
+        user_ids = list(get_user_model().objects.filter(
+            Exists(Recipe.objects.filter(user=OuterRef('pk'))),
+        ).order_by('pk').values_list('pk', flat=True))
+        if not user_ids:
+            raise CommandError('There are no recipes to benchmark, seed some with seed_data first.')
+        rng = random.Random(options['seed'])
+        contexts = [self._context(user_id) for user_id in rng.sample(user_ids, min(options['users'], len(user_ids)))]
+        churn_ids = rng.sample(user_ids, min(options['churn_users'], len(user_ids)))
+        self.stdout.write(
+            f'{Recipe.objects.count()} recipes of {len(user_ids)} users, queries as {len(contexts)} users, '
+            f'VACUUM after changing the recipes of {len(churn_ids)}'
+        )
+
+        results = {'plain': self._measure(contexts, churn_ids, options['repeat'])}
+        elapsed = partitioning.partition(options['partitions'])
+        self.stdout.write(f'Partitioned into {options["partitions"]} partitions in {elapsed:.1f} s')
+        try:
+            results['partitioned'] = self._measure(contexts, churn_ids, options['repeat'])
+        finally:
+            if not options['keep']:
+                elapsed = partitioning.unpartition()
+                self.stdout.write(f'Unpartitioned in {elapsed:.1f} s')
+
+        self._report(results, options['partitions'])
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(results, indent=2))
+            self.stdout.write(f'\nResults written to {options["output"]}')
+
+    def _context(self, user_id):
+        """Return the data of a user the queries are built from"""
+        user = get_user_model().objects.get(pk=user_id)
+        recipes = Recipe.objects.filter(user=user).order_by('-id')
+        title = recipes.values_list('title', flat=True).first()
+        return {
+            'user': user,
+            'page_ids': list(recipes.values_list('id', flat=True)[:PAGE_SIZE]),
+            'recipe_id': recipes.values_list('id', flat=True).first(),
+            'tag_id': user.tag_set.order_by('id').values_list('id', flat=True).first() or 0,
+            'word': title.split()[0],
+        }
+
+    def _measure(self, contexts, churn_ids, repeat):
+        """Return the timings of the queries and of VACUUM with the tables as they are now"""
+        tables = list(partitioning.partition_counts())
+        with connection.cursor() as cursor:
+            cursor.execute(f'VACUUM (ANALYZE) {", ".join(tables)}') #Starts both runs with no dead rows
+        queries = {}
+        for name, build in QUERIES:
+            list(build(contexts[0])) #Warms the cache, the first run reads the pages from disk
+            timings = []
+            for ctx in contexts:
+                for _ in range(repeat):
+                    queryset = build(ctx)
+                    started = time.perf_counter()
+                    list(queryset)
+                    timings.append((time.perf_counter() - started) * 1000)
+            plan = build(contexts[0]).explain(analyze=True)
+            #The partitions pruned while the query runs show up in the plan as never executed
+            scanned = {
+                partition for line in plan.splitlines() if 'never executed' not in line
+                for partition in PARTITION_SCAN.findall(line)
+            }
+            queries[name] = {
+                'p50_ms': statistics.median(timings),
+                'p95_ms': percentile(timings, 95),
+                'partitions': len(scanned),
+            }
+        return {'queries': queries, **self._vacuum(churn_ids, tables)}
+
+    def _vacuum(self, churn_ids, tables):
+        """Time VACUUM after changing every recipe and link of churn_ids, return its stats"""
+        with transaction.atomic(), connection.cursor() as cursor:
+            recipe_ids = 'SELECT id FROM core_recipe WHERE user_id = ANY(%s)'
+            cursor.execute('UPDATE core_recipe SET time_minutes = time_minutes WHERE user_id = ANY(%s)', [churn_ids])
+            changed = cursor.rowcount
+            cursor.execute(f'UPDATE core_recipe_tags SET tag_id = tag_id WHERE recipe_id IN ({recipe_ids})', [churn_ids])
+            changed += cursor.rowcount
+            cursor.execute(
+                f'UPDATE core_recipe_ingredients SET ingredient_id = ingredient_id WHERE recipe_id IN ({recipe_ids})',
+                [churn_ids],
+            )
+            changed += cursor.rowcount
+            transaction.set_rollback(True) #Leaves a dead version of every row it changed, and the data as it was
+
+        with connection.cursor() as cursor:
+            #Autovacuum vacuums each partition on its own, only the ones with the changed rows need it
+            cursor.execute(
+                f'SELECT DISTINCT tableoid::regclass::text FROM core_recipe WHERE user_id = ANY(%s) '
+                f'UNION SELECT DISTINCT tableoid::regclass::text FROM core_recipe_tags WHERE recipe_id IN ({recipe_ids}) '
+                f'UNION SELECT DISTINCT tableoid::regclass::text FROM core_recipe_ingredients '
+                f'WHERE recipe_id IN ({recipe_ids})',
+                [churn_ids] * 3,
+            )
+            vacuumed = sorted(row[0] for row in cursor.fetchall())
+            cursor.execute(
+                'SELECT max(pg_relation_size(indexrelid)) FROM pg_index WHERE indrelid = ANY(%s::regclass[])',
+                [vacuumed],
+            )
+            largest_index = cursor.fetchone()[0]
+            #INDEX_CLEANUP ON, because autovacuum only starts on a table once it has enough dead rows that it would
+            #vacuum the indexes too. It's what takes the longest, every index of the table is read
+            timings = []
+            for table in vacuumed: #1 at a time like autovacuum, which can run a few at once
+                started = time.perf_counter()
+                cursor.execute(f'VACUUM (INDEX_CLEANUP ON) {table}')
+                timings.append(time.perf_counter() - started)
+        return {
+            'vacuum_s': sum(timings),
+            'longest_vacuum_s': max(timings),
+            'vacuumed_tables': len(vacuumed),
+            'dead_rows': changed,
+            'largest_index_mb': largest_index / 2 ** 20,
+        }
+
+    def _report(self, results, partitions):
+        """Print the results of the plain and the partitioned tables side by side"""
+        plain, partitioned = results['plain'], results['partitioned']
+        self.stdout.write(
+            f'\n{"query":<34} {"plain p50":>10} {"p95 ms":>8} {"part. p50":>10} {"p95 ms":>8} {"change":>8} '
+            f'{"partitions":>11}'
+        )
+        for name, before in plain['queries'].items():
+            after = partitioned['queries'][name]
+            change = (after['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100 if before['p50_ms'] else 0
+            self.stdout.write(
+                f'{name:<34} {before["p50_ms"]:>10.2f} {before["p95_ms"]:>8.2f} {after["p50_ms"]:>10.2f} '
+                f'{after["p95_ms"]:>8.2f} {change:>+7.1f}% {after["partitions"]:>5}/{partitions * 3:<5}'
+            )
+        change = (partitioned['vacuum_s'] - plain['vacuum_s']) / plain['vacuum_s'] * 100 if plain['vacuum_s'] else 0
+        self.stdout.write(
+            f'\nVACUUM of {plain["dead_rows"]} dead rows: {plain["vacuum_s"]:.2f} s on the {plain["vacuumed_tables"]} '
+            f'tables, {partitioned["vacuum_s"]:.2f} s on the {partitioned["vacuumed_tables"]} partitions with them '
+            f'({change:+.1f}%)'
+        )
+        self.stdout.write(
+            f'Longest VACUUM of 1 table: {plain["longest_vacuum_s"]:.2f} s plain, '
+            f'{partitioned["longest_vacuum_s"]:.2f} s partitioned'
+        )
+        self.stdout.write(
+            f'Largest index VACUUM read: {plain["largest_index_mb"]:.1f} MB plain, '
+            f'{partitioned["largest_index_mb"]:.1f} MB partitioned'
+        )
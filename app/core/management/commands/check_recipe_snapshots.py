@@ -0,0 +1,74 @@
+"""
+Django command to find the recipes whose snapshot doesn't match their tags and ingredients, or that have no
+search_vector, and rebuild them
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from core.models import Recipe
+from recipe.cache import bump_version
+
+
+class Command(BaseCommand):
+    """Django command to check the recipe snapshots, e.g. check_recipe_snapshots --repair"""
+
+    help = (
+        'Compare every recipe\'s snapshot with what core_recipe_snapshot() builds from the through tables, including the '
+        'NULL ones of recipes from before migration 0016, and find the recipes without a search_vector, which those from '
+        'before migration 0009 are. With --repair the recipes found are rebuilt by the trigger, which also gives them a '
+        'new sync_xid, so clients sync them again'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='Rebuild the recipes found')
+        parser.add_argument('--batch', type=int, default=1000, help='Recipes checked in each query')
+        parser.add_argument(
+            '--database', action='append',
+            help='Database to check, can be repeated. Defaults to every shard in SHARDING',
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        if options['batch'] < 1:
+            raise CommandError('--batch must be at least 1.')
+        aliases = options['database'] or settings.SHARDING['SHARDS']
+        for alias in aliases:
+            if alias not in connections.databases:
+                raise CommandError(f'There is no database {alias}.')
+
+        total = 0
+        for alias in aliases:
+            found = self.check_database(alias, options['batch'], options['repair'])
+            self.stdout.write(f'{alias}: {found} recipes with a wrong or missing snapshot or search_vector')
+            total += found
+        done = 'Repaired' if options['repair'] else 'Found'
+        self.stdout.write(self.style.SUCCESS(f'{done} {total} recipes.'))
+
+    def check_database(self, alias, batch, repair):
+        """Check the recipes of 1 database batch ids at a time, return how many were wrong"""
+        #Batches of ids rather than 1 query, so a repair only locks batch recipes at a time while the API keeps running
+        ids = Recipe.objects.using(alias).order_by('id').values_list('id', flat=True)
+        found, last_id = 0, 0
+        while True:
+            batch_ids = list(ids.filter(id__gt=last_id)[:batch])
+            if not batch_ids:
+                return found
+            last_id = batch_ids[-1]
+            with transaction.atomic(using=alias), connections[alias].cursor() as cursor:
+                cursor.execute(
+                    'SELECT id, user_id FROM core_recipe WHERE id = ANY(%s) '
+                    'AND (snapshot IS DISTINCT FROM core_recipe_snapshot(id) OR search_vector IS NULL)',
+                    [batch_ids],
+                )
+                wrong = cursor.fetchall()
+                found += len(wrong)
+                if repair and wrong:
+                    #Setting search_vector to NULL is how the through table triggers touch recipes (see migration 0014),
+                    #the trigger then rebuilds the snapshot and search_vector together
+                    cursor.execute(
+                        'UPDATE core_recipe SET search_vector = NULL WHERE id = ANY(%s)',
+                        [[recipe_id for recipe_id, _ in wrong]],
+                    )
+                    for user_id in {user_id for _, user_id in wrong}:
+                        bump_version(user_id, alias) #Their cached list responses were built from the old snapshots
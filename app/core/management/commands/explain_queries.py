@@ -0,0 +1,144 @@
+"""
+Django command to check the API queries use the indexes on the core models
+"""
+import re
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import RequestFactory
+
+from rest_framework.request import Request
+
+from core.models import (
+    Recipe,
+    Tag,
+    Ingredient,
+    Tombstone,
+)
+from recipe import views
+from recipe.pagination import (
+    RecipeCursorPagination,
+    NameCursorPagination,
+)
+from recipe.sync import (
+    changed_since,
+    current_token,
+    decode_token,
+)
+
+INDEX_SCAN = re.compile(r'Index (?:Only )?Scan(?: Backward)? (?:using|on) (\S+)')
+SEQ_SCAN = re.compile(r'Seq Scan on (\S+)')
+EXECUTION_TIME = re.compile(r'Execution Time: ([\d.]+) ms')
+PARTITION_SUFFIX = re.compile(r'_p\d+$') #The indexes of a partition are named after the table's, see core/partitioning.py
+
+
+class Command(BaseCommand):
+    """Django command to EXPLAIN ANALYZE the queries behind each API endpoint"""
+
+    help = 'Run EXPLAIN ANALYZE on the queries each recipe endpoint makes and report which indexes they use'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--email',
+            help='User to run the queries as, defaults to the user with the most recipes',
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        if connection.vendor != 'postgresql':
+            raise CommandError('explain_queries only supports PostgreSQL.')
+
+        user = self._get_user(options['email'])
+        self.stdout.write(f'Explaining queries for {user.email}')
+
+        missing = 0
+        for name, queryset, expected_index in self._endpoint_queries(user):
+            plan = queryset.explain(analyze=True)
+            indexes = list(dict.fromkeys(PARTITION_SUFFIX.sub('', index) for index in INDEX_SCAN.findall(plan)))
+            seq_scans = SEQ_SCAN.findall(plan)
+            time = EXECUTION_TIME.search(plan)
+
+            self.stdout.write(f'\n{name}')
+            self.stdout.write(f'  indexes:    {", ".join(indexes) or "-"}')
+            self.stdout.write(f'  seq scans:  {", ".join(seq_scans) or "-"}')
+            self.stdout.write(f'  time:       {time.group(1) if time else "?"} ms')
+            if expected_index is None and indexes or expected_index in indexes:
+                self.stdout.write(self.style.SUCCESS(f'  uses {expected_index or "an index"}'))
+            else:
+                missing += 1
+                self.stdout.write(self.style.WARNING(f'  does not use {expected_index or "an index"}'))
+
+        if missing:
+            #Postgres prefers a seq scan on small tables, so this is expected on a dev database with little data
+            self.stdout.write(self.style.WARNING(
+                f'\n{missing} queries did not use their index. Run ANALYZE, and note small tables are always seq scanned.'
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS('\nAll queries use their indexes!'))
+
+    def _get_user(self, email):
+        """Return the user to explain the queries for"""
+        users = get_user_model().objects.all()
+        if email:
+            user = users.filter(email=email).first()
+        else:
+            user = users.annotate(recipe_count=Count('recipe')).order_by('-recipe_count').first()
+        if user is None:
+            raise CommandError('No user found to explain the queries for.')
+
+        return user
+
+    def _view_queryset(self, viewset, user, action='list', params=None):
+        """Return the queryset a viewset uses for user, so we explain exactly what the API runs"""
+        view = viewset(action=action, format_kwarg=None)
+        view.request = Request(RequestFactory().get('/', params))
+        view.request.user = user
+
+        return view.get_queryset()
+
+    def _endpoint_queries(self, user):
+        """Return (name, queryset, expected index) for each query the endpoints make"""
+        #An expected index of None means any index will do, i.e. the ones Django creates for the through tables
+        page_size = RecipeCursorPagination.page_size
+        recipes = self._view_queryset(views.RecipeViewSet, user)
+        recipe_page = recipes.order_by(RecipeCursorPagination.ordering)[:page_size]
+        recipe_ids = list(recipe_page.values_list('id', flat=True))
+        tag = Tag.objects.filter(user=user).first()
+        ingredient = Ingredient.objects.filter(user=user).first()
+
+        queries = [
+            ('recipe:recipe-list', recipe_page, 'recipe_user_id_desc_idx'),
+            ('recipe:recipe-list (search)',
+                self._view_queryset(views.RecipeViewSet, user, params={'q': 'recipe'})[:page_size],
+                'recipe_search_vector_gin'),
+            ('recipe:recipe-list (tags)', Tag.objects.filter(recipe__in=recipe_ids), None),
+            ('recipe:recipe-list (ingredients)', Ingredient.objects.filter(recipe__in=recipe_ids), None),
+            ('recipe:tag-list',
+                self._view_queryset(views.TagViewSet, user).order_by(*NameCursorPagination.ordering)[:page_size],
+                'unique_tag_name_per_user'),
+            ('recipe:tag-list (recipe_count)',
+                self._view_queryset(views.TagViewSet, user, params={'recipe_count': 1, 'assigned_only': 1})
+                    .order_by(*NameCursorPagination.ordering)[:page_size],
+                'core_recipe_tags_tag_id_recipe_id_idx'),
+            ('recipe:ingredient-list',
+                self._view_queryset(views.IngredientViewSet, user).order_by(*NameCursorPagination.ordering)[:page_size],
+                'unique_ingredient_name_per_user'),
+        ]
+        snapshot = decode_token(current_token())[1]
+        queries += [
+            ('recipe:sync (recipes)', changed_since(Recipe.objects.filter(user=user), snapshot), 'recipe_user_sync_xid_idx'),
+            ('recipe:sync (tags)', changed_since(Tag.objects.filter(user=user), snapshot), 'tag_user_sync_xid_idx'),
+            ('recipe:sync (tombstones)', changed_since(Tombstone.objects.filter(user=user), snapshot),
+                'tombstone_user_sync_xid_idx'),
+        ]
+        if tag is not None:
+            queries.append(('recipes with tag', Recipe.tags.through.objects.filter(tag=tag).values('recipe_id'),
+                'core_recipe_tags_tag_id_recipe_id_idx'))
+        if ingredient is not None:
+            queries.append(('recipes with ingredient',
+                Recipe.ingredients.through.objects.filter(ingredient=ingredient).values('recipe_id'),
+                'core_recipe_ingredients_ingredient_id_recipe_id_idx'))
+
+        return queries
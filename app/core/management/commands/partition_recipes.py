@@ -0,0 +1,53 @@
+"""
+Django command to convert the recipe and through tables to Postgres hash partitions, or back to plain tables
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from core import partitioning
+
+
+class Command(BaseCommand):
+    """Django command to partition the recipe tables, e.g. partition_recipes --partitions 32"""
+
+    help = (
+        'Rebuild core_recipe as hash partitions on user_id and its tag/ingredient through tables as hash partitions on '
+        'recipe_id, or as plain tables again with --revert. The tables are locked while their rows are copied, so run '
+        'it when the API is down. Indexes added later can\'t be created CONCURRENTLY on the partitioned tables'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--partitions', type=int, default=16, help='Partitions of each table')
+        parser.add_argument('--revert', action='store_true', help='Rebuild the tables unpartitioned')
+        parser.add_argument(
+            '--database', action='append',
+            help='Database to convert, can be repeated. Defaults to every shard in SHARDING',
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        if options['partitions'] < 2:
+            raise CommandError('--partitions must be at least 2.')
+        aliases = options['database'] or settings.SHARDING['SHARDS']
+        for alias in aliases:
+            if alias not in connections.databases:
+                raise CommandError(f'There is no database {alias}.')
+            if connections[alias].vendor != 'postgresql':
+                raise CommandError('partition_recipes only supports PostgreSQL.')
+
+        for alias in aliases:
+            counts = partitioning.partition_counts(alias)
+            if options['revert']:
+                if not any(counts.values()):
+                    self.stdout.write(f'{alias}: the tables aren\'t partitioned.')
+                    continue
+                elapsed = partitioning.unpartition(alias)
+                done = 'unpartitioned'
+            else:
+                if set(counts.values()) == {options['partitions']}:
+                    self.stdout.write(f'{alias}: the tables already have {options["partitions"]} partitions.')
+                    continue
+                elapsed = partitioning.partition(options['partitions'], alias)
+                done = f'split into {options["partitions"]} partitions'
+            self.stdout.write(self.style.SUCCESS(f'{alias}: {", ".join(counts)} {done} in {elapsed:.1f} s.'))
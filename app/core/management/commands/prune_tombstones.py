@@ -0,0 +1,24 @@
+"""
+Django command to delete tombstones older than the sync tokens that could still need them
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import Tombstone
+
+
+class Command(BaseCommand):
+    """Django command to delete old tombstones, run it daily e.g. from cron"""
+
+    help = 'Delete the tombstones of rows deleted more than SYNC_TOKEN_MAX_AGE seconds ago'
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        #Tokens older than SYNC_TOKEN_MAX_AGE get a full sync, which doesn't use tombstones
+        cutoff = timezone.now() - timedelta(seconds=settings.SYNC_TOKEN_MAX_AGE)
+        deleted, _ = Tombstone.objects.filter(deleted_at__lt=cutoff).delete()
+
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} tombstones.'))
@@ -0,0 +1,68 @@
+"""
+Django command to move users to the shard the hash ring picks for them, after shards are added or removed
+"""
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core import sharding
+
+
+class Command(BaseCommand):
+    """Django command to rebalance users between shards while the API keeps running"""
+
+    help = (
+        'Move the users whose shard in SHARDING changed. A user\'s data can be read during their move, changes get a '
+        '503 with Retry-After until it\'s done'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only list the moves')
+        parser.add_argument('--limit', type=int, help='Move at most this many users')
+        parser.add_argument('--batch', type=int, default=100, help='Users moved together')
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        if not sharding.is_enabled():
+            raise CommandError('There is only 1 shard, set DB_SHARD_HOSTS to add more.')
+        moves = sharding.planned_moves(options['limit'])
+        counts = {}
+        for _, source, target in moves:
+            counts[source, target] = counts.get((source, target), 0) + 1
+        for (source, target), count in sorted(counts.items()):
+            self.stdout.write(f'{source} -> {target}: {count} users')
+        if options['dry_run'] or not moves:
+            self.stdout.write(self.style.SUCCESS(f'{len(moves)} users to move.'))
+            return
+
+        for shard in settings.SHARDING['SHARDS']:
+            sharding.prepare_shard(shard)
+        rows = 0
+        for start in range(0, len(moves), options['batch']):
+            rows += self.move(moves[start:start + options['batch']])
+            self.stdout.write(f'Moved {min(start + options["batch"], len(moves))}/{len(moves)} users')
+        self.stdout.write(self.style.SUCCESS(f'Moved {len(moves)} users and {rows} rows.'))
+
+    def move(self, moves):
+        """Move a batch of users, return the rows copied"""
+        #Every process caches where a user lives for PLACEMENT_TTL seconds, so each step waits that long for all of
+        #them to see it: first that the users are moving (no more changes), then that they're on the new shard, before
+        #their data is deleted from the old one
+        wait = settings.SHARDING['PLACEMENT_TTL']
+        for user, source, _ in moves:
+            sharding.set_placement(user, source, moving=True)
+        time.sleep(wait)
+        rows, moved = 0, []
+        try:
+            for user, source, target in moves:
+                rows += sharding.copy_user_data(user, source, target) #All or nothing for each user
+                sharding.finish_move(user, target)
+                moved.append((user, source))
+        finally:
+            for user, source, _ in moves[len(moved):]: #After an error, the rest stay where they were
+                sharding.set_placement(user, source, moving=False)
+            time.sleep(wait)
+            for user, source in moved:
+                sharding.delete_user_data(user.pk, source)
+        return rows
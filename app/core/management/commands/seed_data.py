@@ -0,0 +1,90 @@
+"""
+Django command to fill the database with synthetic users, recipes, tags and ingredients for performance testing
+"""
+import os
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from core import seeding
+
+
+class Command(BaseCommand):
+    """Django command to seed millions of rows, e.g. seed_data --users 100000 --workers 8"""
+
+    help = (
+        'Create synthetic users with recipes, tags and ingredients. Distributions are N, fixed:N, uniform:LOW:HIGH, '
+        'lognormal:MEAN:SIGMA or zipf:S:MAX. The same --seed creates the same data whatever the --workers'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--recipes-per-user', default='lognormal:50:1')
+        parser.add_argument('--tags-per-user', default='uniform:5:40')
+        parser.add_argument('--ingredients-per-user', default='uniform:20:150')
+        parser.add_argument('--tags-per-recipe', default='uniform:1:5')
+        parser.add_argument('--ingredients-per-recipe', default='uniform:3:12')
+        parser.add_argument('--tag-names', type=int, default=1000, help='Different tag names to pick from')
+        parser.add_argument('--ingredient-names', type=int, default=5000, help='Different ingredient names to pick from')
+        parser.add_argument('--zipf', type=float, default=1.1,
+                            help='Zipf exponent of how much more popular the first names are, 0 for none')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--chunk-size', type=int, default=200, help='Users per transaction')
+        parser.add_argument('--email-prefix', default='seed-', help='Users are <prefix><n>@example.com')
+        parser.add_argument('--password', default='seedpass123', help='The password of every user')
+        parser.add_argument('--clear', action='store_true', help='Delete the users of an earlier run with the prefix')
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        if connection.vendor != 'postgresql':
+            raise CommandError('seed_data only supports PostgreSQL.')
+        if options['users'] < 1 or options['workers'] < 1 or options['chunk_size'] < 1:
+            raise CommandError('--users, --workers and --chunk-size must be at least 1.')
+        try:
+            config = seeding.make_config(
+                seed=options['seed'],
+                email=options['email_prefix'] + '{index}@example.com',
+                password=options['password'],
+                recipes_per_user=options['recipes_per_user'],
+                tags_per_user=options['tags_per_user'],
+                ingredients_per_user=options['ingredients_per_user'],
+                tags_per_recipe=options['tags_per_recipe'],
+                ingredients_per_recipe=options['ingredients_per_recipe'],
+                tag_names=options['tag_names'],
+                ingredient_names=options['ingredient_names'],
+                zipf=options['zipf'],
+            )
+        except ValueError as value_error:
+            raise CommandError(value_error)
+
+        existing = get_user_model().objects.filter(
+            email__startswith=options['email_prefix'], email__endswith='@example.com',
+        )
+        if options['clear']:
+            started = time.perf_counter()
+            deleted = seeding.delete_users(existing)
+            self.stdout.write(f'Deleted {deleted} users in {time.perf_counter() - started:.1f} s')
+        elif existing.exists():
+            raise CommandError(
+                f'Users starting with {options["email_prefix"]} already exist, use --clear or another --email-prefix.'
+            )
+
+        workers = min(options['workers'], -(-options['users'] // options['chunk_size']))
+        started = time.perf_counter()
+
+        def progress(totals):
+            self.stdout.write(f'\r{totals["users"]}/{options["users"]} users', ending='')
+            self.stdout.flush()
+
+        totals = seeding.seed(config, options['users'], workers, options['chunk_size'], progress)
+        elapsed = time.perf_counter() - started
+        rows = sum(totals.values())
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {totals["users"]} users, {totals["recipes"]} recipes, {totals["tags"]} tags, '
+            f'{totals["ingredients"]} ingredients and {totals["links"]} links in {elapsed:.1f} s '
+            f'({rows / elapsed:.0f} rows/s on {workers} workers).'
+        ))
@@ -0,0 +1,214 @@
+"""
+Prometheus metrics for /metrics: request latency, statuses and queries per route, and the cache hit ratios, added
+up across every process that writes to METRICS['DIR']
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+
+from core import timing
+from recipe.cache import get_stats as get_response_cache_stats
+from user.authentication import get_stats as get_auth_stats
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+STALE_INTERVALS = 3 #Flush intervals without a write after which a snapshot is from a process that has exited
+
+_process = (None, None) #(pid, id) of the process the id was made in
+
+
+def process_id():
+    """Return the name of this process' snapshot file"""
+    #Made again in a process forked from the one that made it, e.g. the workers of gunicorn --preload, so each of them
+    #writes a file of its own. The pid alone can be reused by the next process
+    global _process
+    pid = os.getpid()
+    if _process[0] != pid:
+        _process = (pid, f'{pid}-{uuid.uuid4().hex[:8]}')
+    return _process[1]
+
+
+def process_snapshot():
+    """Return this process' counters, in a form that can be written to a file and added to the others"""
+    routes = []
+    for (method, name), stats in timing.collect_routes().items():
+        routes.append({
+            'method': method,
+            'route': name,
+            'statuses': {str(status): count for status, count in stats.statuses.items()},
+            'size': stats.size,
+            'duration': [stats.total.counts, stats.total.sum],
+            'queries': [stats.queries.counts, stats.queries.sum],
+            'db': [stats.db.counts, stats.db.sum],
+        })
+    auth = get_auth_stats()
+    return {
+        'routes': routes,
+        'response_cache': {key: get_response_cache_stats()[key] for key in ('hits', 'misses')},
+        'auth_cache': {key: auth[key] for key in ('hits', 'shared_hits', 'misses', 'size')},
+    }
+
+
+def write_snapshot():
+    """Write this process' snapshot to METRICS['DIR'], replacing its last one in 1 step so readers never see half"""
+    directory = Path(settings.METRICS['DIR'])
+    path = directory / f'{process_id()}.json'
+    temp_path = directory / f'.{process_id()}.tmp'
+    temp_path.write_text(json.dumps(process_snapshot()))
+    os.replace(temp_path, path)
+
+
+def read_snapshots():
+    """Return the snapshots of every process, or just this one when METRICS['DIR'] isn't set"""
+    if not settings.METRICS['DIR']:
+        return [process_snapshot()]
+    write_snapshot() #This process' counters are the most up to date ones
+    snapshots = []
+    #A running process writes its file every FLUSH_INTERVAL, so one that hasn't for a few intervals has exited, its file
+    #is removed and its requests leave the totals, which Prometheus takes as a counter reset. The modification time
+    #rather than the pid in the name, which is only meaningful on the host that wrote it
+    stale_before = time.time() - STALE_INTERVALS * settings.METRICS['FLUSH_INTERVAL']
+    for path in Path(settings.METRICS['DIR']).glob('*.json'):
+        try:
+            if path.stat().st_mtime < stale_before:
+                path.unlink()
+                continue
+            snapshots.append(json.loads(path.read_text()))
+        except (OSError, ValueError): #Removed since the glob
+            continue
+    return snapshots
+
+
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def start_flusher():
+    """Start the thread that writes this process' snapshot every METRICS['FLUSH_INTERVAL'] seconds, if DIR is set"""
+    #Called on every request, a forked process doesn't have the threads of the one it was forked from, so the pid
+    #tells whether this process has a flusher. Only the first request of a process takes the lock
+    global _flusher_pid
+    if _flusher_pid == os.getpid() or not settings.METRICS['DIR']:
+        return
+    with _flusher_lock:
+        if _flusher_pid != os.getpid():
+            threading.Thread(target=_flush, name='metrics-flusher', daemon=True).start()
+            _flusher_pid = os.getpid()
+
+
+def _flush():
+    while True:
+        time.sleep(settings.METRICS['FLUSH_INTERVAL'])
+        try:
+            write_snapshot()
+        except OSError:
+            pass #The next flush tries again
+
+
+def _add(totals, values):
+    for i, value in enumerate(values):
+        totals[i] += value
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _number(value):
+    return '+Inf' if value == float('inf') else repr(round(value, 6))
+
+
+def _histogram(lines, name, labels, buckets, data, scale=1):
+    counts, total = data
+    cumulative = 0
+    for bound, count in zip(buckets, counts):
+        cumulative += count
+        le = bound if bound == float('inf') else bound / scale
+        lines.append(f'{name}_bucket{_labels(**labels, le=_number(le))} {cumulative}')
+    lines.append(f'{name}_sum{_labels(**labels)} {_number(total / scale)}')
+    lines.append(f'{name}_count{_labels(**labels)} {cumulative}')
+
+
+def render(snapshots):
+    """Return the snapshots added together in the Prometheus text format"""
+    routes = {}
+    response_cache = {'hits': 0, 'misses': 0}
+    auth_cache = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'size': 0}
+    for snapshot in snapshots:
+        for route in snapshot['routes']:
+            key = (route['method'], route['route'])
+            if key not in routes:
+                routes[key] = {
+                    'statuses': {},
+                    'size': 0,
+                    'duration': [[0] * len(timing.BUCKETS), 0],
+                    'queries': [[0] * len(timing.QUERY_BUCKETS), 0],
+                    'db': [[0] * len(timing.BUCKETS), 0],
+                }
+            totals = routes[key]
+            for status, count in route['statuses'].items():
+                totals['statuses'][status] = totals['statuses'].get(status, 0) + count
+            totals['size'] += route['size']
+            for histogram in ('duration', 'queries', 'db'):
+                _add(totals[histogram][0], route[histogram][0])
+                totals[histogram][1] += route[histogram][1]
+        for key in response_cache:
+            response_cache[key] += snapshot['response_cache'][key]
+        for key in auth_cache:
+            auth_cache[key] += snapshot['auth_cache'][key]
+
+    lines = []
+
+    def metric(name, kind, help_text):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    metric('http_requests_total', 'counter', 'Requests by route (URL name) and status.')
+    for (method, name), totals in sorted(routes.items()):
+        for status, count in sorted(totals['statuses'].items()):
+            lines.append(f'http_requests_total{_labels(method=method, route=name, status=status)} {count}')
+    metric('http_request_duration_seconds', 'histogram', 'Time to respond, by route.')
+    for (method, name), totals in sorted(routes.items()):
+        _histogram(lines, 'http_request_duration_seconds', {'method': method, 'route': name},
+                   timing.BUCKETS, totals['duration'], scale=1000)
+    metric('http_response_size_bytes_total', 'counter', 'Bytes sent, by route (streamed responses not included).')
+    for (method, name), totals in sorted(routes.items()):
+        lines.append(f'http_response_size_bytes_total{_labels(method=method, route=name)} {totals["size"]}')
+    metric('db_queries_per_request', 'histogram', 'Queries made by each sampled request, by route.')
+    for (method, name), totals in sorted(routes.items()):
+        _histogram(lines, 'db_queries_per_request', {'method': method, 'route': name},
+                   timing.QUERY_BUCKETS, totals['queries'])
+    metric('db_query_duration_seconds', 'histogram', 'Time each sampled request spent on queries, by route.')
+    for (method, name), totals in sorted(routes.items()):
+        _histogram(lines, 'db_query_duration_seconds', {'method': method, 'route': name},
+                   timing.BUCKETS, totals['db'], scale=1000)
+
+    lookups = response_cache['hits'] + response_cache['misses']
+    metric('response_cache_requests_total', 'counter', 'List response cache lookups.')
+    lines.append(f'response_cache_requests_total{_labels(result="hit")} {response_cache["hits"]}')
+    lines.append(f'response_cache_requests_total{_labels(result="miss")} {response_cache["misses"]}')
+    metric('response_cache_hit_ratio', 'gauge', 'List response cache hits / lookups.')
+    lines.append(f'response_cache_hit_ratio {_number(response_cache["hits"] / lookups if lookups else 0.0)}')
+
+    lookups = auth_cache['hits'] + auth_cache['shared_hits'] + auth_cache['misses']
+    hits = auth_cache['hits'] + auth_cache['shared_hits']
+    metric('auth_token_cache_requests_total', 'counter', 'Token lookups by the cache tier that answered them.')
+    lines.append(f'auth_token_cache_requests_total{_labels(result="local_hit")} {auth_cache["hits"]}')
+    lines.append(f'auth_token_cache_requests_total{_labels(result="shared_hit")} {auth_cache["shared_hits"]}')
+    lines.append(f'auth_token_cache_requests_total{_labels(result="miss")} {auth_cache["misses"]}')
+    metric('auth_token_cache_hit_ratio', 'gauge', 'Token lookups answered by a cache / lookups.')
+    lines.append(f'auth_token_cache_hit_ratio {_number(hits / lookups if lookups else 0.0)}')
+    metric('auth_token_cache_size', 'gauge', 'Tokens in the local caches.')
+    lines.append(f'auth_token_cache_size {auth_cache["size"]}')
+
+    metric('metrics_processes', 'gauge', 'Processes the metrics were added up from.')
+    lines.append(f'metrics_processes {len(snapshots)}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:29
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def merge_duplicate_names(apps, schema_editor):
+    """Merge tags/ingredients a user created twice so the unique constraint can be added"""
+    Recipe = apps.get_model('core', 'Recipe')
+
+    for model_name, field_name in [('Tag', 'tags'), ('Ingredient', 'ingredients')]:
+        model = apps.get_model('core', model_name)
+        through = getattr(Recipe, field_name).through
+        column = model_name.lower() + '_id'
+
+        duplicates = model.objects.values('user', 'name').annotate(
+            keep_id=Min('id'), total=Count('id'),
+        ).filter(total__gt=1)
+        for duplicate in duplicates:
+            extra_ids = list(model.objects.filter(
+                user=duplicate['user'], name=duplicate['name'],
+            ).exclude(id=duplicate['keep_id']).values_list('id', flat=True))
+            recipe_ids = through.objects.filter(
+                **{column + '__in': extra_ids}
+            ).values_list('recipe_id', flat=True)
+            through.objects.bulk_create(
+                [through(recipe_id=recipe_id, **{column: duplicate['keep_id']}) for recipe_id in set(recipe_ids)],
+                ignore_conflicts=True,
+            )
+            model.objects.filter(id__in=extra_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_auto_20240210_2006'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_names, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:30
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False #CREATE INDEX CONCURRENTLY can't run inside a transaction
+
+    dependencies = [
+        ('core', '0006_unique_tag_ingredient_names'),
+    ]
+
+    operations = [
+        AddIndexConcurrently( #Builds the index without locking core_recipe against writes
+            model_name='recipe',
+            index=models.Index(fields=['user', '-id'], name='recipe_user_id_desc_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:45
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    #The through tables for Recipe.tags and Recipe.ingredients are created by Django, so we can't declare indexes on them
+    #in core/models.py. These composite indexes cover the reverse lookup (all recipes with a given tag/ingredient) so it
+    #can be answered from the index alone
+    atomic = False #CREATE INDEX CONCURRENTLY can't run inside a transaction
+
+    dependencies = [
+        ('core', '0007_recipe_user_id_desc_idx'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS core_recipe_tags_tag_id_recipe_id_idx '
+            'ON core_recipe_tags (tag_id, recipe_id);',
+            'DROP INDEX CONCURRENTLY IF EXISTS core_recipe_tags_tag_id_recipe_id_idx;',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS core_recipe_ingredients_ingredient_id_recipe_id_idx '
+            'ON core_recipe_ingredients (ingredient_id, recipe_id);',
+            'DROP INDEX CONCURRENTLY IF EXISTS core_recipe_ingredients_ingredient_id_recipe_id_idx;',
+        ),
+    ]
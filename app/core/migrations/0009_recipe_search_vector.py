@@ -0,0 +1,127 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:39
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+#core_recipe.search_vector is computed by a BEFORE trigger on core_recipe, which reads the recipe's tag and ingredient
+#names. Changes to the through tables or to a tag/ingredient name "touch" the affected recipes by setting
+#search_vector to NULL, which makes the core_recipe trigger recompute them. Only the changed recipes are updated.
+#The existing recipes are left NULL here, updating them all in the migration's transaction would lock the whole table
+#for the deploy. check_recipe_snapshots --repair fills them in, a batch at a time
+SEARCH_VECTOR_SQL = '''
+CREATE FUNCTION core_recipe_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce((
+            SELECT string_agg(tag.name, ' ')
+            FROM core_recipe_tags recipe_tag JOIN core_tag tag ON tag.id = recipe_tag.tag_id
+            WHERE recipe_tag.recipe_id = NEW.id
+        ), '')), 'B') ||
+        setweight(to_tsvector('english', coalesce((
+            SELECT string_agg(ingredient.name, ' ')
+            FROM core_recipe_ingredients recipe_ingredient
+            JOIN core_ingredient ingredient ON ingredient.id = recipe_ingredient.ingredient_id
+            WHERE recipe_ingredient.recipe_id = NEW.id
+        ), '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(NEW.description, '')), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER core_recipe_search_vector_insert
+    BEFORE INSERT ON core_recipe
+    FOR EACH ROW EXECUTE FUNCTION core_recipe_search_vector_update();
+
+CREATE TRIGGER core_recipe_search_vector_update
+    BEFORE UPDATE OF title, description, search_vector ON core_recipe
+    FOR EACH ROW
+    WHEN (OLD.title IS DISTINCT FROM NEW.title
+          OR OLD.description IS DISTINCT FROM NEW.description
+          OR NEW.search_vector IS NULL)
+    EXECUTE FUNCTION core_recipe_search_vector_update();
+
+CREATE FUNCTION core_recipe_search_vector_touch_added() RETURNS trigger AS $$
+BEGIN
+    UPDATE core_recipe SET search_vector = NULL WHERE id IN (SELECT recipe_id FROM added_rows);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION core_recipe_search_vector_touch_removed() RETURNS trigger AS $$
+BEGIN
+    UPDATE core_recipe SET search_vector = NULL WHERE id IN (SELECT recipe_id FROM removed_rows);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER core_recipe_tags_search_vector_insert
+    AFTER INSERT ON core_recipe_tags REFERENCING NEW TABLE AS added_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION core_recipe_search_vector_touch_added();
+CREATE TRIGGER core_recipe_tags_search_vector_delete
+    AFTER DELETE ON core_recipe_tags REFERENCING OLD TABLE AS removed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION core_recipe_search_vector_touch_removed();
+CREATE TRIGGER core_recipe_ingredients_search_vector_insert
+    AFTER INSERT ON core_recipe_ingredients REFERENCING NEW TABLE AS added_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION core_recipe_search_vector_touch_added();
+CREATE TRIGGER core_recipe_ingredients_search_vector_delete
+    AFTER DELETE ON core_recipe_ingredients REFERENCING OLD TABLE AS removed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION core_recipe_search_vector_touch_removed();
+
+CREATE FUNCTION core_tag_search_vector_rename() RETURNS trigger AS $$
+BEGIN
+    UPDATE core_recipe SET search_vector = NULL
+    WHERE id IN (SELECT recipe_id FROM core_recipe_tags WHERE tag_id = NEW.id);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION core_ingredient_search_vector_rename() RETURNS trigger AS $$
+BEGIN
+    UPDATE core_recipe SET search_vector = NULL
+    WHERE id IN (SELECT recipe_id FROM core_recipe_ingredients WHERE ingredient_id = NEW.id);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER core_tag_search_vector_rename
+    AFTER UPDATE OF name ON core_tag
+    FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+    EXECUTE FUNCTION core_tag_search_vector_rename();
+CREATE TRIGGER core_ingredient_search_vector_rename
+    AFTER UPDATE OF name ON core_ingredient
+    FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+    EXECUTE FUNCTION core_ingredient_search_vector_rename();
+'''
+
+DROP_SEARCH_VECTOR_SQL = '''
+DROP TRIGGER core_ingredient_search_vector_rename ON core_ingredient;
+DROP TRIGGER core_tag_search_vector_rename ON core_tag;
+DROP FUNCTION core_ingredient_search_vector_rename();
+DROP FUNCTION core_tag_search_vector_rename();
+DROP TRIGGER core_recipe_ingredients_search_vector_delete ON core_recipe_ingredients;
+DROP TRIGGER core_recipe_ingredients_search_vector_insert ON core_recipe_ingredients;
+DROP TRIGGER core_recipe_tags_search_vector_delete ON core_recipe_tags;
+DROP TRIGGER core_recipe_tags_search_vector_insert ON core_recipe_tags;
+DROP FUNCTION core_recipe_search_vector_touch_removed();
+DROP FUNCTION core_recipe_search_vector_touch_added();
+DROP TRIGGER core_recipe_search_vector_update ON core_recipe;
+DROP TRIGGER core_recipe_search_vector_insert ON core_recipe;
+DROP FUNCTION core_recipe_search_vector_update();
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_recipe_through_reverse_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(SEARCH_VECTOR_SQL, DROP_SEARCH_VECTOR_SQL),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_recipe_search_vector_gin'),
+    ]
+
+    operations = [
+        migrations.AddField( #Existing recipes start at the time of the migration. The default is a constant, so Postgres
+            model_name='recipe', #adds the column without rewriting the table
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
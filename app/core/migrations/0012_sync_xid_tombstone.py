@@ -0,0 +1,97 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:15
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+#sync_xid is set to the id of the transaction that changes a row. Changes to a recipe's tags/ingredients, or to the
+#name of one of its tags/ingredients, already update the recipe row (the search_vector triggers from migration 0009),
+#so those change the recipe's sync_xid too. Deleted rows are recorded in core_tombstone
+SYNC_SQL = '''
+CREATE FUNCTION core_sync_xid_set() RETURNS trigger AS $$
+BEGIN
+    NEW.sync_xid := txid_current();
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER core_recipe_sync_xid BEFORE INSERT OR UPDATE ON core_recipe
+    FOR EACH ROW EXECUTE FUNCTION core_sync_xid_set();
+CREATE TRIGGER core_tag_sync_xid BEFORE INSERT OR UPDATE ON core_tag
+    FOR EACH ROW EXECUTE FUNCTION core_sync_xid_set();
+CREATE TRIGGER core_ingredient_sync_xid BEFORE INSERT OR UPDATE ON core_ingredient
+    FOR EACH ROW EXECUTE FUNCTION core_sync_xid_set();
+
+CREATE FUNCTION core_tombstone_insert() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO core_tombstone (user_id, model, object_id, sync_xid, deleted_at)
+    SELECT user_id, TG_ARGV[0], id, txid_current(), now() FROM removed_rows;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER core_recipe_tombstone
+    AFTER DELETE ON core_recipe REFERENCING OLD TABLE AS removed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION core_tombstone_insert('recipe');
+CREATE TRIGGER core_tag_tombstone
+    AFTER DELETE ON core_tag REFERENCING OLD TABLE AS removed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION core_tombstone_insert('tag');
+CREATE TRIGGER core_ingredient_tombstone
+    AFTER DELETE ON core_ingredient REFERENCING OLD TABLE AS removed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION core_tombstone_insert('ingredient');
+'''
+
+DROP_SYNC_SQL = '''
+DROP TRIGGER core_ingredient_tombstone ON core_ingredient;
+DROP TRIGGER core_tag_tombstone ON core_tag;
+DROP TRIGGER core_recipe_tombstone ON core_recipe;
+DROP FUNCTION core_tombstone_insert();
+DROP TRIGGER core_ingredient_sync_xid ON core_ingredient;
+DROP TRIGGER core_tag_sync_xid ON core_tag;
+DROP TRIGGER core_recipe_sync_xid ON core_recipe;
+DROP FUNCTION core_sync_xid_set();
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_recipe_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('sync_xid', models.BigIntegerField()),
+                ('deleted_at', models.DateTimeField()),
+                ('user', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['user', 'sync_xid'], name='tombstone_user_sync_xid_idx'),
+                    models.Index(fields=['deleted_at'], name='tombstone_deleted_at_idx'),
+                ],
+            },
+        ),
+        #Existing rows keep a NULL sync_xid: they were changed before any sync token was handed out
+        migrations.AddField(
+            model_name='ingredient',
+            name='sync_xid',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='sync_xid',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='sync_xid',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunSQL(SYNC_SQL, DROP_SYNC_SQL),
+    ]
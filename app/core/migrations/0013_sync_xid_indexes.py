@@ -0,0 +1,27 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:15
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False #CREATE INDEX CONCURRENTLY can't run inside a transaction
+
+    dependencies = [
+        ('core', '0012_sync_xid_tombstone'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='recipe',
+            index=models.Index(fields=['user', 'sync_xid'], name='recipe_user_sync_xid_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='tag',
+            index=models.Index(fields=['user', 'sync_xid'], name='tag_user_sync_xid_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='ingredient',
+            index=models.Index(fields=['user', 'sync_xid'], name='ingredient_user_sync_xid_idx'),
+        ),
+    ]
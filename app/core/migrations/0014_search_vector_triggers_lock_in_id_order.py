@@ -0,0 +1,61 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:10
+
+from django.db import migrations
+
+#Renaming a tag/ingredient updates every recipe that has it. Postgres locks those rows in whatever order it finds
+#them, so 2 renames of tags that share recipes could each hold some of the rows the other needs and deadlock.
+#Locking the rows in id order first means the second rename waits for the first instead
+ORDERED_RENAME_SQL = '''
+CREATE OR REPLACE FUNCTION core_tag_search_vector_rename() RETURNS trigger AS $$
+BEGIN
+    UPDATE core_recipe SET search_vector = NULL
+    WHERE id IN (
+        SELECT id FROM core_recipe
+        WHERE id IN (SELECT recipe_id FROM core_recipe_tags WHERE tag_id = NEW.id)
+        ORDER BY id FOR UPDATE
+    );
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION core_ingredient_search_vector_rename() RETURNS trigger AS $$
+BEGIN
+    UPDATE core_recipe SET search_vector = NULL
+    WHERE id IN (
+        SELECT id FROM core_recipe
+        WHERE id IN (SELECT recipe_id FROM core_recipe_ingredients WHERE ingredient_id = NEW.id)
+        ORDER BY id FOR UPDATE
+    );
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+'''
+
+UNORDERED_RENAME_SQL = '''
+CREATE OR REPLACE FUNCTION core_tag_search_vector_rename() RETURNS trigger AS $$
+BEGIN
+    UPDATE core_recipe SET search_vector = NULL
+    WHERE id IN (SELECT recipe_id FROM core_recipe_tags WHERE tag_id = NEW.id);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION core_ingredient_search_vector_rename() RETURNS trigger AS $$
+BEGIN
+    UPDATE core_recipe SET search_vector = NULL
+    WHERE id IN (SELECT recipe_id FROM core_recipe_ingredients WHERE ingredient_id = NEW.id);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_sync_xid_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(ORDERED_RENAME_SQL, UNORDERED_RENAME_SQL),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_search_vector_triggers_lock_in_id_order'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShardPlacement',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='core.user')),
+                ('shard', models.CharField(max_length=63)),
+                ('moving', models.BooleanField(default=False)),
+                ('moved_at', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
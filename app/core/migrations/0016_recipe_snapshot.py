@@ -0,0 +1,104 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+#core_recipe_snapshot() builds a recipe's snapshot from the through tables. The search_vector trigger (migration 0009)
+#already reads the recipe's tag and ingredient names every time they change, so it now builds the snapshot and takes the
+#names for search_vector from it. The update trigger also runs when a save writes back a search_vector or snapshot
+#other than the one in the row: Django saves every column, so a recipe loaded before its tags changed would otherwise
+#overwrite both with what they were then
+SNAPSHOT_SQL = '''
+CREATE FUNCTION core_recipe_snapshot(recipe_id bigint) RETURNS jsonb AS $$
+    SELECT jsonb_build_object(
+        'tags', coalesce((
+            SELECT jsonb_agg(jsonb_build_array(tag.id, tag.name) ORDER BY tag.id)
+            FROM core_recipe_tags recipe_tag JOIN core_tag tag ON tag.id = recipe_tag.tag_id
+            WHERE recipe_tag.recipe_id = $1
+        ), '[]'),
+        'ingredients', coalesce((
+            SELECT jsonb_agg(jsonb_build_array(ingredient.id, ingredient.name) ORDER BY ingredient.id)
+            FROM core_recipe_ingredients recipe_ingredient
+            JOIN core_ingredient ingredient ON ingredient.id = recipe_ingredient.ingredient_id
+            WHERE recipe_ingredient.recipe_id = $1
+        ), '[]')
+    )
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION core_recipe_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.snapshot := core_recipe_snapshot(NEW.id);
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce((
+            SELECT string_agg(link->>1, ' ') FROM jsonb_array_elements(NEW.snapshot->'tags') link
+        ), '')), 'B') ||
+        setweight(to_tsvector('english', coalesce((
+            SELECT string_agg(link->>1, ' ') FROM jsonb_array_elements(NEW.snapshot->'ingredients') link
+        ), '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(NEW.description, '')), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER core_recipe_search_vector_update ON core_recipe;
+CREATE TRIGGER core_recipe_search_vector_update
+    BEFORE UPDATE OF title, description, search_vector, snapshot ON core_recipe
+    FOR EACH ROW
+    WHEN (OLD.title IS DISTINCT FROM NEW.title
+          OR OLD.description IS DISTINCT FROM NEW.description
+          OR NEW.search_vector IS NULL
+          OR OLD.search_vector IS DISTINCT FROM NEW.search_vector
+          OR OLD.snapshot IS DISTINCT FROM NEW.snapshot)
+    EXECUTE FUNCTION core_recipe_search_vector_update();
+'''
+
+DROP_SNAPSHOT_SQL = '''
+DROP TRIGGER core_recipe_search_vector_update ON core_recipe;
+CREATE TRIGGER core_recipe_search_vector_update
+    BEFORE UPDATE OF title, description, search_vector ON core_recipe
+    FOR EACH ROW
+    WHEN (OLD.title IS DISTINCT FROM NEW.title
+          OR OLD.description IS DISTINCT FROM NEW.description
+          OR NEW.search_vector IS NULL)
+    EXECUTE FUNCTION core_recipe_search_vector_update();
+
+CREATE OR REPLACE FUNCTION core_recipe_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce((
+            SELECT string_agg(tag.name, ' ')
+            FROM core_recipe_tags recipe_tag JOIN core_tag tag ON tag.id = recipe_tag.tag_id
+            WHERE recipe_tag.recipe_id = NEW.id
+        ), '')), 'B') ||
+        setweight(to_tsvector('english', coalesce((
+            SELECT string_agg(ingredient.name, ' ')
+            FROM core_recipe_ingredients recipe_ingredient
+            JOIN core_ingredient ingredient ON ingredient.id = recipe_ingredient.ingredient_id
+            WHERE recipe_ingredient.recipe_id = NEW.id
+        ), '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(NEW.description, '')), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP FUNCTION core_recipe_snapshot(bigint);
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_shard_placement'),
+    ]
+
+    operations = [
+        #Existing recipes keep a NULL snapshot, filling it in would rewrite every row of the table in 1 transaction.
+        #The list reads their tags/ingredients from the through tables until check_recipe_snapshots --repair is run
+        migrations.AddField(
+            model_name='recipe',
+            name='snapshot',
+            field=models.JSONField(editable=False, null=True),
+        ),
+        migrations.RunSQL(SNAPSHOT_SQL, DROP_SNAPSHOT_SQL),
+    ]
@@ -2,6 +2,8 @@
 Database models
 """
 from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from django.contrib.auth.models import (
     AbstractBaseUser,
@@ -33,6 +35,38 @@ class UserManager(BaseUserManager):
         return user
 
 
+class UserDataManager(models.Manager):
+    """Manager for the data a user owns, which lives on their shard (see core/sharding.py)"""
+
+    def for_user(self, user):
+        """Return the user's objects, from their shard"""
+        #Inside the recipe API views the router already picks the shard, this is for everything else, e.g. commands
+        from core.sharding import db_for_user
+        return self.using(db_for_user(user.pk)).filter(user=user)
+
+
+class NamedObjectManager(UserDataManager):
+    """Manager for objects a user names, i.e. tags and ingredients"""
+
+    def get_or_create_many(self, user, names):
+        """Return a {name: id} dict for names, creating the missing ones in bulk"""
+        names = list(dict.fromkeys(names)) #Removes duplicate names but keeps the order they were passed in
+        if not names:
+            return {}
+
+        ids = dict(self.filter(user=user, name__in=names).values_list('name', 'id')) #1 query for every name in the payload
+        missing = [name for name in names if name not in ids]
+        if missing:
+            #ignore_conflicts turns the insert into an upsert (ON CONFLICT DO NOTHING) on the unique (user, name) constraint,
+            #so if another request creates the same name at the same moment we don't fail, we just read back its row below
+            self.bulk_create(
+                [self.model(user=user, name=name) for name in missing],
+                ignore_conflicts=True,
+            )
+            #With ignore_conflicts Postgres doesn't give us back the ids, so we fetch the rows we just upserted
+            ids.update(self.filter(user=user, name__in=missing).values_list('name', 'id'))
+
+        return ids
 
 
 class User(AbstractBaseUser, PermissionsMixin):
@@ -68,6 +102,33 @@ class Recipe(models.Model):
 
     ingredients = models.ManyToManyField('Ingredient')
 
+    #Full text search document of the title, tag names, ingredient names and description. It's kept up to date by
+    #database triggers (see migration 0009), so it's also right after bulk_create or changes made outside of Django
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    #The recipe's tags and ingredients as {"tags": [[id, name], ...], "ingredients": [[id, name], ...]} sorted by id, so
+    #the recipe list doesn't have to read the through tables. Built by the same trigger as search_vector (see migration
+    #0016), NULL for recipes from before it until check_recipe_snapshots --repair fills them in
+    snapshot = models.JSONField(null=True, editable=False)
+
+    #Changed on every save, and by recipe/signals.py when its tags/ingredients are added, removed or renamed.
+    #The recipe detail ETag is made from it
+    updated_at = models.DateTimeField(auto_now=True)
+
+    #Id of the transaction that last changed the recipe, including its tags/ingredients. Set by a database trigger
+    #(see migration 0012), the sync API uses it to find what changed since a client last synced
+    sync_xid = models.BigIntegerField(null=True, editable=False)
+
+    objects = UserDataManager()
+
+    class Meta:
+        indexes = [
+            #Every recipe API query filters by user and sorts newest first, this lets Postgres read them straight off the index
+            models.Index(fields=['user', '-id'], name='recipe_user_id_desc_idx'),
+            GinIndex(fields=['search_vector'], name='recipe_search_vector_gin'), #Used by the ?q= search
+            models.Index(fields=['user', 'sync_xid'], name='recipe_user_sync_xid_idx'), #Used by the sync API
+        ]
+
     def __str__(self):
         return self.title
     
@@ -81,6 +142,18 @@ class Tag(models.Model):
         on_delete = models.CASCADE, #If the related object gets deleted, we cascade that i.e. if the user is deleted, we also delete all recipes associated with that user
     )
 
+    sync_xid = models.BigIntegerField(null=True, editable=False) #Same as Recipe.sync_xid
+
+    objects = NamedObjectManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'sync_xid'], name='tag_user_sync_xid_idx'), #Used by the sync API
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'name'], name='unique_tag_name_per_user'), #Each user can only have 1 tag with a given name
+        ]
+
     def __str__(self):
         return self.name
     
@@ -92,5 +165,51 @@ class Ingredient(models.Model):
         on_delete = models.CASCADE, #If the related object gets deleted, we cascade that i.e. if the user is deleted, we also delete all recipes associated with that user
     )
 
+    sync_xid = models.BigIntegerField(null=True, editable=False) #Same as Recipe.sync_xid
+
+    objects = NamedObjectManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'sync_xid'], name='ingredient_user_sync_xid_idx'), #Used by the sync API
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'name'], name='unique_ingredient_name_per_user'), #Each user can only have 1 ingredient with a given name
+        ]
+
     def __str__(self):
         return self.name
+
+
+class Tombstone(models.Model):
+    """Record of a deleted recipe, tag or ingredient, so the sync API can tell clients to delete it too"""
+    #Written by a database trigger (see migration 0012) whenever one of those rows is deleted. There's no foreign key
+    #constraint on user, because deleting a user deletes their recipes and adds tombstones for them in the same transaction
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False)
+    model = models.CharField(max_length=20) #recipe, tag or ingredient
+    object_id = models.BigIntegerField()
+    sync_xid = models.BigIntegerField()
+    deleted_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'sync_xid'], name='tombstone_user_sync_xid_idx'),
+            models.Index(fields=['deleted_at'], name='tombstone_deleted_at_idx'), #Used to delete old tombstones
+        ]
+
+    def __str__(self):
+        return f'{self.model} {self.object_id}'
+
+
+class ShardPlacement(models.Model):
+    """The shard a user's recipes, tags and ingredients live on, for every user placed off the primary"""
+    #Kept on the primary. moving is set while rebalance_shards copies the user to another shard, their data can be read
+    #but not changed until it's done. Sync tokens from before moved_at get a full sync, the ids in them are of the old
+    #shard's transactions
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True)
+    shard = models.CharField(max_length=63)
+    moving = models.BooleanField(default=False)
+    moved_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f'{self.user_id} on {self.shard}'
@@ -0,0 +1,154 @@
+"""
+Opt-in Postgres hash partitioning of the recipe table and its tag/ingredient through tables, see the partition_recipes
+command. core_recipe is partitioned on user_id, so the queries of a user's recipes only read the partition they're in.
+The through tables have no user_id, they're partitioned on recipe_id: their queries look up recipe ids, and their unique
+(recipe_id, tag_id) constraint has to include the partition key. Each partition is vacuumed and indexed on its own
+"""
+import time
+
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from core.models import Recipe
+
+#The tables and the column they're partitioned on, the recipe table first since the through tables reference it
+PARTITIONED = [
+    (Recipe, 'user_id'),
+    (Recipe.tags.through, 'recipe_id'),
+    (Recipe.ingredients.through, 'recipe_id'),
+]
+
+
+def partition_counts(using=DEFAULT_DB_ALIAS):
+    """Return {table: number of partitions} of the partitioned tables, 0 for a plain table"""
+    tables = [model._meta.db_table for model, _ in PARTITIONED]
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            'SELECT table_name, (SELECT count(*) FROM pg_inherits WHERE inhparent = table_name::regclass) '
+            'FROM unnest(%s::text[]) AS table_name',
+            [tables],
+        )
+        return dict(cursor.fetchall())
+
+
+def partition(partitions, using=DEFAULT_DB_ALIAS):
+    """Rebuild the recipe and through tables with that many hash partitions each, whether they're partitioned or not"""
+    if partitions < 2:
+        raise ValueError('There must be at least 2 partitions.')
+    return _rebuild_all(partitions, using)
+
+
+def unpartition(using=DEFAULT_DB_ALIAS):
+    """Rebuild the partitioned recipe and through tables as plain tables"""
+    return _rebuild_all(0, using)
+
+
+def _recipe_foreign_keys():
+    """Return (model, field) of every foreign key constraint to the recipe table"""
+    return [
+        (model, field)
+        for model in apps.get_models(include_auto_created=True)
+        for field in model._meta.local_fields
+        if field.remote_field and field.remote_field.model is Recipe and field.db_constraint
+    ]
+
+
+def _rebuild_all(partitions, using):
+    """Rebuild every table of PARTITIONED in 1 transaction, return the seconds it took"""
+    started = time.perf_counter()
+    connection = connections[using]
+    tables = [model._meta.db_table for model, _ in PARTITIONED]
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        #Nobody can read or write the tables until they're rebuilt. The deferred foreign keys are checked now, a table
+        #with checks pending can't be dropped
+        cursor.execute(f'LOCK TABLE {", ".join(tables)} IN ACCESS EXCLUSIVE MODE')
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        for model, key in PARTITIONED:
+            _rebuild(cursor, model, key, partitions)
+        if not partitions: #The foreign keys _rebuild dropped, a partitioned table can't have 1 to just its id
+            with connection.schema_editor() as editor:
+                for model, field in _recipe_foreign_keys():
+                    #Nothing stopped deleting a recipe but not its links while the recipe table was partitioned
+                    cursor.execute(
+                        f'DELETE FROM {model._meta.db_table} WHERE {field.column} NOT IN '
+                        f'(SELECT {Recipe._meta.pk.column} FROM {Recipe._meta.db_table})'
+                    )
+                    editor.execute(editor._create_fk_sql(model, field, '_fk_%(to_table)s_%(to_column)s'))
+        for table in tables:
+            cursor.execute(f'ANALYZE {table}')
+    return time.perf_counter() - started
+
+
+def _rebuild(cursor, model, key, partitions):
+    """Rebuild the table of model with its data, constraints, indexes and triggers, partitioned on key unless 0"""
+    table = model._meta.db_table
+    pk = model._meta.pk.column
+    cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, pk])
+    sequence = cursor.fetchone()[0]
+    cursor.execute(
+        "SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass "
+        "ORDER BY contype = 'f', conname",
+        [table],
+    )
+    constraints = cursor.fetchall()
+    cursor.execute(
+        'SELECT pg_get_indexdef(indexrelid) FROM pg_index WHERE indrelid = %s::regclass '
+        'AND indexrelid NOT IN (SELECT conindid FROM pg_constraint WHERE conrelid = %s::regclass)',
+        [table, table],
+    )
+    indexes = [row[0].replace(' ON ONLY ', ' ON ') for row in cursor.fetchall()] #ONLY is how a partitioned one reads
+    cursor.execute('SELECT pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = %s::regclass AND NOT tgisinternal', [table])
+    triggers = [row[0] for row in cursor.fetchall()]
+
+    new_table = f'{table}_new'
+    partition_by = f' PARTITION BY HASH ({key})' if partitions else ''
+    cursor.execute(f'CREATE TABLE {new_table} (LIKE {table} INCLUDING DEFAULTS){partition_by}')
+    for remainder in range(partitions):
+        cursor.execute(
+            f'CREATE TABLE {new_table}_p{remainder} PARTITION OF {new_table} '
+            f'FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})'
+        )
+    #The rows are copied before there are indexes, which is faster, or triggers, so search_vector and sync_xid are kept
+    cursor.execute(f'INSERT INTO {new_table} SELECT * FROM {table}')
+
+    cursor.execute(
+        'SELECT conrelid::regclass, conname FROM pg_constraint WHERE confrelid = %s::regclass AND conrelid != confrelid',
+        [table],
+    )
+    for referencing_table, name in cursor.fetchall():
+        cursor.execute(f'ALTER TABLE {referencing_table} DROP CONSTRAINT {name}')
+    if sequence: #Dropping the table would drop the sequence it owns
+        cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY NONE')
+    cursor.execute(f'DROP TABLE {table}')
+    cursor.execute(f'ALTER TABLE {new_table} RENAME TO {table}')
+    for remainder in range(partitions):
+        cursor.execute(f'ALTER TABLE {new_table}_p{remainder} RENAME TO {table}_p{remainder}')
+    if sequence:
+        cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {table}.{pk}')
+
+    for name, kind, definition in constraints:
+        if kind == 'p': #The primary key of a partitioned table has to include the partition key
+            definition = f'PRIMARY KEY ({pk}, {key})' if partitions else f'PRIMARY KEY ({pk})'
+        cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {name} {definition}')
+    for definition in indexes + triggers:
+        cursor.execute(definition)
+    if partitions:
+        _name_partition_indexes(cursor, table)
+
+
+def _name_partition_indexes(cursor, table):
+    """Name the index of each partition <index of the table>_p<n>, instead of the names Postgres makes up"""
+    cursor.execute(
+        'SELECT child.relname, parent.relname, part.relname FROM pg_inherits '
+        'JOIN pg_class child ON child.oid = inhrelid '
+        'JOIN pg_class parent ON parent.oid = inhparent '
+        'JOIN pg_index ON indexrelid = child.oid '
+        'JOIN pg_class part ON part.oid = indrelid '
+        'WHERE inhparent IN (SELECT indexrelid FROM pg_index WHERE indrelid = %s::regclass)',
+        [table],
+    )
+    for index, parent_index, partition_table in cursor.fetchall():
+        suffix = partition_table[len(table):] #_p<n>
+        name = parent_index[:63 - len(suffix)] + suffix
+        if index != name:
+            cursor.execute(f'ALTER INDEX {index} RENAME TO {name}')
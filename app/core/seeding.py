@@ -0,0 +1,323 @@
+"""
+Fast generation of synthetic users, recipes, tags and ingredients, for benchmarks and performance tests
+"""
+import bisect
+import functools
+import io
+import math
+import multiprocessing
+import random
+from decimal import Decimal
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connection, connections, transaction
+
+from rest_framework.authtoken.models import Token
+
+from core import sharding
+from core.models import (
+    Recipe,
+    Tag,
+    Ingredient,
+    ShardPlacement,
+)
+
+TAG_WORDS = [
+    'Dinner', 'Quick', 'Vegetarian', 'Lunch', 'Healthy', 'Breakfast', 'Dessert', 'Vegan', 'Comfort food', 'Baking',
+    'Soup', 'Salad', 'Spicy', 'Italian', 'Gluten free', 'Mexican', 'Indian', 'Budget', 'Kids', 'Grill', 'Snack',
+    'Thai', 'Low carb', 'High protein', 'Party', 'Summer', 'Winter', 'Chinese', 'French', 'Japanese',
+]
+INGREDIENT_WORDS = [
+    'Salt', 'Olive oil', 'Garlic', 'Onion', 'Black pepper', 'Butter', 'Sugar', 'Flour', 'Eggs', 'Milk', 'Tomato',
+    'Lemon', 'Rice', 'Chicken', 'Carrot', 'Potato', 'Cheese', 'Basil', 'Parsley', 'Ginger', 'Soy sauce', 'Honey',
+    'Beef', 'Pasta', 'Cream', 'Chili', 'Cumin', 'Paprika', 'Spinach', 'Mushroom', 'Coriander', 'Lime', 'Coconut milk',
+    'Chickpeas', 'Bell pepper', 'Yogurt', 'Thyme', 'Oregano', 'Salmon', 'Pork', 'Beans', 'Celery', 'Zucchini',
+]
+ADJECTIVES = ['Easy', 'Classic', 'Creamy', 'Crispy', 'Spicy', 'Quick', 'Roasted', 'Slow cooked', 'Grandmas', 'Simple']
+DISHES = ['soup', 'curry', 'salad', 'stew', 'bake', 'stir fry', 'pie', 'pasta', 'tacos', 'bowl', 'risotto', 'cake']
+SENTENCES = [
+    'Preheat the oven.', 'Chop everything finely.', 'Fry the onion until golden.', 'Simmer for twenty minutes.',
+    'Season to taste.', 'Serve with fresh bread.', 'Keeps for three days in the fridge.', 'Stir well and rest.',
+]
+
+
+class Distribution:
+    """Whole numbers drawn from a distribution given as text, e.g. 10, uniform:1:5, lognormal:50:1 or zipf:1.2:1000"""
+
+    def __init__(self, spec):
+        self.spec = spec
+        kind, *args = str(spec).split(':')
+        if not args:
+            kind, args = 'fixed', [kind]
+        try:
+            if (kind, len(args)) == ('fixed', 1):
+                self.kind, self.args = kind, (int(args[0]),)
+            elif (kind, len(args)) == ('uniform', 2):
+                self.kind, self.args = kind, (int(args[0]), int(args[1]))
+            elif (kind, len(args)) == ('lognormal', 2):
+                mean, sigma = float(args[0]), float(args[1])
+                self.kind, self.args = kind, (math.log(mean) - sigma ** 2 / 2, sigma)
+            elif (kind, len(args)) == ('zipf', 2):
+                self.kind, self.args = kind, (float(args[0]), int(args[1]))
+            else:
+                raise ValueError
+        except ValueError:
+            raise ValueError(
+                f'Invalid distribution "{spec}", use N, fixed:N, uniform:LOW:HIGH, lognormal:MEAN:SIGMA or zipf:S:MAX.'
+            )
+
+    def sample(self, rng):
+        if self.kind == 'fixed':
+            return self.args[0]
+        if self.kind == 'uniform':
+            return rng.randint(*self.args)
+        if self.kind == 'lognormal': #Most values near the mean, a long tail of much larger ones
+            return int(round(rng.lognormvariate(*self.args)))
+        s, maximum = self.args #1 is the most likely, then 2...up to the maximum
+        return zipf_index(rng, maximum, s) + 1
+
+    def __repr__(self):
+        return f'Distribution({self.spec!r})'
+
+
+@functools.lru_cache(maxsize=256)
+def _zipf_cumulative(n, s):
+    total, cumulative = 0.0, []
+    for rank in range(1, n + 1):
+        total += 1 / rank ** s
+        cumulative.append(total)
+    return cumulative
+
+
+def zipf_index(rng, n, s):
+    """Return an index below n, where index k is picked with a weight of 1 / (k + 1) ** s"""
+    cumulative = _zipf_cumulative(n, s)
+    return min(bisect.bisect_left(cumulative, rng.random() * cumulative[-1]), n - 1)
+
+
+def vocabulary(words, size):
+    """Return size names, the words first and then numbered variants of them"""
+    return [
+        words[i % len(words)] + (f' {i // len(words) + 1}' if i >= len(words) else '')
+        for i in range(size)
+    ]
+
+
+def _pick_names(rng, count, names, s):
+    """Return count different names, popular ones (low index) far more likely, in popularity order"""
+    count = min(count, len(names))
+    picked = set()
+    for _ in range(count * 20):
+        if len(picked) == count:
+            break
+        picked.add(zipf_index(rng, len(names), s))
+    for index in range(len(names)): #Only when the draws kept hitting the same popular names
+        if len(picked) == count:
+            break
+        picked.add(index)
+    return [names[index] for index in sorted(picked)]
+
+
+def _pick_links(rng, count, available, s):
+    """Return up to count different indexes below available, for the tags/ingredients of 1 recipe"""
+    if not available:
+        return []
+    return sorted({zipf_index(rng, available, s) for _ in range(count)})
+
+
+def make_config(seed=1, email='seed-{index}@example.com', password='seedpass123', recipes_per_user='lognormal:50:1',
+                tags_per_user='uniform:5:40', ingredients_per_user='uniform:20:150', tags_per_recipe='uniform:1:5',
+                ingredients_per_recipe='uniform:3:12', tag_names=1000, ingredient_names=5000, zipf=1.1,
+                batch_size=2000):
+    """Return the settings of a seeding run, which workers get a copy of"""
+    return {
+        'seed': seed,
+        'email': email,
+        'password_hash': make_password(password), #Hashed once, hashing for every user would take longer than the rest
+        'recipes_per_user': Distribution(recipes_per_user),
+        'tags_per_user': Distribution(tags_per_user),
+        'ingredients_per_user': Distribution(ingredients_per_user),
+        'tags_per_recipe': Distribution(tags_per_recipe),
+        'ingredients_per_recipe': Distribution(ingredients_per_recipe),
+        'tag_names': vocabulary(TAG_WORDS, tag_names),
+        'ingredient_names': vocabulary(INGREDIENT_WORDS, ingredient_names),
+        'zipf': zipf,
+        'batch_size': batch_size,
+    }
+
+
+def build_user(config, index):
+    """Return everything seeded for the index-th user, the same for the same config whichever worker builds it"""
+    rng = random.Random(config['seed'] * 1000003 + index)
+    s = config['zipf']
+    tag_names = _pick_names(rng, config['tags_per_user'].sample(rng), config['tag_names'], s)
+    ingredient_names = _pick_names(rng, config['ingredients_per_user'].sample(rng), config['ingredient_names'], s)
+    recipes = []
+    for _ in range(max(0, config['recipes_per_user'].sample(rng))):
+        ingredients = _pick_links(rng, config['ingredients_per_recipe'].sample(rng), len(ingredient_names), s)
+        main = ingredient_names[ingredients[-1]] if ingredients else 'Mystery'
+        recipes.append({
+            'title': f'{rng.choice(ADJECTIVES)} {main.lower()} {rng.choice(DISHES)}',
+            'description': ' '.join(rng.choices(SENTENCES, k=rng.randint(0, 6))),
+            'time_minutes': rng.randint(5, 180),
+            'price': Decimal(rng.randint(100, 5000)) / 100,
+            'tags': _pick_links(rng, config['tags_per_recipe'].sample(rng), len(tag_names), s),
+            'ingredients': ingredients,
+        })
+    return {
+        'email': config['email'].format(index=index),
+        'tag_names': tag_names,
+        'ingredient_names': ingredient_names,
+        'recipes': recipes,
+    }
+
+
+def _copy_links(using, table, column, rows):
+    """Insert (recipe_id, id) rows into a through table of a database with COPY"""
+    if not rows:
+        return
+    data = io.StringIO(''.join(f'{recipe_id}\t{related_id}\n' for recipe_id, related_id in rows))
+    with connections[using].cursor() as cursor:
+        cursor.copy_expert(f'COPY {table} (recipe_id, {column}) FROM STDIN', data)
+
+
+def _seed_data(config, using, users, user_rows):
+    """Create the tags, ingredients and recipes of users on the database using, and return the rows created"""
+    batch_size = config['batch_size']
+    tag_ids, ingredient_ids, recipes = [], [], []
+    for model, names_key, ids in [(Tag, 'tag_names', tag_ids), (Ingredient, 'ingredient_names', ingredient_ids)]:
+        rows = model.objects.using(using).bulk_create(
+            [model(user_id=user_row.pk, name=name) for user, user_row in zip(users, user_rows)
+             for name in user[names_key]],
+            batch_size=batch_size,
+        )
+        position = 0
+        for user in users: #The ids of each user's names, in the same order as the names
+            ids.append([row.id for row in rows[position:position + len(user[names_key])]])
+            position += len(user[names_key])
+
+    for user, user_row in zip(users, user_rows):
+        for recipe in user['recipes']:
+            recipes.append(Recipe(
+                user_id=user_row.pk, title=recipe['title'], description=recipe['description'],
+                time_minutes=recipe['time_minutes'], price=recipe['price'],
+            ))
+    recipes = Recipe.objects.using(using).bulk_create(recipes, batch_size=batch_size)
+
+    tag_links, ingredient_links = [], []
+    recipe_rows = iter(recipes)
+    for user, user_tag_ids, user_ingredient_ids in zip(users, tag_ids, ingredient_ids):
+        for recipe in user['recipes']:
+            recipe_id = next(recipe_rows).id
+            tag_links.extend((recipe_id, user_tag_ids[i]) for i in recipe['tags'])
+            ingredient_links.extend((recipe_id, user_ingredient_ids[i]) for i in recipe['ingredients'])
+    _copy_links(using, 'core_recipe_tags', 'tag_id', tag_links)
+    _copy_links(using, 'core_recipe_ingredients', 'ingredient_id', ingredient_links)
+
+    return {
+        'tags': sum(map(len, tag_ids)),
+        'ingredients': sum(map(len, ingredient_ids)),
+        'recipes': len(recipes),
+        'links': len(tag_links) + len(ingredient_links),
+    }
+
+
+def seed_chunk(config, start, stop):
+    """Create users start to stop - 1 with all their data in 1 transaction per database, and return the rows created"""
+    #bulk_create sends no signals, so seeding doesn't bump cache versions or publish change events. The database
+    #triggers still fill in search_vector and sync_xid, the through table COPYs update each recipe once per table
+    users = [build_user(config, index) for index in range(start, stop)]
+    User = get_user_model()
+    counts = {'users': 0, 'tags': 0, 'ingredients': 0, 'recipes': 0, 'links': 0}
+    with transaction.atomic(using=sharding.PRIMARY):
+        user_rows = User.objects.using(sharding.PRIMARY).bulk_create(
+            [User(email=user['email'], name=user['email'].split('@')[0], password=config['password_hash'])
+             for user in users],
+            batch_size=config['batch_size'],
+        )
+        counts['users'] = len(user_rows)
+        #The users' data goes to the shard the ring picks for each of them, like for a user signing up
+        shards = sharding.place_users(user_rows)
+        for shard in sorted(set(shards)):
+            on_shard = [index for index, user_shard in enumerate(shards) if user_shard == shard]
+            with transaction.atomic(using=shard):
+                shard_counts = _seed_data(
+                    config, shard, [users[i] for i in on_shard], [user_rows[i] for i in on_shard],
+                )
+            for key, value in shard_counts.items():
+                counts[key] += value
+    return counts
+
+
+def _seed_chunk_args(args):
+    return seed_chunk(*args)
+
+
+def seed(config, users, workers=1, chunk_size=500, progress=None):
+    """Create users users from config on workers processes and return the total rows created"""
+    chunks = [(config, start, min(start + chunk_size, users)) for start in range(0, users, chunk_size)]
+    totals = {'users': 0, 'tags': 0, 'ingredients': 0, 'recipes': 0, 'links': 0}
+
+    def add(counts):
+        for key, value in counts.items():
+            totals[key] += value
+        if progress:
+            progress(totals)
+
+    if workers <= 1:
+        for chunk in chunks:
+            add(seed_chunk(*chunk))
+    else:
+        connections.close_all() #Idle for as long as the workers run
+        #spawn instead of fork, so no process inherits the parent's database connection. The workers set Django up
+        #before unpickling anything from this module, which imports the models
+        with multiprocessing.get_context('spawn').Pool(workers, initializer=django.setup) as pool:
+            for counts in pool.imap_unordered(_seed_chunk_args, chunks):
+                add(counts)
+
+    for shard in settings.SHARDING['SHARDS']:
+        with connections[shard].cursor() as cursor:
+            cursor.execute('ANALYZE core_user, core_recipe, core_tag, core_ingredient, core_recipe_tags, '
+                           'core_recipe_ingredients')
+    return totals
+
+
+def _delete_data(cursor, where, params):
+    """Delete the recipes, tags, ingredients, their links and tombstones of the users with user_id {where}"""
+    for through, column, table in [
+        ('core_recipe_tags', 'recipe_id', 'core_recipe'),
+        ('core_recipe_ingredients', 'recipe_id', 'core_recipe'),
+        ('core_recipe_tags', 'tag_id', 'core_tag'),
+        ('core_recipe_ingredients', 'ingredient_id', 'core_ingredient'),
+    ]:
+        cursor.execute(
+            f'DELETE FROM {through} WHERE {column} IN (SELECT id FROM {table} WHERE user_id {where})', params,
+        )
+    #The tombstones last, the triggers add some for the recipes, tags and ingredients deleted
+    for table in ['core_recipe', 'core_tag', 'core_ingredient', 'core_tombstone']:
+        cursor.execute(f'DELETE FROM {table} WHERE user_id {where}', params)
+
+
+def delete_users(users):
+    """Delete a queryset of users and everything they own in SQL, without loading their rows or sending signals"""
+    Token.objects.filter(user__in=users).delete() #Through the ORM, so the token cache forgets them
+    on_shards = {}
+    for user_id, shard in ShardPlacement.objects.filter(user__in=users).values_list('user_id', 'shard'):
+        on_shards.setdefault(shard, []).append(user_id)
+        sharding.placement_cache.delete(user_id)
+    for shard, shard_user_ids in on_shards.items():
+        if shard != sharding.PRIMARY:
+            with connections[shard].cursor() as cursor:
+                _delete_data(cursor, '= ANY(%s)', [shard_user_ids])
+                cursor.execute('DELETE FROM core_user WHERE id = ANY(%s)', [shard_user_ids])
+
+    user_ids, params = users.values('id').query.sql_with_params()
+    with connection.cursor() as cursor:
+        _delete_data(cursor, f'IN ({user_ids})', params)
+        for table in ['core_shardplacement', 'core_user_groups', 'core_user_user_permissions', 'django_admin_log']:
+            cursor.execute(f'DELETE FROM {table} WHERE user_id IN ({user_ids})', params)
+        cursor.execute(f'DELETE FROM core_user WHERE id IN ({user_ids})', params)
+        return cursor.rowcount
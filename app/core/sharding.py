@@ -0,0 +1,299 @@
+"""
+Sharding of the user-owned data (recipes, tags, ingredients, their links and tombstones) by user across the databases
+in SHARDING['SHARDS']. New users go to the shard a consistent hash of their id picks, ShardPlacement records where
+every user placed off the primary lives, and the rebalance_shards command moves users to the shard the ring picks now
+"""
+import bisect
+import contextvars
+import copy
+import hashlib
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connections, transaction
+from django.db.models.signals import post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from core.models import (
+    Recipe,
+    Tag,
+    Ingredient,
+    ShardPlacement,
+    Tombstone,
+)
+from user.authentication import LRUCache
+
+PRIMARY = 'default'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+#The models whose rows live on their user's shard, in the order their rows can be inserted
+SHARDED_MODELS = [Tag, Ingredient, Recipe, Recipe.tags.through, Recipe.ingredients.through, Tombstone]
+SHARDED_LABELS = {model._meta.label for model in SHARDED_MODELS}
+
+#The shard the current request's user lives on, None outside of a request
+_current_shard = contextvars.ContextVar('current_shard', default=None)
+
+Placement = namedtuple('Placement', ['shard', 'moving', 'moved_at'])
+PRIMARY_PLACEMENT = Placement(PRIMARY, False, None) #Users without a ShardPlacement, e.g. from before sharding
+
+_prepared = set() #The shards this process has run prepare_shard on
+
+placement_cache = LRUCache(max_size=10000, ttl=settings.SHARDING['PLACEMENT_TTL'])
+
+
+def is_enabled():
+    """Return whether there is more than 1 shard"""
+    return len(settings.SHARDING['SHARDS']) > 1
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring of the shards, adding a shard only moves the users it takes over to it"""
+
+    def __init__(self, shards, vnodes):
+        #Every shard is at vnodes points of the ring, so they get an even share of it
+        points = sorted((_hash(f'{shard}-{i}'), shard) for shard in shards for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def get(self, user_id):
+        """Return the shard of the first point of the ring after user_id's hash"""
+        index = bisect.bisect(self._hashes, _hash(user_id)) % len(self._hashes)
+        return self._shards[index]
+
+
+_ring = None
+
+
+def get_ring():
+    """Return the ring of SHARDING['SHARDS'], rebuilt when the setting changes"""
+    global _ring
+    key = (tuple(settings.SHARDING['SHARDS']), settings.SHARDING['VNODES'])
+    if _ring is None or _ring[0] != key:
+        _ring = (key, HashRing(*key))
+    return _ring[1]
+
+
+def get_placement(user_id):
+    """Return where a user's data lives now, cached for PLACEMENT_TTL seconds"""
+    if not is_enabled():
+        return PRIMARY_PLACEMENT
+    placement = placement_cache.get(user_id)
+    if placement is None:
+        row = ShardPlacement.objects.using(PRIMARY).filter(user_id=user_id).values_list(
+            'shard', 'moving', 'moved_at',
+        ).first()
+        placement = Placement(*row) if row else PRIMARY_PLACEMENT
+        placement_cache.set(user_id, placement)
+    return placement
+
+
+def db_for_user(user_id):
+    """Return the alias of the shard a user's data lives on"""
+    return get_placement(user_id).shard
+
+
+def current_db():
+    """Return the shard of the current request's user, or the primary outside of a request"""
+    return _current_shard.get() or PRIMARY
+
+
+def _user_id(instance):
+    if isinstance(instance, get_user_model()):
+        return instance.pk
+    return getattr(instance, 'user_id', None)
+
+
+class ShardRouter:
+    """Send the queries of the sharded models to the current request's shard, or the shard of the user in the hints"""
+
+    def _db(self, model, hints):
+        if not is_enabled() or model._meta.label not in SHARDED_LABELS:
+            return None #The other routers, then the primary
+        shard = _current_shard.get()
+        if shard:
+            return shard
+        user_id = _user_id(hints.get('instance'))
+        return db_for_user(user_id) if user_id else None
+
+    def db_for_read(self, model, **hints):
+        db = self._db(model, hints)
+        #The replicas in READ_REPLICAS are of the primary, so the reads of its users are left to the ReplicaRouter after
+        #this one. The other shards have no replicas, their reads go to the shard
+        return None if db == PRIMARY else db
+
+    def db_for_write(self, model, **hints):
+        return self._db(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if type(obj1)._meta.label in SHARDED_LABELS or type(obj2)._meta.label in SHARDED_LABELS:
+            return True #A user is on the primary, their recipes on a shard that has a copy of their row
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.SHARDING['SHARDS']:
+            return True #Every shard has the whole schema, the user table for the foreign keys of the copied users
+        return None
+
+
+class ShardMoving(APIException):
+    """The user is being moved to another shard, their data can't be changed until that's done"""
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = _('Your data is being moved, try again in a few seconds.')
+    default_code = 'shard_moving'
+    wait = 5 #DRF sends it as Retry-After
+
+
+class ShardRoutingMixin:
+    """Route a viewset's queries on the sharded models to the shard of the request's user"""
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs) #Authenticates, so the user is known from here on
+        if not is_enabled() or not request.user.is_authenticated:
+            return
+        placement = get_placement(request.user.pk)
+        if placement.moving and request.method not in SAFE_METHODS:
+            raise ShardMoving()
+        self._shard_token = _current_shard.set(placement.shard)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, '_shard_token', None)
+        if token is not None:
+            _current_shard.reset(token)
+            self._shard_token = None
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+def copy_user(user, shard):
+    """Copy a user's row to a shard, for the foreign keys of their data there"""
+    if shard != PRIMARY:
+        clone = copy.copy(user)
+        clone._state = copy.copy(user._state) #bulk_create sets the state's db, which has to stay the primary on user
+        get_user_model().objects.using(shard).bulk_create([clone], ignore_conflicts=True)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def place_new_user(sender, instance, created, using, **kwargs):
+    """Place a new user on the shard the ring picks for them"""
+    if not created or using != PRIMARY or not is_enabled():
+        return
+    shard = get_ring().get(instance.pk)
+    if shard != PRIMARY:
+        if shard not in _prepared: #Before the first row this process writes there
+            prepare_shard(shard)
+            _prepared.add(shard)
+        copy_user(instance, shard)
+        ShardPlacement.objects.using(PRIMARY).create(user=instance, shard=shard)
+        placement_cache.delete(instance.pk)
+
+
+def place_users(users):
+    """Place new users bulk_create sent no post_save for like place_new_user does, and return their shards"""
+    shards = [get_ring().get(user.pk) if is_enabled() else PRIMARY for user in users]
+    for shard in set(shards) - {PRIMARY}:
+        if shard not in _prepared:
+            prepare_shard(shard)
+            _prepared.add(shard)
+        clones = []
+        for user, user_shard in zip(users, shards):
+            if user_shard == shard:
+                clone = copy.copy(user)
+                clone._state = copy.copy(user._state) #See copy_user
+                clones.append(clone)
+        get_user_model().objects.using(shard).bulk_create(clones, ignore_conflicts=True)
+    ShardPlacement.objects.using(PRIMARY).bulk_create([
+        ShardPlacement(user=user, shard=shard) for user, shard in zip(users, shards) if shard != PRIMARY
+    ])
+    return shards
+
+
+@receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
+def delete_sharded_user(sender, instance, using, **kwargs):
+    """Delete the data of a user on another shard, the cascade only deletes what's on the primary"""
+    shard = get_placement(instance.pk).shard if using == PRIMARY else PRIMARY
+    if shard != PRIMARY:
+        delete_user_data(instance.pk, shard)
+        placement_cache.delete(instance.pk)
+
+
+def prepare_shard(shard):
+    """Start the ids of the sharded tables of a shard at its own block, so rows can be moved between shards"""
+    #Shard n (the position in SHARDS) hands out ids from n * ID_BLOCK, a moved row keeps its id. The primary is 0
+    start = settings.SHARDING['SHARDS'].index(shard) * settings.SHARDING['ID_BLOCK']
+    if not start:
+        return
+    with connections[shard].cursor() as cursor:
+        for model in SHARDED_MODELS:
+            cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [model._meta.db_table, 'id'])
+            sequence = cursor.fetchone()[0]
+            cursor.execute(f'SELECT last_value FROM {sequence}')
+            if cursor.fetchone()[0] < start:
+                cursor.execute('SELECT setval(%s, %s, false)', [sequence, start])
+
+
+def delete_user_data(user_id, shard):
+    """Delete a user's data from a shard in SQL, and their copied row if it isn't the primary"""
+    with connections[shard].cursor() as cursor:
+        for through, column, table in [
+            ('core_recipe_tags', 'recipe_id', 'core_recipe'),
+            ('core_recipe_ingredients', 'recipe_id', 'core_recipe'),
+            ('core_recipe_tags', 'tag_id', 'core_tag'),
+            ('core_recipe_ingredients', 'ingredient_id', 'core_ingredient'),
+        ]:
+            cursor.execute(
+                f'DELETE FROM {through} WHERE {column} IN (SELECT id FROM {table} WHERE user_id = %s)', [user_id],
+            )
+        #The tombstones last, the triggers add some for the rows deleted. Sync tokens from before the move get a full
+        #sync, so they aren't needed on either shard
+        for table in ['core_recipe', 'core_tag', 'core_ingredient', 'core_tombstone']:
+            cursor.execute(f'DELETE FROM {table} WHERE user_id = %s', [user_id])
+        if shard != PRIMARY:
+            cursor.execute('DELETE FROM core_user WHERE id = %s', [user_id])
+
+
+def copy_user_data(user, source, target):
+    """Copy a user's row and data from the source shard to the target shard in 1 transaction, return the rows copied"""
+    copied = 0
+    with transaction.atomic(using=target):
+        copy_user(user, target)
+        for model in SHARDED_MODELS[:-1]: #Not the tombstones, see delete_user_data
+            field = 'recipe__user' if model in (Recipe.tags.through, Recipe.ingredients.through) else 'user'
+            rows = list(model.objects.using(source).filter(**{field: user.pk}).order_by('pk'))
+            model.objects.using(target).bulk_create(rows, batch_size=2000)
+            copied += len(rows)
+    return copied
+
+
+def set_placement(user, shard, moving, moved_at=None):
+    """Record where a user lives and whether they're moving"""
+    ShardPlacement.objects.using(PRIMARY).update_or_create(
+        user=user, defaults={'shard': shard, 'moving': moving, 'moved_at': moved_at},
+    )
+    placement_cache.delete(user.pk)
+
+
+def planned_moves(limit=None):
+    """Return [(user, from shard, to shard)] of the users not on the shard the ring picks for them"""
+    ring = get_ring()
+    placements = dict(ShardPlacement.objects.using(PRIMARY).values_list('user_id', 'shard'))
+    moves = []
+    for user in get_user_model().objects.using(PRIMARY).order_by('pk').iterator():
+        source, target = placements.get(user.pk, PRIMARY), ring.get(user.pk)
+        if source != target:
+            moves.append((user, source, target))
+            if limit and len(moves) >= limit:
+                break
+    return moves
+
+
+def finish_move(user, target):
+    """Point a user at the shard their data was copied to"""
+    set_placement(user, target, moving=False, moved_at=timezone.now())
@@ -0,0 +1,139 @@
+"""Tests for the async read views served over ASGI"""
+
+import threading
+from urllib.parse import urlencode
+from unittest.mock import patch
+
+from asgiref.sync import sync_to_async
+
+from django.contrib.auth import get_user_model
+from django.test import (
+    AsyncClient,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.urls import resolve, reverse
+
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from core.models import (
+    Tag,
+    Ingredient,
+)
+from recipe.views import RecipeViewSet
+from recipe.tests.test_recipe_api import create_recipe, detail_url
+from user.authentication import local_cache
+
+RECIPES_URL = reverse('recipe:recipe-list')
+TAGS_URL = reverse('recipe:tag-list')
+INGREDIENTS_URL = reverse('recipe:ingredient-list')
+ME_URL = reverse('user:me')
+
+
+@override_settings(ROOT_URLCONF='app.asgi_urls', ASYNC_DB_THREADS=0) #0 keeps the queries inside the test transaction
+class AsyncReadViewTests(TestCase):
+    """Test the async views return exactly what the sync views return"""
+
+    def setUp(self):
+        local_cache.clear()
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123', name='Test Name')
+        self.token = Token.objects.create(user=self.user)
+        recipe = create_recipe(self.user, title='Soup')
+        recipe.tags.add(Tag.objects.create(user=self.user, name='Dinner'))
+        recipe.ingredients.add(Ingredient.objects.create(user=self.user, name='Salt'))
+        create_recipe(self.user, title='Salad')
+        self.recipe = recipe
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.async_client = AsyncClient()
+
+    async def assertSameResponse(self, url, params=None):
+        """Request url with both clients and compare the status and body"""
+        if params:
+            url = f'{url}?{urlencode(params)}' #Django 3.2's AsyncClient.get() ignores its data argument
+        expected = await sync_to_async(self.client.get)(url)
+        res = await self.async_client.get(url, authorization=f'Token {self.token.key}')
+
+        self.assertEqual(res.status_code, expected.status_code)
+        self.assertEqual(res.content, expected.content)
+
+    async def test_recipe_list(self):
+        """Test the recipe list, with and without filters"""
+        await self.assertSameResponse(RECIPES_URL)
+        await self.assertSameResponse(RECIPES_URL, {'page_size': 1})
+        await self.assertSameResponse(RECIPES_URL, {'q': 'soup'})
+
+    async def test_recipe_detail(self):
+        """Test the recipe detail and a missing recipe"""
+        await self.assertSameResponse(detail_url(self.recipe.id))
+        await self.assertSameResponse(detail_url(0))
+
+    async def test_tags_ingredients_and_me(self):
+        """Test the tag, ingredient and user reads"""
+        await self.assertSameResponse(TAGS_URL, {'recipe_count': 1})
+        await self.assertSameResponse(INGREDIENTS_URL)
+        await self.assertSameResponse(ME_URL)
+
+    async def test_auth_required(self):
+        """Test requests without a valid token are rejected like the sync API does"""
+        res = await self.async_client.get(RECIPES_URL)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        res = await self.async_client.get(RECIPES_URL, authorization='Token invalid')
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_writes_use_the_sync_views(self):
+        """Test writes to an async route still work"""
+        res = await self.async_client.patch(
+            detail_url(self.recipe.id),
+            {'title': 'Tomato soup'},
+            content_type='application/json',
+            authorization=f'Token {self.token.key}',
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.json()['title'], 'Tomato soup')
+
+    def test_recipe_actions_not_taken_for_a_detail(self):
+        """Test recipes/import/ and recipes/export/ go to the router's actions, not the async recipe detail"""
+        #Django 3.2's AsyncClient can't give a view a request.stream to read an import from, so the import is only resolved
+        self.assertEqual(resolve(reverse('recipe:recipe-bulk-import')).url_name, 'recipe-bulk-import')
+        self.assertEqual(resolve(reverse('recipe:recipe-export')).url_name, 'recipe-export')
+        self.assertEqual(resolve(detail_url(self.recipe.id)).url_name, 'async-recipe-detail')
+
+
+@override_settings(ROOT_URLCONF='app.asgi_urls', ASYNC_DB_THREADS=2)
+class AsyncReadThreadPoolTests(TransactionTestCase):
+    """Test the async views run their database work on the thread pool"""
+
+    def setUp(self):
+        local_cache.clear()
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        self.token = Token.objects.create(user=self.user)
+        create_recipe(self.user)
+
+    async def test_list_runs_on_pool_thread(self):
+        """Test the recipe list is built on an async-db thread"""
+        threads = []
+        list_view = RecipeViewSet.list
+
+        def list_spy(view, request, *args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return list_view(view, request, *args, **kwargs)
+
+        with patch.object(RecipeViewSet, 'list', list_spy):
+            res = await AsyncClient().get(RECIPES_URL, authorization=f'Token {self.token.key}')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(res.json()['results']), 1)
+        self.assertTrue(threads[0].startswith('async-db'))
+
+    async def test_export_streams_off_the_event_loop(self):
+        """Test the export, whose lines Django 3.2 reads on the event loop, queries on a thread of its own"""
+        res = await AsyncClient().get(reverse('recipe:recipe-export'), authorization=f'Token {self.token.key}')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(b''.join(res.streaming_content).splitlines()), 1)
@@ -2,14 +2,28 @@
 Test custom Django management commands
 """
 
+import json
+import tempfile
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
 #We'll patch in order to mock behaviour of DB, we need to simulate when DB is returning a response
 from unittest.mock import patch
 #OperationalError is one of the possible erros that we might get when trying to connect to the DB before DB is ready
 from psycopg2 import OperationalError as Psycopg2Error
 
+from django.contrib.auth import get_user_model
 from django.core.management import call_command #Helper function provided by Django allowing us to call command by name, the one we testing
 from django.db.utils import OperationalError #Another exception that may get thrown by the DB, depending on stage of startup process it is in
-from django.test import SimpleTestCase #SimpleTestCase, because we testing whether DB ready or not, so no migrations to test DB is needed
+from django.core.management.base import CommandError
+from django.test import TestCase, SimpleTestCase, TransactionTestCase #SimpleTestCase, because we testing whether DB ready or not, so no migrations to test DB is needed
+
+from core import partitioning
+from core.models import (
+    Recipe,
+    Tag,
+    Ingredient,
+)
 
 @patch('core.management.commands.wait_for_db.Command.check')#This is the command we're going to be mocking
 # Command.check - is provided by the BaseCommand class which allows us to check the status of the DB. We will be mocking the
@@ -45,4 +59,157 @@ class CommandTests(SimpleTestCase):
         call_command('wait_for_db')
 
         self.assertEqual(patched_check.call_count, 6)
-        patched_check.assert_called_with(databases=['default'])
\ No newline at end of file
+        patched_check.assert_called_with(databases=['default'])
+
+class ExplainQueriesCommandTests(TestCase):
+    """Test the explain_queries command"""
+
+    def test_explain_queries_reports_each_endpoint(self):
+        """Test the command explains the query of every endpoint"""
+        user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        recipe = Recipe.objects.create(user=user, title='Soup', time_minutes=5, price=Decimal('1.00'))
+        recipe.tags.add(Tag.objects.create(user=user, name='Dinner'))
+        recipe.ingredients.add(Ingredient.objects.create(user=user, name='Salt'))
+        out = StringIO()
+
+        call_command('explain_queries', email=user.email, stdout=out)
+
+        output = out.getvalue()
+        for name in ['recipe:recipe-list', 'recipe:tag-list', 'recipe:ingredient-list',
+                     'recipes with tag', 'recipes with ingredient']:
+            self.assertIn(name, output)
+
+    def test_explain_queries_without_user_error(self):
+        """Test the command fails when there is no user to explain queries for"""
+        with self.assertRaises(CommandError):
+            call_command('explain_queries', email='missing@example.com', stdout=StringIO())
+
+
+#The requests run on the command's own threads, so the data it seeds has to be committed
+class BenchmarkAPICommandTests(TransactionTestCase):
+    """Test the benchmark_api command"""
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.output = Path(temp_dir.name) / 'results.json'
+
+    def run_benchmark(self, *args):
+        out = StringIO()
+        call_command(
+            'benchmark_api', '--recipes', '5', '--requests', '2', '--concurrency', '2', *args, stdout=out,
+        )
+        return out.getvalue()
+
+    def test_benchmark_every_endpoint(self):
+        """Test every endpoint is loaded without errors, the results are saved and the seed data removed"""
+        self.run_benchmark('--output', str(self.output))
+
+        results = json.loads(self.output.read_text())['results']['5']
+        for name in ['recipe:recipe-list', 'recipe:recipe-detail DELETE', 'recipe:sync?since', 'user:token']:
+            self.assertIn(name, results)
+        self.assertEqual([name for name, stats in results.items() if stats['errors']], [])
+        self.assertEqual(results['recipe:recipe-detail']['queries'], 3)
+        self.assertEqual(results['recipe:recipe-detail?fields']['queries'], 1) #No tags/ingredients prefetch
+        self.assertLess(results['recipe:recipe-list?fields']['bytes'], results['recipe:recipe-list']['bytes'])
+        self.assertFalse(get_user_model().objects.exists())
+        self.assertFalse(Recipe.objects.exists())
+
+    def test_regression_against_baseline(self):
+        """Test an endpoint slower than the baseline fails the run with --fail-on-regression"""
+        self.run_benchmark('--scenarios', 'user:me', '--output', str(self.output))
+        baseline = json.loads(self.output.read_text())
+        baseline['results']['5']['user:me']['p95_ms'] = 0.0001
+        self.output.write_text(json.dumps(baseline))
+
+        with self.assertRaises(CommandError):
+            self.run_benchmark('--scenarios', 'user:me', '--baseline', str(self.output), '--fail-on-regression')
+
+
+#VACUUM can't run in the transaction of a TestCase
+class BenchmarkPartitioningCommandTests(TransactionTestCase):
+    """Test the benchmark_partitioning command"""
+
+    def test_benchmark_plain_and_partitioned(self):
+        """Test the queries and VACUUM are timed on both tables, and the plain tables are put back"""
+        call_command(
+            'seed_data', '--users', '3', '--workers', '1', '--recipes-per-user', '4', '--tags-per-user', '3',
+            '--ingredients-per-user', '3', stdout=StringIO(),
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output = Path(temp_dir) / 'results.json'
+            call_command(
+                'benchmark_partitioning', '--partitions', '2', '--users', '2', '--repeat', '1', '--churn-users', '1',
+                '--output', str(output), stdout=StringIO(),
+            )
+            results = json.loads(output.read_text())
+
+        self.assertEqual(results['partitioned']['queries']['recipe:recipe-list']['partitions'], 1)
+        self.assertEqual(results['plain']['dead_rows'], results['partitioned']['dead_rows'])
+        self.assertGreater(results['plain']['dead_rows'], 0)
+        self.assertFalse(any(partitioning.partition_counts().values()))
+        self.assertEqual(Recipe.objects.count(), 12)
+
+
+class SeedDataCommandTests(TestCase):
+    """Test the seed_data command"""
+
+    def seed(self, *args):
+        call_command(
+            'seed_data', '--users', '3', '--workers', '1', '--chunk-size', '2', '--recipes-per-user', '4',
+            '--tags-per-user', 'uniform:2:5', '--ingredients-per-user', '6', '--tag-names', '10', *args,
+            stdout=StringIO(),
+        )
+
+    def test_seed_data(self):
+        """Test the users are created with their recipes linked to their own tags and ingredients"""
+        self.seed()
+
+        users = get_user_model().objects.filter(email__startswith='seed-')
+        self.assertEqual(users.count(), 3)
+        self.assertTrue(users.first().check_password('seedpass123'))
+        self.assertEqual(Recipe.objects.count(), 12)
+        self.assertEqual(Ingredient.objects.count(), 18)
+        for recipe in Recipe.objects.prefetch_related('tags', 'ingredients'):
+            self.assertTrue(all(tag.user_id == recipe.user_id for tag in recipe.tags.all()))
+            self.assertTrue(all(ingredient.user_id == recipe.user_id for ingredient in recipe.ingredients.all()))
+            self.assertIsNotNone(recipe.search_vector)
+
+    def test_same_seed_same_data(self):
+        """Test a seed creates the same data however the users are split up, and another seed different data"""
+        self.seed('--seed', '7')
+        self.seed('--seed', '7', '--email-prefix', 'again-', '--chunk-size', '1')
+        self.seed('--seed', '8', '--email-prefix', 'other-')
+
+        def data(prefix):
+            return sorted(
+                (email.replace(prefix, ''), title, tag)
+                for email, title, tag in Recipe.objects.filter(user__email__startswith=prefix)
+                .values_list('user__email', 'title', 'tags__name')
+            )
+
+        self.assertEqual(data('seed-'), data('again-'))
+        self.assertNotEqual(data('seed-'), data('other-'))
+
+    def test_existing_users(self):
+        """Test seeding again fails unless the earlier users are cleared"""
+        self.seed()
+
+        with self.assertRaises(CommandError):
+            self.seed()
+        self.seed('--clear', '--recipes-per-user', '1')
+
+        self.assertEqual(get_user_model().objects.count(), 3)
+        self.assertEqual(Recipe.objects.count(), 3)
+
+    def test_invalid_distribution(self):
+        """Test a distribution that can't be parsed is an error"""
+        with self.assertRaises(CommandError):
+            self.seed('--tags-per-recipe', 'normal:3')
+
+    def test_zipf_popularity(self):
+        """Test the most popular tag names are picked by more users"""
+        self.seed('--users', '40', '--zipf', '1.5')
+
+        counts = {name: Tag.objects.filter(name=name).count() for name in ['Dinner', 'Dessert']}
+        self.assertGreater(counts['Dinner'], counts['Dessert'])
@@ -0,0 +1,206 @@
+"""Tests for the read replica routing"""
+
+import threading
+import time
+from decimal import Decimal
+from unittest.mock import patch
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import connections
+from django.test import AsyncClient, SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from core import db_routing
+from core.models import Recipe, Tag
+
+RECIPES_URL = reverse('recipe:recipe-list')
+TAGS_URL = reverse('recipe:tag-list')
+SYNC_URL = reverse('recipe:sync')
+REPLICAS = ['replica1', 'replica2']
+RECIPE_PAYLOAD = {'title': 'Curry', 'time_minutes': 30, 'price': '5.00', 'tags': [{'name': 'Dinner'}]}
+
+
+def replica_settings(**overrides):
+    #Lags only measured when a test does, with pool.refresh()
+    return override_settings(READ_REPLICAS={
+        **settings.READ_REPLICAS, 'ALIASES': REPLICAS, 'LAG_CHECK_INTERVAL': 60, **overrides,
+    })
+
+
+def wait_for_lag_thread():
+    for thread in threading.enumerate():
+        if thread.name == 'replica-lag':
+            thread.join()
+
+
+#Stand-ins for 2 replicas: their own connections to the test database, like the MIRROR of the replicas in settings.
+#The test data has to be committed for those connections to see it
+@replica_settings()
+@override_settings(RESPONSE_CACHE={'CACHE': 'default', 'TTL': 0, 'SINGLE_PROCESS': True}) #Every request queries
+class ReplicaRoutingTests(TransactionTestCase):
+    """Test which database the requests read from"""
+
+    def setUp(self):
+        for alias in REPLICAS:
+            connections.databases[alias] = dict(connections.databases['default'])
+            self.addCleanup(self.remove_alias, alias)
+        db_routing.pool.reset()
+        db_routing.pool.refresh()
+        caches['default'].clear()
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        self.token = Token.objects.create(user=self.user)
+        Recipe.objects.create(user=self.user, title='Soup', time_minutes=5, price=Decimal('1.00'))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def remove_alias(self, alias):
+        connections[alias].close()
+        del connections[alias]
+        del connections.databases[alias]
+
+    def get_queries(self, method, url, data=None):
+        """Return {alias: SQL of the queries} of a request"""
+        contexts = {alias: CaptureQueriesContext(connections[alias]) for alias in ['default', *REPLICAS]}
+        for context in contexts.values():
+            context.__enter__()
+        try:
+            res = getattr(self.client, method)(url, data, format='json')
+        finally:
+            for context in contexts.values():
+                context.__exit__(None, None, None)
+        self.assertLess(res.status_code, 400)
+        return {
+            alias: [query['sql'] for query in context.captured_queries if 'pg_is_in_recovery' not in query['sql']]
+            for alias, context in contexts.items()
+        }
+
+    def test_reads_from_replica(self):
+        """Test a list is read from a replica, and only the token from the primary"""
+        queries = self.get_queries('get', RECIPES_URL)
+
+        self.assertTrue(queries['replica1'] or queries['replica2'])
+        self.assertTrue(all('authtoken_token' in sql for sql in queries['default']))
+
+    def test_round_robin(self):
+        """Test the requests take turns on the replicas"""
+        first = self.get_queries('get', RECIPES_URL)
+        second = self.get_queries('get', RECIPES_URL)
+
+        self.assertEqual({bool(first['replica1']), bool(second['replica1'])}, {True, False})
+        self.assertEqual({bool(first['replica2']), bool(second['replica2'])}, {True, False})
+
+    @replica_settings(SELECTION='least_lag')
+    def test_least_lag(self):
+        """Test least_lag picks the replica the least behind"""
+        with patch('core.db_routing.measure_lag', side_effect=lambda alias: {'replica1': 0.5, 'replica2': 0.1}[alias]):
+            db_routing.pool.refresh()
+            queries = [self.get_queries('get', RECIPES_URL) for _ in range(2)]
+
+        self.assertTrue(all(query['replica2'] and not query['replica1'] for query in queries))
+
+    def test_lagging_or_down_replicas_skipped(self):
+        """Test replicas more than MAX_LAG behind or unreachable aren't used, and with none left the primary is"""
+        with patch('core.db_routing.measure_lag', side_effect=lambda alias: {'replica1': None, 'replica2': 60}[alias]):
+            db_routing.pool.refresh()
+            queries = self.get_queries('get', RECIPES_URL)
+
+        self.assertEqual(queries['replica1'] + queries['replica2'], [])
+        self.assertTrue(any('core_recipe' in sql for sql in queries['default']))
+
+    def test_write_pins_client_to_primary(self):
+        """Test the client that wrote reads from the primary for STICKY_SECONDS, and other clients don't"""
+        self.get_queries('post', RECIPES_URL, RECIPE_PAYLOAD)
+
+        queries = self.get_queries('get', TAGS_URL)
+
+        self.assertEqual(queries['replica1'] + queries['replica2'], [])
+        other_user = get_user_model().objects.create_user('other@example.com', 'testpass123')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=other_user).key}')
+        queries = self.get_queries('get', TAGS_URL)
+        self.assertTrue(queries['replica1'] or queries['replica2'])
+
+    @replica_settings(STICKY_SECONDS=0)
+    def test_writes_on_primary(self):
+        """Test writes go to the primary"""
+        queries = self.get_queries('post', RECIPES_URL, RECIPE_PAYLOAD)
+
+        self.assertEqual(queries['replica1'] + queries['replica2'], [])
+        self.assertTrue(Tag.objects.using('default').filter(name='Dinner').exists())
+
+    def test_other_routes_on_primary(self):
+        """Test reads of routes that aren't in ROUTES, like the sync, stay on the primary"""
+        queries = self.get_queries('get', SYNC_URL)
+
+        self.assertEqual(queries['replica1'] + queries['replica2'], [])
+
+    @override_settings(RESPONSE_CACHE={'CACHE': 'default', 'TTL': 300, 'SINGLE_PROCESS': True})
+    def test_replica_reads_not_cached(self):
+        """Test a list read from a replica isn't cached or given the data version's ETag, one from the primary is"""
+        res = self.client.get(RECIPES_URL)
+        queries = self.get_queries('get', RECIPES_URL) #Not from the cache
+
+        self.assertNotIn('ETag', res)
+        self.assertTrue(queries['replica1'] or queries['replica2'])
+
+        with patch('core.db_routing.measure_lag', return_value=None): #No replica is usable
+            db_routing.pool.refresh()
+        res = self.client.get(RECIPES_URL)
+        queries = self.get_queries('get', RECIPES_URL)
+
+        self.assertIn('ETag', res)
+        self.assertFalse(any('core_recipe' in sql for sqls in queries.values() for sql in sqls)) #From the cache
+
+    def test_lag_measured_off_the_request(self):
+        """Test a request doesn't wait for the lags to be measured, it reads from the primary until they are"""
+        def slow_lag(alias):
+            time.sleep(0.5) #Like a replica that's down, until connect_timeout
+            return 0.0
+
+        db_routing.pool.reset()
+        with patch('core.db_routing.measure_lag', side_effect=slow_lag):
+            started = time.perf_counter()
+            queries = self.get_queries('get', RECIPES_URL)
+            self.assertLess(time.perf_counter() - started, 0.5)
+            wait_for_lag_thread()
+
+        self.assertEqual(queries['replica1'] + queries['replica2'], [])
+        queries = self.get_queries('get', RECIPES_URL)
+        self.assertTrue(queries['replica1'] or queries['replica2'])
+
+    @override_settings(ROOT_URLCONF='app.asgi_urls', ASYNC_DB_THREADS=0)
+    async def test_async_request(self):
+        """Test a request to an async view picks a replica without querying on the event loop"""
+        db_routing.pool.reset()
+        client = AsyncClient()
+
+        res = await client.get(TAGS_URL, authorization=f'Token {self.token.key}') #Starts the measurement
+        self.assertEqual(res.status_code, 200)
+        wait_for_lag_thread()
+        self.assertEqual(db_routing.pool.lags(), {'replica1': 0.0, 'replica2': 0.0})
+        res = await client.get(TAGS_URL, authorization=f'Token {self.token.key}')
+        self.assertEqual(res.status_code, 200)
+
+
+class ReplicaRouterTests(SimpleTestCase):
+    """Test the database router"""
+
+    def test_no_replica_reads_primary(self):
+        """Test reads outside a routed request go to the primary"""
+        router = db_routing.ReplicaRouter()
+
+        self.assertEqual(router.db_for_read(Recipe), 'default')
+        self.assertEqual(router.db_for_write(Recipe), 'default')
+        self.assertIsNone(db_routing.get_read_alias())
+
+    def test_migrate_only_primary(self):
+        """Test migrations only run on the primary"""
+        router = db_routing.ReplicaRouter()
+
+        self.assertTrue(router.allow_migrate('default', 'core'))
+        self.assertFalse(router.allow_migrate('replica1', 'core'))
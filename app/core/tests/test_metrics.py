@@ -0,0 +1,170 @@
+"""Tests for the Prometheus metrics"""
+
+import json
+import re
+import tempfile
+import os
+import threading
+import time
+from pathlib import Path
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework.test import APIClient
+
+from core import metrics, timing
+
+METRICS_URL = reverse('metrics')
+TAGS_URL = reverse('recipe:tag-list')
+METRICS_SETTINGS = {'DIR': None, 'FLUSH_INTERVAL': 5, 'ALLOWED_IPS': ['127.0.0.1'], 'TOKEN': None}
+
+
+def sample_value(text, name, **labels):
+    """Return the value of the sample called name with labels in a metrics page, or None"""
+    for line in text.splitlines():
+        match = re.fullmatch(r'(\w+)(?:\{(.*)\})? (\S+)', line)
+        if not match or match.group(1) != name:
+            continue
+        sample_labels = dict(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', match.group(2) or ''))
+        if sample_labels == {key: str(value) for key, value in labels.items()}:
+            return float(match.group(3))
+    return None
+
+
+@override_settings(
+    METRICS=METRICS_SETTINGS,
+    SERVER_TIMING={'SAMPLE_RATE': 1, 'HEADER': True, 'WINDOW': 60}, #For the queries per request
+)
+class MetricsTests(TestCase):
+    """Test the /metrics endpoint"""
+
+    def setUp(self):
+        timing.reset_route_stats()
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+
+    def get_metrics(self):
+        res = self.client.get(METRICS_URL)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Content-Type'], metrics.CONTENT_TYPE)
+        return res.content.decode()
+
+    def test_request_metrics(self):
+        """Test the requests are counted by route and status, with their latency and queries"""
+        self.client.get(TAGS_URL)
+        self.client.force_authenticate(self.user)
+        self.client.get(TAGS_URL)
+        self.client.get(TAGS_URL)
+
+        text = self.get_metrics()
+
+        route = {'method': 'GET', 'route': 'recipe:tag-list'}
+        self.assertEqual(sample_value(text, 'http_requests_total', **route, status=200), 2)
+        self.assertEqual(sample_value(text, 'http_requests_total', **route, status=401), 1)
+        self.assertEqual(sample_value(text, 'http_request_duration_seconds_count', **route), 3)
+        self.assertEqual(sample_value(text, 'http_request_duration_seconds_bucket', **route, le='+Inf'), 3)
+        self.assertEqual(sample_value(text, 'db_queries_per_request_count', **route), 3)
+        self.assertIsNotNone(sample_value(text, 'response_cache_hit_ratio'))
+        self.assertIsNotNone(sample_value(text, 'auth_token_cache_requests_total', result='miss'))
+        self.assertEqual(sample_value(text, 'metrics_processes'), 1)
+
+    def test_requests_from_other_threads(self):
+        """Test the requests recorded by other threads are included, also once they've ended"""
+        thread = threading.Thread(target=timing.observe, args=('GET', 'recipe:tag-list', 3.0, 200, 10))
+        thread.start()
+        thread.join()
+
+        for _ in range(2): #The 2nd time the ended thread has been folded into the totals
+            stats = timing.get_route_stats()
+            self.assertEqual(stats['GET recipe:tag-list']['count'], 1)
+
+    def test_only_get(self):
+        """Test the metrics can't be posted to"""
+        res = self.client.post(METRICS_URL)
+
+        self.assertEqual(res.status_code, 405)
+
+    @override_settings(METRICS={**METRICS_SETTINGS, 'ALLOWED_IPS': ['10.0.0.0/8']})
+    def test_other_addresses_refused(self):
+        """Test the metrics are a 404 for addresses outside ALLOWED_IPS"""
+        self.assertEqual(self.client.get(METRICS_URL, REMOTE_ADDR='10.1.2.3').status_code, 200)
+        self.assertEqual(self.client.get(METRICS_URL, REMOTE_ADDR='203.0.113.5').status_code, 404)
+        self.assertEqual(self.client.get(METRICS_URL).status_code, 404) #127.0.0.1
+
+    @override_settings(METRICS={**METRICS_SETTINGS, 'ALLOWED_IPS': [], 'TOKEN': 'scrape-secret'})
+    def test_bearer_token(self):
+        """Test the metrics can be read from any address with the token"""
+        self.assertEqual(self.client.get(METRICS_URL).status_code, 404)
+        res = self.client.get(METRICS_URL, HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(res.status_code, 404)
+
+        res = self.client.get(METRICS_URL, HTTP_AUTHORIZATION='Bearer scrape-secret', REMOTE_ADDR='203.0.113.5')
+
+        self.assertEqual(res.status_code, 200)
+
+    def test_label_escaping(self):
+        """Test label values are escaped"""
+        timing.observe('GET', 'odd"name\\', 1.0, 200, 0)
+
+        text = metrics.render([metrics.process_snapshot()])
+
+        self.assertIn('route="odd\\"name\\\\"', text)
+
+
+class MultiProcessMetricsTests(TestCase):
+    """Test the metrics of several processes are added up"""
+
+    def setUp(self):
+        timing.reset_route_stats()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = Path(temp_dir.name)
+        settings_override = override_settings(METRICS={**METRICS_SETTINGS, 'DIR': temp_dir.name})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_processes_added_up(self):
+        """Test the snapshots written by other processes are added to this one's"""
+        timing.observe('GET', 'recipe:tag-list', 3.0, 200, 10)
+        other = metrics.process_snapshot() #As if it came from another process
+        other['auth_cache']['misses'] += 5
+        (self.dir / 'other-process.json').write_text(json.dumps(other))
+
+        text = metrics.render(metrics.read_snapshots())
+
+        route = {'method': 'GET', 'route': 'recipe:tag-list'}
+        self.assertEqual(sample_value(text, 'http_requests_total', **route, status=200), 2)
+        self.assertEqual(sample_value(text, 'http_response_size_bytes_total', **route), 20)
+        self.assertEqual(sample_value(text, 'metrics_processes'), 2)
+        self.assertGreaterEqual(sample_value(text, 'auth_token_cache_requests_total', result='miss'), 5)
+        self.assertEqual(len(list(self.dir.glob('*.json'))), 2) #This process wrote its own snapshot
+
+    def test_stale_snapshots_removed(self):
+        """Test the snapshot of a process that stopped writing it is removed instead of added up"""
+        stale = self.dir / 'exited-process.json'
+        stale.write_text(json.dumps(metrics.process_snapshot()))
+        written = time.time() - metrics.STALE_INTERVALS * 5 - 1
+        os.utime(stale, (written, written))
+
+        text = metrics.render(metrics.read_snapshots())
+
+        self.assertEqual(sample_value(text, 'metrics_processes'), 1)
+        self.assertFalse(stale.exists())
+
+    def test_forked_process(self):
+        """Test a process forked after the metrics were loaded writes a file of its own, from a flusher of its own"""
+        self.addCleanup(setattr, metrics, '_flusher_pid', metrics._flusher_pid)
+        metrics._flusher_pid = None
+        with patch('core.metrics.threading.Thread') as thread:
+            metrics.start_flusher()
+            parent_id = metrics.process_id()
+            metrics.start_flusher()
+            with patch('core.metrics.os.getpid', return_value=os.getpid() + 1): #In the forked worker
+                child_id = metrics.process_id()
+                metrics.start_flusher()
+
+        self.assertNotEqual(child_id, parent_id)
+        self.assertEqual(thread.return_value.start.call_count, 2)
@@ -4,6 +4,7 @@ Tests for models
 
 from decimal import Decimal
 
+from django.db import IntegrityError
 from django.test import TestCase
 from django.contrib.auth import get_user_model #Will always get reference to our custom user model and thus recommended to use
 
@@ -94,4 +95,25 @@ class ModelTests(TestCase):
 
         self.assertEqual(str(ingredient), ingredient.name)
 
-        
\ No newline at end of file
+    def test_tag_name_unique_per_user(self):
+        """Test a user can't have 2 tags with the same name"""
+        user = create_user()
+        models.Tag.objects.create(user=user, name="Tag1")
+
+        with self.assertRaises(IntegrityError):
+            models.Tag.objects.create(user=user, name="Tag1")
+
+    def test_get_or_create_many(self):
+        """Test resolving names returns existing ingredients and creates missing ones"""
+        user = create_user()
+        other_user = create_user(email='other@example.com')
+        existing = models.Ingredient.objects.create(user=user, name='Salt')
+        models.Ingredient.objects.create(user=other_user, name='Pepper')
+
+        ids = models.Ingredient.objects.get_or_create_many(user, ['Salt', 'Pepper', 'Salt'])
+
+        self.assertEqual(list(ids), ['Salt', 'Pepper'])
+        self.assertEqual(ids['Salt'], existing.id)
+        pepper = models.Ingredient.objects.get(id=ids['Pepper'])
+        self.assertEqual(pepper.user, user)
+        self.assertEqual(models.Ingredient.objects.filter(user=user).count(), 2)
@@ -0,0 +1,111 @@
+"""Tests for the hash partitioning of the recipe tables"""
+
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework.test import APIClient
+
+from core import partitioning
+from core.models import Recipe
+from recipe.tests.test_recipe_api import detail_url
+
+RECIPES_URL = reverse('recipe:recipe-list')
+PAYLOAD = {
+    'title': 'Thai Curry', 'time_minutes': 30, 'price': '5.00',
+    'tags': [{'name': 'Dinner'}], 'ingredients': [{'name': 'Coconut'}],
+}
+
+
+def foreign_keys(table):
+    """Return the tables the foreign keys of table reference"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT confrelid::regclass::text FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'",
+            [table],
+        )
+        return sorted(row[0] for row in cursor.fetchall())
+
+
+def partition_scans(plan):
+    """Return the partitions of core_recipe a plan reads"""
+    return [word for word in plan.split() if word.startswith('core_recipe_p')]
+
+
+#The tables are rebuilt in the test's transaction, so the rollback at the end puts the plain ones back
+@override_settings(RESPONSE_CACHE={'CACHE': 'default', 'TTL': 0, 'SINGLE_PROCESS': True})
+class PartitioningTests(TestCase):
+    """Test converting the recipe tables to partitions and back"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.recipe = self.client.post(RECIPES_URL, PAYLOAD, format='json').data
+
+    def partition(self, *args):
+        call_command('partition_recipes', '--partitions', '4', *args, stdout=StringIO())
+
+    def test_partition_keeps_data(self):
+        """Test the rows and the columns the triggers set are the same in the partitions"""
+        before = list(Recipe.objects.values_list('id', 'search_vector', 'sync_xid', 'updated_at'))
+
+        self.partition()
+
+        self.assertEqual(
+            partitioning.partition_counts(),
+            {'core_recipe': 4, 'core_recipe_tags': 4, 'core_recipe_ingredients': 4},
+        )
+        self.assertEqual(list(Recipe.objects.values_list('id', 'search_vector', 'sync_xid', 'updated_at')), before)
+        self.assertEqual(foreign_keys('core_recipe_tags'), ['core_tag'])
+
+    def test_api_on_partitions(self):
+        """Test the recipe API works on the partitioned tables, and the triggers still run"""
+        self.partition()
+
+        res = self.client.post(RECIPES_URL, {**PAYLOAD, 'title': 'Green Soup'}, format='json')
+        self.assertEqual(res.status_code, 201)
+        self.assertGreater(res.data['id'], self.recipe['id']) #The sequence carried on
+        self.assertEqual(len(self.client.get(RECIPES_URL).data['results']), 2)
+        self.assertEqual(self.client.get(RECIPES_URL, {'q': 'soup'}).data['results'][0]['title'], 'Green Soup')
+        self.assertEqual(len(self.client.get(RECIPES_URL, {'q': 'coconut'}).data['results']), 2)
+        res = self.client.patch(detail_url(self.recipe['id']), {'tags': [{'name': 'Lunch'}]}, format='json')
+        self.assertEqual(res.status_code, 200)
+        res = self.client.get(RECIPES_URL, {'tags': res.data['tags'][0]['id']})
+        self.assertEqual([recipe['id'] for recipe in res.data['results']], [self.recipe['id']])
+        self.assertEqual(self.client.delete(detail_url(self.recipe['id'])).status_code, 204)
+        self.assertEqual(Recipe.tags.through.objects.filter(recipe_id=self.recipe['id']).count(), 0)
+
+    def test_queries_read_one_partition(self):
+        """Test the list of a user's recipes only reads the partition they're in"""
+        self.partition()
+
+        plan = Recipe.objects.filter(user=self.user).order_by('-id').explain()
+
+        self.assertEqual(len(set(partition_scans(plan))), 1)
+
+    def test_revert(self):
+        """Test --revert rebuilds plain tables with the foreign keys to the recipe table back"""
+        self.partition()
+
+        self.partition('--revert')
+
+        self.assertEqual(
+            partitioning.partition_counts(),
+            {'core_recipe': 0, 'core_recipe_tags': 0, 'core_recipe_ingredients': 0},
+        )
+        self.assertEqual(foreign_keys('core_recipe_tags'), ['core_recipe', 'core_tag'])
+        self.assertEqual(self.client.get(detail_url(self.recipe['id'])).data['tags'][0]['name'], 'Dinner')
+
+    def test_repartition(self):
+        """Test partitioned tables can be rebuilt with another number of partitions"""
+        self.partition()
+
+        call_command('partition_recipes', '--partitions', '8', stdout=StringIO())
+
+        self.assertEqual(set(partitioning.partition_counts().values()), {8})
+        self.assertEqual(len(self.client.get(RECIPES_URL).data['results']), 1)
@@ -0,0 +1,155 @@
+"""Tests for the recipe snapshots of tags and ingredients"""
+
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework.test import APIClient
+
+from core.models import Recipe, Tag
+from recipe.cache import get_version
+from recipe.tests.test_recipe_api import detail_url
+
+RECIPES_URL = reverse('recipe:recipe-list')
+PAYLOAD = {
+    'title': 'Thai Curry', 'time_minutes': 30, 'price': '5.00',
+    'tags': [{'name': 'Dinner'}, {'name': 'Thai'}], 'ingredients': [{'name': 'Coconut'}],
+}
+
+
+def tag_url(tag_id):
+    return reverse('recipe:tag-detail', args=[tag_id])
+
+
+def expected_snapshot(recipe):
+    """Return the snapshot of recipe built from its tags and ingredients"""
+    return {
+        'tags': [[tag.id, tag.name] for tag in recipe.tags.order_by('id')],
+        'ingredients': [[ingredient.id, ingredient.name] for ingredient in recipe.ingredients.order_by('id')],
+    }
+
+
+def update_without_trigger(sql, params):
+    """Run an UPDATE of core_recipe without the trigger, which would build the snapshot and search_vector again"""
+    with connection.cursor() as cursor:
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE') #ALTER TABLE fails while the foreign key checks are still pending
+        cursor.execute('ALTER TABLE core_recipe DISABLE TRIGGER core_recipe_search_vector_update')
+        cursor.execute(sql, params)
+        cursor.execute('ALTER TABLE core_recipe ENABLE TRIGGER core_recipe_search_vector_update')
+
+
+def set_snapshots(value, recipe_ids=None):
+    """Set the snapshot of recipe_ids, or every recipe"""
+    if recipe_ids is None:
+        update_without_trigger('UPDATE core_recipe SET snapshot = %s::jsonb', [value])
+    else:
+        update_without_trigger('UPDATE core_recipe SET snapshot = %s::jsonb WHERE id = ANY(%s)', [value, recipe_ids])
+
+
+@override_settings(RESPONSE_CACHE={'CACHE': 'default', 'TTL': 0, 'SINGLE_PROCESS': True})
+class RecipeSnapshotTests(TestCase):
+    """Test the trigger keeps the snapshots up to date and the list reads them"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.recipe = Recipe.objects.get(pk=self.client.post(RECIPES_URL, PAYLOAD, format='json').data['id'])
+
+    def assertSnapshotCurrent(self):
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.snapshot, expected_snapshot(self.recipe))
+
+    def test_create_and_update(self):
+        """Test the snapshot has the tags and ingredients after they're set and changed through the API"""
+        self.assertSnapshotCurrent()
+        self.assertEqual([name for _, name in self.recipe.snapshot['tags']], ['Dinner', 'Thai'])
+
+        self.client.patch(detail_url(self.recipe.id), {'tags': [{'name': 'Lunch'}], 'ingredients': []}, format='json')
+
+        self.assertSnapshotCurrent()
+        self.assertEqual(self.recipe.snapshot['ingredients'], [])
+
+    def test_tag_renamed_and_deleted(self):
+        """Test renaming or deleting a tag changes the snapshots of its recipes"""
+        dinner = Tag.objects.get(user=self.user, name='Dinner')
+
+        self.client.patch(tag_url(dinner.id), {'name': 'Supper'})
+        self.assertSnapshotCurrent()
+        self.assertEqual(self.recipe.snapshot['tags'][0], [dinner.id, 'Supper'])
+
+        self.client.delete(tag_url(dinner.id))
+        self.assertSnapshotCurrent()
+        self.assertEqual([name for _, name in self.recipe.snapshot['tags']], ['Thai'])
+
+    def test_stale_save_keeps_snapshot(self):
+        """Test saving a recipe loaded before its tags changed doesn't write back the old snapshot and search_vector"""
+        stale = Recipe.objects.get(pk=self.recipe.pk)
+        self.recipe.tags.set([Tag.objects.create(user=self.user, name='Breakfast')])
+
+        stale.time_minutes = 45
+        stale.save()
+
+        self.assertSnapshotCurrent()
+        self.assertEqual(list(Recipe.objects.filter(search_vector='breakfast')), [self.recipe])
+
+    def test_list_without_snapshots(self):
+        """Test the list reads the tags and ingredients of recipes without a snapshot from the through tables"""
+        expected = self.client.get(RECIPES_URL).json()
+        set_snapshots(None)
+
+        with self.assertNumQueries(3): #recipes, tags and ingredients
+            res = self.client.get(RECIPES_URL)
+
+        self.assertEqual(res.json(), expected)
+
+
+class CheckRecipeSnapshotsCommandTests(TestCase):
+    """Test the check_recipe_snapshots command"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        self.recipe = Recipe.objects.create(user=self.user, title='Soup', time_minutes=10, price='2.50')
+        self.recipe.tags.add(Tag.objects.create(user=self.user, name='Dinner'))
+        Recipe.objects.create(user=self.user, title='Salad', time_minutes=5, price='1.50')
+
+    def check_snapshots(self, *args):
+        out = StringIO()
+        call_command('check_recipe_snapshots', '--batch', '1', *args, stdout=out)
+        return out.getvalue()
+
+    def test_current_snapshots(self):
+        """Test nothing is reported when every snapshot is right"""
+        self.assertIn('Found 0 recipes.', self.check_snapshots())
+
+    def test_missing_and_wrong_snapshots(self):
+        """Test NULL and outdated snapshots are found, and only rebuilt with --repair"""
+        salad = Recipe.objects.get(title='Salad')
+        set_snapshots('{"tags": [[1, "Old"]], "ingredients": []}', [self.recipe.id])
+        set_snapshots(None, [salad.id])
+        version = get_version(self.user.pk)
+
+        self.assertIn('Found 2 recipes.', self.check_snapshots())
+        salad.refresh_from_db()
+        self.assertIsNone(salad.snapshot)
+
+        self.assertIn('Repaired 2 recipes.', self.check_snapshots('--repair'))
+
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.snapshot, expected_snapshot(self.recipe))
+        self.assertFalse(Recipe.objects.filter(snapshot__isnull=True).exists())
+        self.assertNotEqual(get_version(self.user.pk), version)
+        self.assertIn('Found 0 recipes.', self.check_snapshots())
+
+    def test_missing_search_vector(self):
+        """Test a recipe without a search_vector, like those from before migration 0009, is found and rebuilt"""
+        update_without_trigger('UPDATE core_recipe SET search_vector = NULL WHERE id = %s', [self.recipe.id])
+
+        self.assertIn('Found 1 recipes.', self.check_snapshots())
+        self.assertIn('Repaired 1 recipes.', self.check_snapshots('--repair'))
+
+        self.assertEqual(list(Recipe.objects.filter(search_vector='dinner')), [self.recipe])
@@ -0,0 +1,194 @@
+"""Tests for the sharding of the user-owned data"""
+
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connections, router
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from rest_framework.test import APIClient
+
+from core import db_routing, seeding, sharding
+from core.models import Recipe, ShardPlacement, Tag
+from recipe.tests.test_recipe_api import detail_url
+
+RECIPES_URL = reverse('recipe:recipe-list')
+TAGS_URL = reverse('recipe:tag-list')
+SYNC_URL = reverse('recipe:sync')
+SHARD = 'shard1'
+SHARDING = {**settings.SHARDING, 'SHARDS': ['default', SHARD], 'PLACEMENT_TTL': 0}
+
+
+class HashRingTests(SimpleTestCase):
+    """Test the consistent hash ring"""
+
+    def test_spread_and_stable(self):
+        """Test the users are spread over the shards, and adding 1 only moves users to it"""
+        ring = sharding.HashRing(['default', 'shard1', 'shard2'], 64)
+        bigger = sharding.HashRing(['default', 'shard1', 'shard2', 'shard3'], 64)
+
+        before = {user_id: ring.get(user_id) for user_id in range(3000)}
+        after = {user_id: bigger.get(user_id) for user_id in range(3000)}
+
+        for shard in ['default', 'shard1', 'shard2']:
+            self.assertGreater(list(before.values()).count(shard), 600)
+        moved = [user_id for user_id in before if before[user_id] != after[user_id]]
+        self.assertTrue(all(after[user_id] == 'shard3' for user_id in moved))
+        self.assertLess(len(moved), 1200)
+
+
+@override_settings(SHARDING=SHARDING)
+class ShardRouterTests(SimpleTestCase):
+    """Test the routing of the sharded models with the replica router after the shard router"""
+
+    def route(self, shard, replica):
+        """Return the (read, write) database of a recipe for a request on shard given replica to read from"""
+        shard_token = sharding._current_shard.set(shard)
+        replica_token = db_routing._read_alias.set(replica)
+        try:
+            return router.db_for_read(Recipe), router.db_for_write(Recipe)
+        finally:
+            db_routing._read_alias.reset(replica_token)
+            sharding._current_shard.reset(shard_token)
+
+    def test_primary_reads_from_replica(self):
+        """Test the reads of a user on the primary go to the request's replica, the writes to the primary"""
+        self.assertEqual(self.route('default', 'replica1'), ('replica1', 'default'))
+        self.assertEqual(self.route('default', None), ('default', 'default'))
+
+    def test_other_shard_not_replicated(self):
+        """Test the reads and writes of a user on another shard go to the shard, which has no replicas"""
+        self.assertEqual(self.route(SHARD, 'replica1'), (SHARD, SHARD))
+
+
+#The shard is a schema of its own in the test database, with its own connection, so it has its own tables like a
+#separate database would
+@override_settings(SHARDING=SHARDING, RESPONSE_CACHE={'CACHE': 'default', 'TTL': 0, 'SINGLE_PROCESS': True})
+class ShardingTests(TransactionTestCase):
+    """Test the data of users on another shard"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with connections['default'].cursor() as cursor:
+            cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {SHARD}')
+        connections.databases[SHARD] = {
+            **connections.databases['default'],
+            'OPTIONS': {'options': f'-c search_path={SHARD}'},
+        }
+        call_command('migrate', database=SHARD, verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections[SHARD].close()
+        del connections[SHARD]
+        del connections.databases[SHARD]
+        with connections['default'].cursor() as cursor:
+            cursor.execute(f'DROP SCHEMA {SHARD} CASCADE')
+        super().tearDownClass()
+
+    def setUp(self):
+        sharding.placement_cache.clear()
+        self.addCleanup(self.empty_shard)
+        with patch('core.sharding.get_ring') as get_ring:
+            get_ring.return_value.get.return_value = SHARD
+            self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def empty_shard(self):
+        with connections[SHARD].cursor() as cursor:
+            cursor.execute(
+                'TRUNCATE core_recipe_tags, core_recipe_ingredients, core_recipe, core_tag, core_ingredient, '
+                'core_tombstone, core_user CASCADE'
+            )
+
+    def test_new_user_placed_on_shard(self):
+        """Test a new user is placed on the shard the ring picks, with a copy of their row there"""
+        self.assertEqual(ShardPlacement.objects.get(user=self.user).shard, SHARD)
+        self.assertTrue(get_user_model().objects.using(SHARD).filter(pk=self.user.pk).exists())
+
+    def test_api_uses_users_shard(self):
+        """Test the recipe APIs write to and read from the user's shard"""
+        payload = {'title': 'Curry', 'time_minutes': 30, 'price': '5.00', 'tags': [{'name': 'Dinner'}]}
+        res = self.client.post(RECIPES_URL, payload, format='json')
+        self.assertEqual(res.status_code, 201)
+
+        self.assertFalse(Recipe.objects.using('default').exists())
+        recipe = Recipe.objects.using(SHARD).get()
+        self.assertEqual(recipe.tags.get().name, 'Dinner')
+        self.assertEqual(Recipe.objects.for_user(self.user).get(), recipe)
+        self.assertEqual(self.client.get(RECIPES_URL).data['results'][0]['title'], 'Curry')
+        self.assertEqual(self.client.get(detail_url(recipe.id)).status_code, 200)
+        self.assertEqual(self.client.get(TAGS_URL).data['results'][0]['name'], 'Dinner')
+        self.assertEqual(len(self.client.get(SYNC_URL).data['recipes']), 1)
+
+    def test_rebalance(self):
+        """Test rebalance_shards moves a user's data to the shard the ring now picks for them"""
+        other = get_user_model().objects.create_user('other@example.com', 'testpass123') #Placed by the real ring
+        ShardPlacement.objects.filter(user=other).delete()
+        sharding.delete_user_data(other.pk, SHARD)
+        recipe = Recipe.objects.create(user=other, title='Soup', time_minutes=5, price=Decimal('1.00'))
+        recipe.tags.add(Tag.objects.create(user=other, name='Lunch'))
+        sharding.placement_cache.clear()
+
+        with patch('core.sharding.get_ring') as get_ring:
+            get_ring.return_value.get.return_value = SHARD
+            call_command('rebalance_shards', stdout=StringIO())
+
+        placement = ShardPlacement.objects.get(user=other)
+        self.assertEqual((placement.shard, placement.moving), (SHARD, False))
+        self.assertFalse(Recipe.objects.using('default').exists())
+        moved = Recipe.objects.using(SHARD).get(pk=recipe.pk)
+        self.assertEqual(list(moved.tags.values_list('name', flat=True)), ['Lunch'])
+        self.assertIsNotNone(moved.search_vector)
+        self.client.force_authenticate(other)
+        self.assertEqual(self.client.get(RECIPES_URL).data['results'][0]['id'], recipe.pk)
+
+    def test_moving_user_read_only(self):
+        """Test a user that's being moved can read but not change their data"""
+        sharding.set_placement(self.user, SHARD, moving=True)
+
+        self.assertEqual(self.client.get(RECIPES_URL).status_code, 200)
+        res = self.client.post(RECIPES_URL, {'title': 'Curry', 'time_minutes': 30, 'price': '5.00'}, format='json')
+        self.assertEqual(res.status_code, 503)
+        self.assertIn('Retry-After', res)
+
+    def test_delete_user(self):
+        """Test deleting a user deletes their data on their shard"""
+        Recipe.objects.using(SHARD).create(user=self.user, title='Soup', time_minutes=5, price=Decimal('1.00'))
+
+        self.user.delete()
+
+        self.assertFalse(Recipe.objects.using(SHARD).exists())
+        self.assertFalse(get_user_model().objects.using(SHARD).exists())
+
+    def test_seed_data_placed_on_shards(self):
+        """Test seeded users are placed on the shard the ring picks, with their data there, and deleted from it"""
+        config = seeding.make_config(email='seed-{index}@example.com', recipes_per_user='fixed:2')
+        with patch('core.sharding.get_ring') as get_ring:
+            get_ring.return_value.get.side_effect = lambda user_id: SHARD if user_id % 2 else 'default'
+            totals = seeding.seed(config, 4)
+
+        seeded = get_user_model().objects.filter(email__startswith='seed-')
+        on_shard = {user.pk for user in seeded if user.pk % 2}
+        self.assertEqual(totals['recipes'], 8)
+        self.assertEqual(set(ShardPlacement.objects.filter(shard=SHARD).values_list('user_id', flat=True)),
+                         on_shard | {self.user.pk})
+        self.assertEqual(set(Recipe.objects.using(SHARD).values_list('user_id', flat=True)), on_shard)
+        self.assertEqual(Recipe.objects.using('default').count(), 4)
+        self.assertFalse(Recipe.objects.using('default').filter(user_id__in=on_shard).exists())
+        self.assertEqual(set(get_user_model().objects.using(SHARD).filter(email__startswith='seed-')
+                             .values_list('pk', flat=True)), on_shard)
+
+        seeding.delete_users(seeded)
+
+        self.assertFalse(Recipe.objects.using(SHARD).exists())
+        self.assertFalse(Recipe.objects.using('default').exists())
+        self.assertEqual(list(ShardPlacement.objects.values_list('user_id', flat=True)), [self.user.pk])
+        self.assertEqual(list(get_user_model().objects.using(SHARD).values_list('pk', flat=True)), [self.user.pk])
@@ -0,0 +1,152 @@
+"""Tests for the per-request timings and Server-Timing header"""
+
+import json
+import re
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import (
+    AsyncClient,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from core import timing
+from core.models import Recipe
+from recipe.tests.test_recipe_api import detail_url
+
+ME_URL = reverse('user:me')
+
+
+def parse_server_timing(header):
+    """Return {name: (dur, desc)} of a Server-Timing header"""
+    metrics = {}
+    for metric in header.split(', '):
+        name, _, params = metric.partition(';')
+        dur = re.search(r'dur=([\d.]+)', params)
+        desc = re.search(r'desc="([^"]*)"', params)
+        metrics[name] = (float(dur.group(1)), desc.group(1) if desc else None)
+    return metrics
+
+
+@override_settings(SERVER_TIMING={'SAMPLE_RATE': 1, 'HEADER': True, 'WINDOW': 60}) #Every request is sampled
+class ServerTimingTests(TestCase):
+    """Test the Server-Timing middleware"""
+
+    def setUp(self):
+        timing.reset_route_stats()
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        self.recipe = Recipe.objects.create(user=self.user, title='Soup', time_minutes=5, price=Decimal('1.00'))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_server_timing_header(self):
+        """Test the header has the requests query count, db, serializer and view time"""
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(detail_url(self.recipe.id))
+
+        metrics = parse_server_timing(res['Server-Timing'])
+        self.assertEqual(metrics['db'][1], f'{len(queries)} queries')
+        self.assertGreater(metrics['serialize'][0], 0)
+        self.assertGreaterEqual(metrics['view'][0], metrics['db'][0])
+
+    def test_log_line(self):
+        """Test a JSON log line is written for the request"""
+        with self.assertLogs('core.timing', 'INFO') as logs:
+            res = self.client.get(detail_url(self.recipe.id))
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['route'], 'recipe:recipe-detail')
+        self.assertEqual(line['status'], 200)
+        self.assertEqual(line['size'], len(res.content))
+        self.assertGreater(line['queries'], 0)
+
+    @override_settings(SERVER_TIMING={'SAMPLE_RATE': 0, 'HEADER': True, 'WINDOW': 60})
+    def test_not_sampled(self):
+        """Test requests that aren't sampled have no header but are still in the histograms"""
+        res = self.client.get(detail_url(self.recipe.id))
+
+        self.assertNotIn('Server-Timing', res)
+        self.assertEqual(timing.get_route_stats()['GET recipe:recipe-detail']['count'], 1)
+
+    @override_settings(SERVER_TIMING={'SAMPLE_RATE': 1, 'HEADER': False, 'WINDOW': 60})
+    def test_header_off(self):
+        """Test the header can be turned off and the timings are still logged"""
+        with self.assertLogs('core.timing', 'INFO'):
+            res = self.client.get(detail_url(self.recipe.id))
+
+        self.assertNotIn('Server-Timing', res)
+
+    def test_route_stats(self):
+        """Test requests are counted per route, with unmatched URLs sharing 1 route"""
+        self.client.get(detail_url(self.recipe.id))
+        self.client.get(detail_url(self.recipe.id))
+        self.client.get(ME_URL)
+        self.client.get('/no/such/url/')
+        self.client.get('/another/missing/url/')
+
+        stats = timing.get_route_stats()
+
+        self.assertEqual(stats['GET recipe:recipe-detail']['count'], 2)
+        self.assertEqual(stats['GET recipe:recipe-detail']['recent']['count'], 2)
+        self.assertEqual(stats['GET user:me']['count'], 1)
+        self.assertEqual(stats[f'GET {timing.UNMATCHED}']['count'], 2)
+        self.assertEqual(stats[f'GET {timing.UNMATCHED}']['statuses'], {404: 2})
+
+
+@override_settings(SERVER_TIMING={'SAMPLE_RATE': 1, 'HEADER': True, 'WINDOW': 60})
+class HistogramTests(SimpleTestCase):
+    """Test the latency histograms"""
+
+    def test_quantiles(self):
+        """Test quantiles are the upper bound of their bucket"""
+        histogram = timing.Histogram()
+        for ms in [1] * 50 + [40] * 45 + [700] * 5:
+            histogram.observe(ms)
+
+        self.assertEqual(histogram.quantile(0.5), 5)
+        self.assertEqual(histogram.quantile(0.95), 50)
+        self.assertEqual(histogram.quantile(0.99), 1000)
+        self.assertIsNone(timing.Histogram().quantile(0.5))
+
+    def test_recent_window(self):
+        """Test only the requests in the last WINDOW seconds are in the recent histogram"""
+        stats = timing.RouteStats()
+        stats.observe(100, 200, 10, now=1000)
+        stats.observe(1, 200, 10, now=1055)
+
+        self.assertEqual(stats.recent(now=1059).count, 2)
+        self.assertEqual(stats.recent(now=1075).count, 1)
+        self.assertEqual(stats.total.count, 2)
+        self.assertEqual(stats.size, 20)
+
+
+@override_settings(
+    ROOT_URLCONF='app.asgi_urls',
+    ASYNC_DB_THREADS=2,
+    SERVER_TIMING={'SAMPLE_RATE': 1, 'HEADER': True, 'WINDOW': 60},
+)
+class AsyncServerTimingTests(TransactionTestCase):
+    """Test the timings of async views include the queries run on the database threads"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        self.token = Token.objects.create(user=self.user)
+        self.recipe = Recipe.objects.create(user=self.user, title='Soup', time_minutes=5, price=Decimal('1.00'))
+
+    async def test_async_view_queries_counted(self):
+        """Test the header counts the queries of an async view"""
+        res = await AsyncClient().get(detail_url(self.recipe.id), authorization=f'Token {self.token.key}')
+
+        metrics = parse_server_timing(res['Server-Timing'])
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(metrics['db'][1], '0 queries')
+        self.assertGreater(metrics['serialize'][0], 0)
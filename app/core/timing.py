@@ -0,0 +1,307 @@
+"""
+Per-request timings: query count, database, serializer and view time and response size, sent in a Server-Timing
+header and a log line, and per-route latency histograms kept in memory
+"""
+import asyncio
+import bisect
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from rest_framework.serializers import BaseSerializer
+
+logger = logging.getLogger(__name__)
+
+#Upper bounds of the histogram buckets, in ms
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, float('inf'))
+UNMATCHED = '<unmatched>' #Route of requests that didn't match a URL pattern, so 404s can't add routes
+
+_current = contextvars.ContextVar('request_timings', default=None)
+_installed = False
+
+
+class RequestTimings:
+    """What 1 sampled request spent its time on, in seconds"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db = 0.0
+        self.serialize = 0.0
+        self._serializing = False
+
+
+def _record_query(execute, sql, params, many, context):
+    """Database execute wrapper that adds each query to the current requests timings"""
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.db += time.perf_counter() - start
+        timings.queries += 1
+
+
+def _add_wrapper(connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+def _timed_data(data):
+    """Wrap the data property of serializers to time it"""
+    def wrapper(serializer):
+        timings = _current.get()
+        if timings is None or timings._serializing: #Only the outermost serializer counts
+            return data.fget(serializer)
+        timings._serializing = True
+        start = time.perf_counter()
+        try:
+            return data.fget(serializer)
+        finally:
+            timings.serialize += time.perf_counter() - start
+            timings._serializing = False
+
+    return property(wrapper)
+
+
+def install():
+    """Record the queries of every connection and the time serializers take, called once from CoreConfig.ready()"""
+    #Serializer and ListSerializer.data both call BaseSerializer.data, which is where to_representation() runs. The
+    #queries a serializer makes (prefetches that weren't done in the view) are counted in both db and serialize
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    BaseSerializer.data = _timed_data(BaseSerializer.data)
+    connection_created.connect(_add_wrapper)
+    for connection in connections.all():
+        _add_wrapper(connection)
+
+
+class Histogram:
+    """Counts of observations in buckets (upper bounds), with their sum"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+        return self
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket the q quantile is in, or None with no observations"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class RouteStats:
+    """Requests to 1 route since the process started, with their latency over the last WINDOW seconds"""
+
+    SLOTS = 6 #The window is kept as SLOTS histograms, the oldest is dropped as each new one starts
+
+    def __init__(self):
+        self.total = Histogram() #ms
+        self.queries = Histogram(QUERY_BUCKETS) #Queries per request and their time, of the sampled requests only
+        self.db = Histogram()
+        self.statuses = {}
+        self.size = 0 #Response bytes
+        self._slots = []
+
+    def observe(self, ms, status, size, now, timings=None):
+        self.total.observe(ms)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.size += size
+        if timings is not None:
+            self.queries.observe(timings.queries)
+            self.db.observe(timings.db * 1000)
+        slot_start = now - now % (settings.SERVER_TIMING['WINDOW'] / self.SLOTS)
+        if not self._slots or self._slots[-1][0] != slot_start:
+            self._slots.append((slot_start, Histogram()))
+            del self._slots[:-self.SLOTS]
+        self._slots[-1][1].observe(ms)
+
+    def merge(self, other):
+        """Add the requests of other, which may still be changing, to these stats"""
+        self.total.merge(other.total)
+        self.queries.merge(other.queries)
+        self.db.merge(other.db)
+        for status, count in list(other.statuses.items()):
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.size += other.size
+        slots = dict(self._slots)
+        for slot_start, slot in list(other._slots):
+            slots[slot_start] = slots.get(slot_start, Histogram()).merge(slot)
+        self._slots = sorted(slots.items(), key=lambda item: item[0])[-self.SLOTS:]
+        return self
+
+    def recent(self, now):
+        """Return a histogram of the requests in the last WINDOW seconds"""
+        histogram = Histogram()
+        for slot_start, slot in self._slots:
+            if slot_start > now - settings.SERVER_TIMING['WINDOW']:
+                histogram.merge(slot)
+        return histogram
+
+
+#Every thread records its requests in its own {(method, URL name): RouteStats}, so requests never wait on a lock.
+#Readers add the threads together, folding in the threads that have ended (runserver has 1 per request)
+_local = threading.local()
+_shards = [] #(thread, routes) of every thread that has recorded a request
+_retired = {}
+_shards_lock = threading.Lock() #Taken when a thread records its first request, and by readers
+
+
+def observe(method, name, ms, status, size, timings=None):
+    """Add a request to the stats of its route"""
+    routes = getattr(_local, 'routes', None)
+    if routes is None:
+        routes = _local.routes = {}
+        with _shards_lock:
+            _shards.append((threading.current_thread(), routes))
+    stats = routes.get((method, name))
+    if stats is None:
+        stats = routes[method, name] = RouteStats()
+    stats.observe(ms, status, size, time.monotonic(), timings)
+
+
+def collect_routes():
+    """Return {(method, URL name): RouteStats} of the requests of every thread"""
+    with _shards_lock:
+        alive = []
+        for thread, routes in _shards:
+            if thread.is_alive():
+                alive.append((thread, routes))
+            else:
+                for key, stats in routes.items():
+                    _retired.setdefault(key, RouteStats()).merge(stats)
+        _shards[:] = alive
+        merged = {}
+        for routes in [_retired] + [routes for thread, routes in alive]:
+            for key, stats in list(routes.items()):
+                merged.setdefault(key, RouteStats()).merge(stats)
+        return merged
+
+
+def get_route_stats():
+    """Return {'METHOD URL name': {count, sum_ms, size, statuses, buckets, recent: {count, p50, p95, p99}}}"""
+    now = time.monotonic()
+    result = {}
+    for (method, name), stats in sorted(collect_routes().items()):
+        recent = stats.recent(now)
+        result[f'{method} {name}'] = {
+            'count': stats.total.count,
+            'sum_ms': stats.total.sum,
+            'size': stats.size,
+            'statuses': stats.statuses,
+            'buckets': list(zip(BUCKETS, stats.total.counts)),
+            'recent': {
+                'count': recent.count,
+                'p50': recent.quantile(0.5),
+                'p95': recent.quantile(0.95),
+                'p99': recent.quantile(0.99),
+            },
+        }
+    return result
+
+
+def reset_route_stats():
+    with _shards_lock:
+        for thread, routes in _shards:
+            routes.clear()
+        _retired.clear()
+
+
+class ServerTimingMiddleware:
+    """Time every request into the route histograms, and add the details of a sample of them to the response"""
+    #Works with both the sync and async handlers, so it doesn't make the ASGI async views switch threads for it
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        from core.metrics import start_flusher
+        #On the first request rather than here, the workers of a preloading server (gunicorn --preload) are forked
+        #after the middleware is loaded
+        self.start_flusher = start_flusher
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            self._is_coroutine = asyncio.coroutines._is_coroutine #Marks the instance as async for Django
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        timings, token, start = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, timings, start)
+
+    async def __acall__(self, request):
+        timings, token, start = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, timings, start)
+
+    def start(self):
+        sampled = random.random() < settings.SERVER_TIMING['SAMPLE_RATE']
+        timings = RequestTimings() if sampled else None
+        return timings, _current.set(timings), time.perf_counter()
+
+    def finish(self, request, response, timings, start):
+        self.start_flusher()
+        view_ms = (time.perf_counter() - start) * 1000
+        match = request.resolver_match
+        name = match.view_name if match else UNMATCHED
+        size = None if response.streaming else len(response.content)
+        observe(request.method, name, view_ms, response.status_code, size or 0, timings)
+        if timings is None:
+            return response
+
+        db_ms, serialize_ms = timings.db * 1000, timings.serialize * 1000
+        if settings.SERVER_TIMING['HEADER']:
+            response['Server-Timing'] = (
+                f'db;dur={db_ms:.1f};desc="{timings.queries} queries", '
+                f'serialize;dur={serialize_ms:.1f}, view;dur={view_ms:.1f}'
+            )
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'route': name,
+            'status': response.status_code,
+            'queries': timings.queries,
+            'db_ms': round(db_ms, 2),
+            'serialize_ms': round(serialize_ms, 2),
+            'view_ms': round(view_ms, 2),
+            'size': size,
+        }))
+        return response
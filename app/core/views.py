@@ -0,0 +1,33 @@
+"""
+Views for the core app
+"""
+import hmac
+import ipaddress
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.views.decorators.http import require_GET
+
+from core import metrics
+
+
+def metrics_allowed(request):
+    """Return whether request may read the metrics, by its address or bearer token"""
+    token = settings.METRICS['TOKEN']
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    #compare_digest takes the same time wherever the strings differ, so the token can't be guessed a character at a time
+    if token and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+        return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network) for network in settings.METRICS['ALLOWED_IPS'])
+
+
+@require_GET
+def metrics_view(request):
+    """Return the metrics of every process in the Prometheus text format"""
+    if not metrics_allowed(request): #404 rather than 403, so the public host doesn't show there's anything here
+        raise Http404
+    return HttpResponse(metrics.render(metrics.read_snapshots()), content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,116 @@
+"""
+Per-user versioned cache of the recipe, tag and ingredient list responses
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+from rest_framework import status
+from rest_framework.response import Response
+
+from core.db_routing import get_read_alias
+from recipe.conditional import etag_matches, make_etag
+
+VERSION_KEY_PREFIX = 'data-version:'
+RESPONSE_KEY_PREFIX = 'response:'
+
+stats = {'hits': 0, 'misses': 0} #Exported counters, read them with get_stats()
+
+
+def get_cache():
+    """Return the cache the responses and the data versions are stored in"""
+    return caches[settings.RESPONSE_CACHE['CACHE']]
+
+
+def is_usable():
+    """Return whether every process sees the data versions, which the cached responses and the ETags depend on"""
+    #With a per-process cache the version a write bumps is only that process', the others would keep serving (or
+    #answering 304 for) the list from before it. A DummyCache has no versions at all, so the ETag would never change
+    cache = get_cache()
+    if isinstance(cache, DummyCache):
+        return False
+    return settings.RESPONSE_CACHE['SINGLE_PROCESS'] or not isinstance(cache, LocMemCache)
+
+
+def get_version(user_id):
+    """Return the current data version of a user"""
+    cache = get_cache()
+    version = cache.get(VERSION_KEY_PREFIX + str(user_id))
+    if version is None:
+        #A random version instead of a counter, so if the key is evicted we never go back to a version that
+        #already has responses cached for it
+        cache.add(VERSION_KEY_PREFIX + str(user_id), uuid.uuid4().hex, None)
+        version = cache.get(VERSION_KEY_PREFIX + str(user_id))
+    return version
+
+
+def _set_version(user_id):
+    get_cache().set(VERSION_KEY_PREFIX + str(user_id), uuid.uuid4().hex, None)
+
+
+def bump_version(user_id, using=None):
+    """Make every cached response of a user stale, call it whenever their recipes, tags or ingredients change"""
+    #Responses are never deleted, they are cached under the version and just stop being looked up, so this is 1 write
+    #however many responses the user has. It's bumped now, so the rest of the transaction doesn't read its own
+    #writes from the cache, and again on commit: a request that read the version in between may have cached data
+    #from before the commit under it
+    _set_version(user_id)
+    transaction.on_commit(lambda: _set_version(user_id), using=using) #using: the user's shard
+
+
+def response_key(request, version):
+    """Return the cache key for the response to request"""
+    #The full URL, because the pagination links in the response are absolute and include the query params
+    url = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+    return f'{RESPONSE_KEY_PREFIX}{request.user.id}:{version}:{url}'
+
+
+def get_stats():
+    """Return the hit/miss counters and the hit ratio"""
+    lookups = stats['hits'] + stats['misses']
+    return dict(stats, hit_ratio=stats['hits'] / lookups if lookups else 0.0)
+
+
+class CachedListMixin:
+    """Viewset mixin that caches the list response per user until their data changes, and gives it an ETag"""
+
+    def list(self, request, *args, **kwargs):
+        if not is_usable():
+            return super().list(request, *args, **kwargs)
+        version = get_version(request.user.id)
+        #The data version changes whenever anything in the list could, so the ETag is known before any query is made
+        etag = make_etag('list', version, request.build_absolute_uri())
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and etag_matches(if_none_match, etag, weak=True):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        response = self._cached_list(request, version, *args, **kwargs)
+        if response.status_code == 200 and not getattr(response, 'read_from_replica', False):
+            response['ETag'] = etag
+        return response
+
+    def _cached_list(self, request, version, *args, **kwargs):
+        ttl = settings.RESPONSE_CACHE['TTL']
+        cache = get_cache()
+        key = response_key(request, version)
+        if ttl:
+            data = cache.get(key)
+            if data is not None:
+                stats['hits'] += 1
+                return Response(data) #The data is cached, not the bytes, so the renderer is still picked per request
+            stats['misses'] += 1
+
+        response = super().list(request, *args, **kwargs)
+        if get_read_alias() is not None:
+            #The replica may not have the write that made this version yet. The cache and the ETag are per version,
+            #not per client, so either would serve or validate a stale list until the next change, even to the client
+            #that wrote and reads from the primary
+            response.read_from_replica = True
+        elif ttl and response.status_code == 200:
+            cache.set(key, response.data, ttl)
+        return response
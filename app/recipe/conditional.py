@@ -0,0 +1,35 @@
+"""
+ETags and conditional requests (If-None-Match, If-Match) for the recipe APIs
+"""
+import hashlib
+
+from django.utils.http import parse_etags, quote_etag
+
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'The resource has changed since it was fetched.'
+    default_code = 'precondition_failed'
+
+
+def make_etag(*parts):
+    """Return a strong ETag made from parts"""
+    return quote_etag(hashlib.md5(':'.join(str(part) for part in parts).encode()).hexdigest())
+
+
+def recipe_etag(recipe_id, updated_at, fields=None):
+    """Return the ETag of a recipe, or of the response with only fields when they're given"""
+    return make_etag('recipe', recipe_id, updated_at.isoformat(), *(fields or []))
+
+
+def etag_matches(header, etag, weak=False):
+    """Return whether an If-None-Match (weak=True) or If-Match header matches etag"""
+    etags = parse_etags(header)
+    if '*' in etags:
+        return True
+    if weak: #If-None-Match uses the weak comparison, which ignores the W/ prefix. If-Match never matches a weak ETag
+        etags = [value[2:] if value.startswith('W/') else value for value in etags]
+    return etag in etags
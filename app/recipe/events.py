@@ -0,0 +1,185 @@
+"""
+In-process pub/sub of recipe, tag and ingredient changes, for the server-sent events feed (recipe/sse.py)
+"""
+import asyncio
+import itertools
+import json
+import logging
+import select
+import threading
+import uuid
+from collections import deque
+
+import psycopg2
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, transaction
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'recipe_events'
+RESET = 'reset' #Sent instead of the events a subscriber missed, it should resync with the sync API and reconnect
+
+
+class Subscription:
+    """Events for 1 user, delivered to 1 event loop through a bounded queue"""
+
+    def __init__(self, user_id, loop):
+        self.user_id = user_id
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=settings.EVENTS['QUEUE_SIZE'])
+        self.overflowed = False
+
+    def push(self, event):
+        """Add an event to the queue, runs on the subscribers event loop"""
+        if self.overflowed:
+            return
+        if self.queue.full(): #A slow client doesn't make us keep more events, it's told to resync instead
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            event = (None, RESET, {})
+        self.queue.put_nowait(event)
+
+
+class Broker:
+    """Fans events out to the subscriptions of their user, keeping the last few for clients that reconnect"""
+
+    def __init__(self):
+        self.boot = uuid.uuid4().hex[:8] #Event ids are only meaningful to the process that made them
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+        self._subscriptions = {} #user id -> set of subscriptions
+        self._count = 0
+        self._recent = deque(maxlen=settings.EVENTS['BUFFER_SIZE'])
+
+    def __len__(self):
+        return self._count
+
+    def subscribe(self, user_id, loop, last_event_id=None):
+        """Return a subscription to a users events, with the events after last_event_id already queued"""
+        with self._lock:
+            if self._count >= settings.EVENTS['MAX_CONNECTIONS']:
+                return None
+            subscription = Subscription(user_id, loop)
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+            self._count += 1
+            if last_event_id is not None:
+                for event in self._missed(user_id, last_event_id):
+                    subscription.push(event)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop delivering events to a subscription"""
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id, set())
+            if subscription in subscriptions:
+                subscriptions.discard(subscription)
+                self._count -= 1
+            if not subscriptions:
+                self._subscriptions.pop(subscription.user_id, None)
+
+    def _missed(self, user_id, last_event_id):
+        """Return the users events after last_event_id, or a reset if they're no longer all kept"""
+        boot, _, number = last_event_id.partition('-')
+        oldest = self._recent[0][0] if self._recent else None
+        if boot != self.boot or not number.isdigit() or (oldest is not None and int(number) < oldest - 1):
+            return [(None, RESET, {})]
+        return [
+            (f'{self.boot}-{event_number}', event_type, data)
+            for event_number, event_user_id, event_type, data in self._recent
+            if event_number > int(number) and event_user_id == user_id
+        ]
+
+    def publish(self, user_id, event_type, data):
+        """Send an event to every subscription of a user, can be called from any thread"""
+        with self._lock:
+            number = next(self._counter)
+            self._recent.append((number, user_id, event_type, data))
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        event = (f'{self.boot}-{number}', event_type, data)
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.push, event)
+
+
+broker = Broker()
+
+
+def publish_change(user_id, model, action, object_id, using=None):
+    """Publish that a users recipe/tag/ingredient was created, updated or deleted once the transaction commits"""
+    publish_changes(user_id, model, action, [object_id], using)
+
+
+def publish_changes(user_id, model, action, object_ids, using=None):
+    """Publish the same change to several of a users objects, with 1 query however many there are"""
+    #using is the database the change was made on, the user's shard
+    event_type = f'{model}.{action}'
+    if settings.EVENTS['PG_NOTIFY']:
+        #NOTIFY is delivered on commit, to the listener thread of every process (see start_listener). The listeners
+        #are on the primary, so a change on another shard is sent there once it's committed
+        payloads = [
+            json.dumps({'user_id': user_id, 'type': event_type, 'data': {'id': object_id}}) for object_id in object_ids
+        ]
+        if using in (None, DEFAULT_DB_ALIAS):
+            _notify(payloads)
+        else:
+            transaction.on_commit(lambda: _notify(payloads), using=using)
+    else:
+        def publish():
+            for object_id in object_ids:
+                broker.publish(user_id, event_type, {'id': object_id})
+        transaction.on_commit(publish, using=using)
+
+
+def _notify(payloads):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) payload', [NOTIFY_CHANNEL, payloads])
+
+
+_listener = None
+_listener_lock = threading.Lock()
+_stop_listener = threading.Event()
+
+
+def start_listener():
+    """Start the thread that LISTENs for the events of every process, if PG_NOTIFY is on and it isn't running yet"""
+    global _listener
+    if not settings.EVENTS['PG_NOTIFY']:
+        return
+    with _listener_lock:
+        if _listener is None or not _listener.is_alive():
+            _stop_listener.clear()
+            _listener = threading.Thread(target=_listen, name='recipe-events-listener', daemon=True)
+            _listener.start()
+
+
+def stop_listener():
+    """Stop the listener thread and close its connection"""
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _stop_listener.set()
+            _listener.join()
+            _listener = None
+
+
+def _listen():
+    #A connection of its own, outside Django's connection handling, that only waits for notifications
+    while not _stop_listener.is_set():
+        listen_connection = None
+        try:
+            listen_connection = psycopg2.connect(**connection.get_connection_params())
+            listen_connection.autocommit = True
+            with listen_connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {NOTIFY_CHANNEL}')
+            while not _stop_listener.is_set():
+                if select.select([listen_connection], [], [], 1) != ([], [], []):
+                    listen_connection.poll()
+                    while listen_connection.notifies:
+                        notify = json.loads(listen_connection.notifies.pop(0).payload)
+                        broker.publish(notify['user_id'], notify['type'], notify['data'])
+        except Exception: #Reconnect, events sent meanwhile are lost but the clients can resync
+            logger.exception('Recipe events listener failed, reconnecting')
+            _stop_listener.wait(1)
+        finally:
+            if listen_connection is not None:
+                listen_connection.close()
@@ -0,0 +1,55 @@
+"""Streaming export of recipes"""
+
+import csv
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from recipe.importer import chunks
+from recipe.serializers import tags_and_ingredients
+
+EXPORT_FIELDS = ['id', 'title', 'description', 'time_minutes', 'price', 'link']
+CSV_HEADER = EXPORT_FIELDS + ['tags', 'ingredients']
+
+
+def iter_recipes(queryset, chunk_size=None, user_id=None):
+    """Yield each recipe in queryset as a dict with its tags and ingredients, a chunk at a time"""
+    #iterator() reads the rows through a Postgres server-side cursor chunk_size at a time instead of loading every row,
+    #and the tags/ingredients are loaded per chunk, so memory stays the same however many recipes the user has.
+    #Pass user_id when the recipes are all 1 user's, see tags_and_ingredients
+    chunk_size = chunk_size or settings.RECIPE_EXPORT_CHUNK_SIZE
+    rows = queryset.values(*EXPORT_FIELDS, 'snapshot').iterator(chunk_size=chunk_size)
+    for chunk in chunks(rows, chunk_size):
+        tags, ingredients = tags_and_ingredients(chunk, user_id)
+        for row in chunk:
+            del row['snapshot']
+            row['tags'] = tags.get(row['id'], [])
+            row['ingredients'] = ingredients.get(row['id'], [])
+            yield row
+
+
+def ndjson_lines(recipes):
+    """Yield each recipe as a line of JSON"""
+    for recipe in recipes:
+        yield json.dumps(recipe, cls=DjangoJSONEncoder) + '\n' #DjangoJSONEncoder writes Decimal prices as strings
+
+
+class _Line:
+    """File-like object that returns what csv.writer writes instead of storing it"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(recipes):
+    """Yield a CSV header and then a line per recipe, tags and ingredients are | separated names"""
+    writer = csv.writer(_Line())
+    yield writer.writerow(CSV_HEADER)
+    for recipe in recipes:
+        yield writer.writerow(
+            [recipe[field] for field in EXPORT_FIELDS] + [
+                '|'.join(tag['name'] for tag in recipe['tags']),
+                '|'.join(ingredient['name'] for ingredient in recipe['ingredients']),
+            ]
+        )
@@ -0,0 +1,170 @@
+"""Bulk import of recipes"""
+
+import codecs
+import json
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+
+from rest_framework.exceptions import ParseError
+
+from core.models import (
+    Recipe,
+    Tag,
+    Ingredient,
+)
+from core.sharding import db_for_user
+from recipe.cache import bump_version
+from recipe.events import publish_changes
+from recipe.serializers import RecipeDetailSerializer
+
+READ_SIZE = 64 * 1024 #Bytes read from the request at a time
+
+
+class ImportFormatError(ParseError):
+    """The uploaded body isn't valid JSON/NDJSON and reading can't carry on"""
+
+
+def iter_ndjson(stream):
+    """Yield (row, item) for each line of an NDJSON stream, item is None for invalid lines"""
+    for row, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield row, json.loads(line)
+        except ValueError: #A bad line is reported as an error for that row, the next line is still read
+            yield row, None
+
+
+def iter_json_array(stream):
+    """Yield (row, item) for each item of a JSON array, reading the stream a chunk at a time"""
+    #json.load would read the whole body into memory at once. Instead we keep a small buffer and decode items as
+    #soon as they are complete, so memory depends on the size of 1 item, not the size of the upload
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    expect = '[' #What can come next: '[', 'item or ]' right after it, 'item' after a comma, ', or ]' after an item, 'end'
+    eof = False
+    row = 0
+    while True:
+        buffer = buffer.lstrip()
+        if buffer:
+            if expect == '[':
+                if buffer[0] != '[':
+                    raise ImportFormatError('Expected a JSON array.')
+                buffer, expect = buffer[1:], 'item or ]'
+                continue
+            if expect == 'end':
+                raise ImportFormatError('Unexpected data after the JSON array.')
+            if expect in ('item or ]', ', or ]') and buffer[0] == ']':
+                buffer, expect = buffer[1:], 'end'
+                continue
+            if expect == ', or ]':
+                if buffer[0] != ',':
+                    raise ImportFormatError(f'Expected , or ] after item {row}.')
+                buffer, expect = buffer[1:], 'item'
+                continue
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except ValueError: #The item isn't complete yet, read some more
+                if eof:
+                    raise ImportFormatError(f'Invalid JSON in item {row + 1}.')
+            else:
+                #A number at the very end of the buffer may be cut off, so wait for more data unless it's an object/array
+                if eof or end < len(buffer) or isinstance(item, (dict, list)):
+                    row += 1
+                    buffer, expect = buffer[end:], ', or ]'
+                    yield row, item
+                    continue
+        if eof:
+            if expect == 'end': #Only whitespace after the ]
+                return
+            raise ImportFormatError('Unexpected end of JSON array.')
+
+        data = stream.read(READ_SIZE)
+        eof = not data
+        try:
+            buffer += text.decode(data, final=eof)
+        except UnicodeDecodeError:
+            raise ImportFormatError("The body isn't UTF-8.")
+
+
+def chunks(iterable, size):
+    """Split iterable into lists of size items"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _import_chunk(user, rows):
+    """Create the valid recipes in rows in bulk and return the errors of the invalid ones"""
+    valid = []
+    errors = []
+    for row, item in rows:
+        if not isinstance(item, dict):
+            errors.append({'row': row, 'errors': {'non_field_errors': ['Expected a JSON object.']}})
+            continue
+        serializer = RecipeDetailSerializer(data=item)
+        if serializer.is_valid():
+            valid.append(serializer.validated_data)
+        else:
+            errors.append({'row': row, 'errors': serializer.errors})
+
+    if not valid:
+        return 0, errors
+
+    using = db_for_user(user.pk)
+    with transaction.atomic(using=using): #A chunk is saved completely or not at all
+        #Every tag and ingredient name in the chunk is resolved with 1 lookup and 1 bulk insert each
+        tag_ids = Tag.objects.get_or_create_many(
+            user, [tag['name'] for data in valid for tag in data.get('tags', [])],
+        )
+        ingredient_ids = Ingredient.objects.get_or_create_many(
+            user, [ingredient['name'] for data in valid for ingredient in data.get('ingredients', [])],
+        )
+        recipes = Recipe.objects.bulk_create([ #Postgres returns the new ids, so we can link the tags/ingredients below
+            Recipe(user=user, **{
+                field: value for field, value in data.items() if field not in ('tags', 'ingredients')
+            }) for data in valid
+        ])
+        Recipe.tags.through.objects.bulk_create([
+            Recipe.tags.through(recipe_id=recipe.id, tag_id=tag_ids[name])
+            for recipe, data in zip(recipes, valid)
+            for name in dict.fromkeys(tag['name'] for tag in data.get('tags', []))
+        ])
+        Recipe.ingredients.through.objects.bulk_create([
+            Recipe.ingredients.through(recipe_id=recipe.id, ingredient_id=ingredient_ids[name])
+            for recipe, data in zip(recipes, valid)
+            for name in dict.fromkeys(ingredient['name'] for ingredient in data.get('ingredients', []))
+        ])
+        bump_version(user.id, using) #bulk_create doesn't send the signals that normally do these
+        publish_changes(user.id, 'recipe', 'created', [recipe.id for recipe in recipes], using)
+
+    return len(recipes), errors
+
+
+def import_recipes(user, rows, chunk_size=None):
+    """Validate and create recipes for user from (row, item) pairs, a chunk at a time"""
+    chunk_size = chunk_size or settings.RECIPE_IMPORT_CHUNK_SIZE
+    max_errors = settings.RECIPE_IMPORT_MAX_ERRORS
+    result = {'created': 0, 'error_count': 0, 'errors': []}
+
+    def read_rows():
+        #Stops at a broken JSON body but lets the rows read before it still be imported
+        try:
+            yield from rows
+        except ImportFormatError as error:
+            result['detail'] = str(error)
+
+    for chunk in chunks(read_rows(), chunk_size):
+        created, errors = _import_chunk(user, chunk)
+        result['created'] += created
+        result['error_count'] += len(errors)
+        #Only the first max_errors are returned so a bad upload can't make the response grow without limit
+        result['errors'] += errors[:max_errors - len(result['errors'])]
+
+    return result
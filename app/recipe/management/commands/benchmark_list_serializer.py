@@ -0,0 +1,84 @@
+"""
+Django command to compare the recipe list serializers
+"""
+import time
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Prefetch
+
+from core.models import (
+    Recipe,
+    Tag,
+    Ingredient,
+)
+from recipe.serializers import (
+    RecipeSerializer,
+    RecipeListSerializer,
+)
+
+
+class Command(BaseCommand):
+    """Django command to time RecipeSerializer against the fast RecipeListSerializer"""
+
+    help = 'Benchmark serializing recipe lists with RecipeSerializer and RecipeListSerializer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000])
+        parser.add_argument('--repeat', type=int, default=3, help='Best of this many runs is reported')
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        for size in options['sizes']:
+            with transaction.atomic(): #Everything we seed is rolled back at the end
+                user = self._seed(size)
+                recipes = Recipe.objects.filter(user=user).order_by('-id')
+
+                slow = self._time(options['repeat'], lambda: RecipeSerializer(
+                    recipes.prefetch_related(
+                        Prefetch('tags', queryset=Tag.objects.order_by('id')),
+                        Prefetch('ingredients', queryset=Ingredient.objects.order_by('id')),
+                    ),
+                    many=True,
+                ).data)
+                fast = self._time(options['repeat'], lambda: RecipeListSerializer(
+                    recipes.values(*RecipeListSerializer.value_fields),
+                    many=True,
+                ).data)
+
+                self.stdout.write(
+                    f'{size} recipes: RecipeSerializer {slow * 1000:.1f} ms, '
+                    f'RecipeListSerializer {fast * 1000:.1f} ms, {slow / fast:.1f}x faster'
+                )
+                transaction.set_rollback(True)
+
+    def _time(self, repeat, func):
+        """Return the fastest of repeat runs of func in seconds"""
+        timings = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    def _seed(self, size):
+        """Create a user with size recipes, each with 3 tags and 2 ingredients"""
+        user = get_user_model().objects.create_user(f'benchmark{size}@example.com', 'benchmark123')
+        tags = Tag.objects.bulk_create([Tag(user=user, name=f'Tag {i}') for i in range(20)])
+        ingredients = Ingredient.objects.bulk_create([Ingredient(user=user, name=f'Ingredient {i}') for i in range(50)])
+        recipes = Recipe.objects.bulk_create([
+            Recipe(user=user, title=f'Recipe {i}', time_minutes=i % 120, price=Decimal(i % 500) / 4)
+            for i in range(size)
+        ])
+        Recipe.tags.through.objects.bulk_create([
+            Recipe.tags.through(recipe_id=recipe.id, tag_id=tags[(i + n) % len(tags)].id)
+            for i, recipe in enumerate(recipes) for n in range(3)
+        ])
+        Recipe.ingredients.through.objects.bulk_create([
+            Recipe.ingredients.through(recipe_id=recipe.id, ingredient_id=ingredients[(i + n) % len(ingredients)].id)
+            for i, recipe in enumerate(recipes) for n in range(2)
+        ])
+
+        return user
@@ -0,0 +1,95 @@
+"""
+Django command to compare join + distinct with EXISTS for the recipe tag filters
+"""
+import re
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import RequestFactory
+
+from rest_framework.request import Request
+
+from core.models import Recipe
+from recipe.views import RecipeViewSet
+
+EXECUTION_TIME = re.compile(r'Execution Time: ([\d.]+) ms')
+PLAN_NODE = re.compile(r'(?:->\s+)?([A-Z][A-Za-z ]+?)(?: on | using |\s+\()')
+
+
+class Command(BaseCommand):
+    """Django command to benchmark the recipe list tag filters"""
+
+    help = 'EXPLAIN ANALYZE the tag filters of the recipe list against a naive join with distinct()'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--links', type=int, default=1000000, help='Recipe-tag links to seed')
+        parser.add_argument('--tags-per-recipe', type=int, default=5)
+        parser.add_argument('--tags', type=int, default=200, help='Tags the user has')
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        if connection.vendor != 'postgresql':
+            raise CommandError('benchmark_recipe_filters only supports PostgreSQL.')
+
+        with transaction.atomic(): #Everything we seed is rolled back at the end
+            user = self._seed(options['links'], options['tags_per_recipe'], options['tags'])
+            tag_ids = list(user.tag_set.order_by('id').values_list('id', flat=True)[:3])
+            self.stdout.write(f'Seeded {options["links"]} recipe-tag links, filtering by tags {tag_ids}')
+
+            recipes = Recipe.objects.filter(user=user).order_by('-id')
+            naive_any = recipes.filter(tags__id__in=tag_ids).distinct()
+            naive_all = recipes.filter(tags__id__in=tag_ids).annotate(
+                matched=Count('tags', distinct=True),
+            ).filter(matched=len(tag_ids))
+            ids = ','.join(str(tag_id) for tag_id in tag_ids)
+            cases = [
+                ('any: join + distinct', naive_any),
+                ('any: EXISTS', self._view_queryset(user, {'tags': ids})),
+                ('all: join + group by', naive_all),
+                ('all: EXISTS', self._view_queryset(user, {'tags': ids, 'match': 'all'})),
+            ]
+            for name, queryset in cases:
+                plan = queryset.values('id')[:100].explain(analyze=True)
+                nodes = ' > '.join(dict.fromkeys(PLAN_NODE.findall(plan)))
+                time = EXECUTION_TIME.search(plan).group(1)
+                self.stdout.write(f'\n{name}: {time} ms\n  {nodes}')
+
+            transaction.set_rollback(True)
+
+    def _view_queryset(self, user, params):
+        """Return the recipe list queryset the API builds for params"""
+        view = RecipeViewSet(action='list', format_kwarg=None)
+        view.request = Request(RequestFactory().get('/', params))
+        view.request.user = user
+
+        return view.get_queryset()
+
+    def _seed(self, links, tags_per_recipe, tags):
+        """Create a user with enough recipes for links recipe-tag links, in SQL so 1M links take seconds"""
+        user = get_user_model().objects.create_user('benchmark-filters@example.com', 'benchmark123')
+        recipe_count = links // tags_per_recipe
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO core_tag (user_id, name) SELECT %s, %s || n FROM generate_series(1, %s) n',
+                [user.id, 'Tag ', tags],
+            )
+            cursor.execute(
+                "INSERT INTO core_recipe (user_id, title, description, time_minutes, price, link) "
+                "SELECT %s, 'Recipe ' || n, '', 10, 5, '' FROM generate_series(1, %s) n",
+                [user.id, recipe_count],
+            )
+            #Each recipe gets tags_per_recipe different tags, spread so every tag is used by a similar number of recipes
+            cursor.execute(
+                'INSERT INTO core_recipe_tags (recipe_id, tag_id) '
+                'SELECT recipe.id, tag_ids[(recipe.n * 7 + offset_n * 31) %% %s + 1] '
+                'FROM (SELECT id, row_number() OVER (ORDER BY id) AS n FROM core_recipe WHERE user_id = %s) recipe, '
+                '(SELECT array_agg(id ORDER BY id) AS tag_ids FROM core_tag WHERE user_id = %s) tags, '
+                'generate_series(0, %s - 1) offset_n '
+                'ON CONFLICT DO NOTHING',
+                [tags, user.id, user.id, tags_per_recipe],
+            )
+            cursor.execute('ANALYZE core_recipe, core_tag, core_recipe_tags')
+
+        return user
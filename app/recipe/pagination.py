@@ -0,0 +1,79 @@
+"""Pagination for the recipe APIs"""
+
+from django.conf import settings
+from django.db.models import Field, Func, Lookup
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+
+
+class SearchPositionField(Field):
+    """Output field of SearchPosition, a (rank, id) row read back as the text '(rank,id)'"""
+
+
+class SearchPosition(Func):
+    """The (rank, id) of a search result as 1 value, so the cursor pagination can page by both"""
+    #DRF's cursor holds the value of the first ordering field only, paging by rank alone skips the results with the
+    #same rank as the last one by an offset, which stops at offset_cutoff
+    template = 'ROW(%(expressions)s)'
+    output_field = SearchPositionField()
+
+
+def parse_search_position(position):
+    """Return (rank, id) from the text of a SearchPosition, ValueError when it isn't one"""
+    rank, _, recipe_id = position.strip('()').partition(',')
+    return float(rank), int(recipe_id)
+
+
+class SearchPositionLookup(Lookup):
+    """Compare a SearchPosition row with the position in a cursor"""
+
+    def as_sql(self, compiler, connection):
+        lhs, params = self.process_lhs(compiler, connection)
+        #The rank is a real, compared as one it's exactly the value that was read, and the row comparison
+        #(rank, id) < (r, i) means rank < r, or the same rank and id < i
+        return f'{lhs} {self.operator} ROW(%s::real, %s::bigint)', [*params, *parse_search_position(self.rhs)]
+
+
+@SearchPositionField.register_lookup
+class SearchPositionLessThan(SearchPositionLookup):
+    lookup_name = 'lt'
+    operator = '<'
+
+
+@SearchPositionField.register_lookup
+class SearchPositionGreaterThan(SearchPositionLookup):
+    lookup_name = 'gt'
+    operator = '>'
+
+
+class RecipeCursorPagination(CursorPagination):
+    """Keyset pagination for recipes, newest first"""
+    #Cursor (keyset) pagination filters on the last id seen, i.e. WHERE id < cursor, instead of using OFFSET,
+    #so page 1000 costs the same as page 1. The cursor is an opaque, encoded string returned in next/previous
+    ordering = '-id' #Must match an index on the table, see the (user, -id) index on Recipe
+    page_size = settings.API_PAGE_SIZE
+    page_size_query_param = 'page_size' #Lets clients ask for a smaller or bigger page, up to max_page_size
+    max_page_size = settings.API_MAX_PAGE_SIZE
+
+    def get_ordering(self, request, queryset, view):
+        """Return the fields to page by"""
+        if 'search_position' in queryset.query.annotations: #Search results are paged best match first, id breaks ties
+            return ('-search_position',)
+        return super().get_ordering(request, queryset, view)
+
+    def decode_cursor(self, request):
+        """Return the cursor of the request, a 404 when its position isn't one of the ordering"""
+        cursor = super().decode_cursor(request)
+        if cursor and cursor.position is not None and self.ordering == ('-search_position',):
+            try:
+                parse_search_position(cursor.position)
+            except ValueError:
+                raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+
+class NameCursorPagination(RecipeCursorPagination):
+    """Keyset pagination for tags and ingredients, sorted by name"""
+    #The unique (user, name) index is used for this ordering. id is only there as a tie breaker
+    ordering = ('-name', 'id')
@@ -1,5 +1,7 @@
 """Serializers for recipe APIs"""
 
+from collections import defaultdict
+
 from rest_framework import serializers
 from core.models import (
    Recipe,
@@ -15,6 +17,17 @@ class IngredientSerializer(serializers.ModelSerializer):
       fields = ['id', 'name']
       read_only_fields = ['id']
 
+   def validate_name(self, value):
+      """Make sure a renamed ingredient doesn't clash with another of the users ingredients"""
+      if self.instance is not None: #Only when renaming, nested ingredients in a recipe reuse existing names on purpose
+         clash = Ingredient.objects.filter(
+            user = self.instance.user,
+            name = value,
+         ).exclude(id = self.instance.id).exists()
+         if clash:
+            raise serializers.ValidationError('You already have an ingredient with this name.')
+      return value
+
 class TagSerializer(serializers.ModelSerializer):
    """Serializer for tags"""
 
@@ -23,6 +36,34 @@ class TagSerializer(serializers.ModelSerializer):
       fields = ['id', 'name']
       read_only_fields = ['id']
 
+   def validate_name(self, value):
+      """Make sure a renamed tag doesn't clash with another of the users tags"""
+      if self.instance is not None: #Only when renaming, nested tags in a recipe reuse existing names on purpose
+         clash = Tag.objects.filter(
+            user = self.instance.user,
+            name = value,
+         ).exclude(id = self.instance.id).exists()
+         if clash:
+            raise serializers.ValidationError('You already have a tag with this name.')
+      return value
+
+
+class IngredientCountSerializer(IngredientSerializer):
+   """Serializer for ingredients with the number of recipes using them"""
+
+   recipe_count = serializers.IntegerField(read_only=True) #Annotated on the queryset by IngredientViewSet
+
+   class Meta(IngredientSerializer.Meta):
+      fields = IngredientSerializer.Meta.fields + ['recipe_count']
+
+class TagCountSerializer(TagSerializer):
+   """Serializer for tags with the number of recipes using them"""
+
+   recipe_count = serializers.IntegerField(read_only=True) #Annotated on the queryset by TagViewSet
+
+   class Meta(TagSerializer.Meta):
+      fields = TagSerializer.Meta.fields + ['recipe_count']
+
 
 class RecipeSerializer(serializers.ModelSerializer): #We're using the ModelSerializer because this serializer is going to represent a spcific model in the system - Recipe Model
    """Serializer for recipes"""
@@ -33,20 +74,25 @@ class RecipeSerializer(serializers.ModelSerializer): #We're using the ModelSeria
    class Meta:
       model = Recipe
       fields = ['id', 'title', 'time_minutes', 'price', 'link', 'tags', 
-                'ingredient']
+                'ingredients']
       read_only_fields = ['id']
 
+   def __init__(self, *args, **kwargs):
+      super().__init__(*args, **kwargs)
+      fields = self.context.get('fields') #Set by RecipeViewSet for ?fields= and ?expand=
+      if fields is not None:
+         for name in set(self.fields) - set(fields):
+            self.fields.pop(name)
+
    def _get_or_create_tags(self, tags, recipe):
       """Handle getting or creating tags as needed"""
       auth_user = self.context['request'].user #Because we're getting auth_user in a serializer and not the view, we use context
       #Context is passed to the serializer by the view when you're using the serializer for a particular view
-      for tag in tags:
-         tag_obj, created = Tag.objects.get_or_create(#get_or_create is a helper method available for your model manager
-            #It gets the value if it already exists or it creates the value with the passed in values if it doesn't exist
-            user = auth_user,
-            **tag,
-         )
-         recipe.tags.add(tag_obj)
+      tag_ids = Tag.objects.get_or_create_many( #Resolves every tag in the payload in bulk instead of 1 get_or_create per tag
+         auth_user,
+         [tag['name'] for tag in tags],
+      )
+      recipe.tags.add(*tag_ids.values()) #Adding all the ids at once is a single bulk insert into the through table
 
    def _get_or_create_ingredients(self, ingredients, recipe): #_method is used internally only "private", i.e. we don't expect
       #anyone using this serializer to be calling _get_or_create_ingredients directly. It should only be used by other 
@@ -54,13 +100,11 @@ class RecipeSerializer(serializers.ModelSerializer): #We're using the ModelSeria
       """Handle getting or creating ingredients as needed"""
 
       auth_user = self.context['request'].user
-      for ingredient in ingredients:
-         ingredient_obj, create = Ingredient.objects.get_or_create( #gets obj if exists or create new
-            #gives a 'create' attr - boolean to know whether the ingredient_obj was created or not. We don't need to us it  
-            user = auth_user,
-            **ingredient
-         )
-         recipe.ingredients.add(ingredient_obj)
+      ingredient_ids = Ingredient.objects.get_or_create_many(
+         auth_user,
+         [ingredient['name'] for ingredient in ingredients],
+      )
+      recipe.ingredients.add(*ingredient_ids.values())
 
    def create(self, validated_data):
       """Create a recipe"""
@@ -69,7 +113,7 @@ class RecipeSerializer(serializers.ModelSerializer): #We're using the ModelSeria
       recipe = Recipe.objects.create(**validated_data) #creating a recipe with excluded tags
       
       self._get_or_create_tags(tags, recipe)
-      self._get_or_create_tags(ingredients, recipe)
+      self._get_or_create_ingredients(ingredients, recipe)
 
       return recipe
    
@@ -77,10 +121,15 @@ class RecipeSerializer(serializers.ModelSerializer): #We're using the ModelSeria
       """Update recipe"""
 
       tags = validated_data.pop('tags', None)
+      ingredients = validated_data.pop('ingredients', None)
       if tags is not None:
          instance.tags.clear()
          self._get_or_create_tags(tags, instance)
 
+      if ingredients is not None:
+         instance.ingredients.clear()
+         self._get_or_create_ingredients(ingredients, instance)
+
       for attr, value in validated_data.items():
          setattr(instance, attr, value)
 
@@ -95,3 +144,127 @@ class RecipeDetailSerializer(RecipeSerializer):#DetailSerializer is going to be
    
    class Meta(RecipeSerializer.Meta):
       fields = RecipeSerializer.Meta.fields + ['description']
+
+
+def group_by_recipe(through, related_field, recipe_ids, user_id=None):
+   """Return {recipe_id: [{'id', 'name'}]} for the tags/ingredients of recipe_ids in 1 query"""
+   grouped = defaultdict(list)
+   rows = through.objects.filter(recipe_id__in = recipe_ids)
+   if user_id is not None:
+      #The recipes' tags/ingredients are all the user's. Postgres can't tell how many links each id has in every
+      #partition of a partitioned through table (see core/partitioning.py) and overestimates, with the user it knows
+      #only a few tags/ingredients match and looks them up by index instead of hashing the whole table
+      rows = rows.filter(**{related_field + '__user_id': user_id})
+   rows = rows.values_list(
+      'recipe_id', related_field + '_id', related_field + '__name',
+   ).order_by(related_field + '_id') #Same order as the prefetch in RecipeViewSet.get_queryset
+   for recipe_id, related_id, name in rows:
+      grouped[recipe_id].append({'id': related_id, 'name': name})
+   return grouped
+
+
+def tags_and_ingredients(rows, user_id=None):
+   """Return ({recipe_id: tags}, {recipe_id: ingredients}) for .values() rows of recipes with their snapshot"""
+   #The snapshot already has them in the same order as group_by_recipe, only the recipes without one (from before
+   #migration 0016, until check_recipe_snapshots --repair is run) need the through tables
+   tags, ingredients, missing = {}, {}, []
+   for row in rows:
+      snapshot = row['snapshot']
+      if snapshot is None:
+         missing.append(row['id'])
+         continue
+      tags[row['id']] = [{'id': tag_id, 'name': name} for tag_id, name in snapshot['tags']]
+      ingredients[row['id']] = [{'id': ingredient_id, 'name': name} for ingredient_id, name in snapshot['ingredients']]
+   if missing:
+      tags.update(group_by_recipe(Recipe.tags.through, 'tag', missing, user_id))
+      ingredients.update(group_by_recipe(Recipe.ingredients.through, 'ingredient', missing, user_id))
+   return tags, ingredients
+
+
+class FastRecipeListSerializer(serializers.ListSerializer):
+   """Read only list serializer that builds the RecipeSerializer JSON straight from .values() rows"""
+   #A ModelSerializer builds a field tree and runs every field's to_representation for every recipe, plus the nested
+   #serializers for each tag and ingredient. For a big list that dominates the CPU time, so here we skip the model
+   #instances and the field machinery and build the same dicts ourselves. Rows must come from
+   #Recipe.objects.values(*RecipeListSerializer.value_fields)
+
+   price_field = serializers.DecimalField(max_digits=5, decimal_places=2) #Formats price exactly like RecipeSerializer
+
+   def to_representation(self, data):
+      rows = list(data)
+      request = self.context.get('request')
+      user_id = request.user.pk if request else None #The rows are all the request user's
+      fields = self.context.get('fields')
+      if fields is not None:
+         return self._sparse(rows, fields, user_id)
+      tags, ingredients = tags_and_ingredients(rows, user_id)
+      to_price = self.price_field.to_representation
+
+      return [
+         { #Keys are in the same order as RecipeSerializer.Meta.fields so the rendered JSON is identical
+            'id': row['id'],
+            'title': row['title'],
+            'time_minutes': row['time_minutes'],
+            'price': to_price(row['price']),
+            'link': row['link'],
+            'tags': tags.get(row['id'], []),
+            'ingredients': ingredients.get(row['id'], []),
+         } for row in rows
+      ]
+
+   def _sparse(self, rows, fields, user_id):
+      """Build the dicts with only fields, for ?fields= and ?expand="""
+      tags = ingredients = {}
+      if 'tags' in fields or 'ingredients' in fields:
+         tags, ingredients = tags_and_ingredients(rows, user_id)
+      to_price = self.price_field.to_representation
+      values = { #How to get the fields that aren't just the row's column
+         'price': lambda row: to_price(row['price']),
+         'tags': lambda row: tags.get(row['id'], []),
+         'ingredients': lambda row: ingredients.get(row['id'], []),
+      }
+
+      return [
+         {field: values[field](row) if field in values else row[field] for field in fields}
+         for row in rows
+      ]
+
+
+class RecipeListSerializer(RecipeSerializer):
+   """Serializer for the recipe list view, using the fast read path"""
+   #Declares the same fields as RecipeSerializer so the API schema stays the same, but many=True gives a FastRecipeListSerializer
+
+   value_fields = ['id', 'title', 'time_minutes', 'price', 'link', 'snapshot'] #Columns the list queryset needs to .values()
+
+   class Meta(RecipeSerializer.Meta):
+      list_serializer_class = FastRecipeListSerializer
+
+   @classmethod
+   def value_fields_for(cls, fields):
+      """Return the columns the list queryset needs to .values() to render fields, or value_fields when it's None"""
+      if fields is None:
+         return cls.value_fields
+      columns = ['id'] #The pagination cursor and the tags/ingredients lookup need it even when it isn't returned
+      columns += [field for field in fields if field in cls.value_fields and field != 'id']
+      if 'tags' in fields or 'ingredients' in fields:
+         columns.append('snapshot')
+      return columns
+
+
+class SyncDeletedSerializer(serializers.Serializer):
+   """Serializer for the ids of what was deleted since the sync token"""
+   recipes = serializers.ListField(child=serializers.IntegerField())
+   tags = serializers.ListField(child=serializers.IntegerField())
+   ingredients = serializers.ListField(child=serializers.IntegerField())
+
+
+class SyncSerializer(serializers.Serializer):
+   """Serializer for the sync response"""
+   #Only describes the response for the API schema, recipe.sync.sync builds it from .values() rows itself
+
+   since = serializers.CharField(help_text='Sync token to send as ?since= next time')
+   full = serializers.BooleanField(help_text='Replace everything the client has with this instead of merging it in')
+   recipes = RecipeDetailSerializer(many=True)
+   tags = TagSerializer(many=True)
+   ingredients = IngredientSerializer(many=True)
+   deleted = SyncDeletedSerializer()
@@ -0,0 +1,74 @@
+"""
+Signals that keep the response cache and Recipe.updated_at up to date, and publish the change events
+"""
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from core.models import (
+    Recipe,
+    Tag,
+    Ingredient,
+)
+from recipe.cache import bump_version
+from recipe.events import publish_change, publish_changes
+
+RECIPE_FIELDS = {Tag: 'tags', Ingredient: 'ingredients'} #The Recipe field that links to each model
+
+
+def touch_recipes(using, **filters):
+    """Set updated_at of the recipes matching filters on the database using (the user's shard) to now"""
+    #The rows are locked in id order first, so 2 renames of tags that share recipes wait for each other instead of
+    #deadlocking (the same as the search_vector triggers, see migration 0014)
+    recipes = Recipe.objects.using(using)
+    with transaction.atomic(using=using):
+        recipe_ids = recipes.filter(**filters).order_by('pk').select_for_update(of=('self',)).values('pk')
+        recipes.filter(pk__in=recipe_ids).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Recipe)
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Ingredient)
+def user_data_changed(sender, instance, signal, using, created=False, **kwargs):
+    """Drop the users cached responses and publish an event when one of their recipes, tags or ingredients changes"""
+    bump_version(instance.user_id, using)
+    action = 'deleted' if signal is post_delete else 'created' if created else 'updated'
+    publish_change(instance.user_id, sender._meta.model_name, action, instance.pk, using)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Ingredient)
+@receiver(pre_delete, sender=Tag)
+@receiver(pre_delete, sender=Ingredient)
+def recipe_attr_changed(sender, instance, using, created=False, **kwargs):
+    """Update the recipes showing a tag/ingredient when it's renamed, or deleted (which removes it from them)"""
+    #Deleting removes the links with a plain DELETE, which doesn't send m2m_changed, so it's done before the delete
+    if not created:
+        touch_recipes(using, **{RECIPE_FIELDS[sender]: instance})
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+@receiver(m2m_changed, sender=Recipe.ingredients.through)
+def recipe_links_changed(sender, instance, action, reverse, model, pk_set, using, **kwargs):
+    """Update the recipes and drop the users cached responses when tags or ingredients are added or removed"""
+    #When the relation is changed from the tag/ingredient side (reverse), instance is the tag/ingredient and pk_set
+    #holds recipe ids. Both have a user
+    if reverse and action == 'pre_clear': #pk_set is None for a clear, so find the recipes before they're unlinked
+        touch_recipes(using, **{RECIPE_FIELDS[type(instance)]: instance})
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if action != 'post_clear' and not pk_set: #Nothing was added/removed
+        return
+
+    if not reverse:
+        instance.updated_at = timezone.now() #Also on the instance, so the ETag of the response it's used for is right
+        Recipe.objects.using(using).filter(pk=instance.pk).update(updated_at=instance.updated_at)
+        publish_change(instance.user_id, 'recipe', 'updated', instance.pk, using)
+    elif action != 'post_clear':
+        touch_recipes(using, pk__in=pk_set)
+        publish_changes(instance.user_id, 'recipe', 'updated', sorted(pk_set), using)
+    bump_version(instance.user_id, using)
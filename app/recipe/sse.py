@@ -0,0 +1,119 @@
+"""
+Server-sent events feed of a user's recipe, tag and ingredient changes, served over ASGI
+"""
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+from django.conf import settings
+
+from rest_framework import exceptions
+
+from core.async_db import run_db
+from recipe.events import RESET, broker, start_listener
+from user.authentication import CachedTokenAuthentication
+
+EVENTS_PATH = '/api/recipe/events/'
+
+
+class EventStreamRouter:
+    """ASGI app that serves EVENTS_PATH itself and passes every other request on to application"""
+    #Django 3.2 iterates a StreamingHttpResponse synchronously on the event loop, so a feed that waits for events
+    #would block every other request. Here each open feed is just a coroutine waiting on its queue instead, which
+    #keeps thousands of idle clients cheap
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == EVENTS_PATH:
+            return await event_stream(scope, receive, send)
+        return await self.application(scope, receive, send)
+
+
+def format_event(event_id, event_type, data):
+    """Return an event in the text/event-stream format"""
+    lines = [f'id: {event_id}'] if event_id else []
+    lines += [f'event: {event_type}', f'data: {json.dumps(data)}']
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+async def _respond(send, status, detail, headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), *headers],
+    })
+    await send({'type': 'http.response.body', 'body': json.dumps({'detail': detail}).encode()})
+
+
+def _authenticate(authorization):
+    """Return the user for an Authorization: Token header, the same way the REST APIs do"""
+    authentication = CachedTokenAuthentication()
+    keyword, _, key = authorization.decode('latin1').partition(' ')
+    if keyword != authentication.keyword or not key.strip():
+        raise exceptions.NotAuthenticated()
+    user, token = authentication.authenticate_credentials(key.strip())
+    return user
+
+
+async def event_stream(scope, receive, send):
+    """Send the authenticated users change events until they disconnect"""
+    if scope['method'] != 'GET':
+        return await _respond(send, 405, f'Method "{scope["method"]}" not allowed.')
+
+    headers = dict(scope['headers'])
+    try: #A cached token is checked without the database, otherwise this runs on a database thread
+        user = await run_db(_authenticate, headers.get(b'authorization', b''))
+    except exceptions.APIException as error:
+        return await _respond(send, 401, str(error.detail), [(b'www-authenticate', b'Token')])
+
+    #Browsers send the id of the last event they got in Last-Event-ID when they reconnect
+    query = parse_qs(scope.get('query_string', b'').decode())
+    last_event_id = headers.get(b'last-event-id', b'').decode() or query.get('last_event_id', [None])[0]
+    start_listener()
+    subscription = broker.subscribe(user.id, asyncio.get_running_loop(), last_event_id)
+    if subscription is None:
+        return await _respond(send, 503, 'Too many open event streams, try again later.')
+
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'), #Stops nginx buffering the events
+            ],
+        })
+        stream = asyncio.ensure_future(_stream(subscription, send))
+        disconnect = asyncio.ensure_future(_wait_for_disconnect(receive))
+        await asyncio.wait({stream, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        for task in (stream, disconnect):
+            task.cancel()
+        if stream.done() and not stream.cancelled() and stream.exception():
+            raise stream.exception()
+    finally:
+        broker.unsubscribe(subscription)
+
+
+async def _stream(subscription, send):
+    """Send the events of a subscription as they arrive, with a comment every HEARTBEAT seconds to keep it open"""
+    await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+    while True:
+        try:
+            event_id, event_type, data = await asyncio.wait_for(
+                subscription.queue.get(), settings.EVENTS['HEARTBEAT'],
+            )
+        except asyncio.TimeoutError:
+            await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+            continue
+        await send({'type': 'http.response.body', 'body': format_event(event_id, event_type, data), 'more_body': True})
+        if event_type == RESET: #The client has to resync before it can rely on the feed again
+            break
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
@@ -0,0 +1,100 @@
+"""
+Delta sync of a user's recipes, tags and ingredients
+"""
+import base64
+import binascii
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import BooleanField, F, Func
+from django.db.models.expressions import RawSQL
+
+from core.models import (
+    Recipe,
+    Tag,
+    Ingredient,
+    Tombstone,
+)
+from core.sharding import get_placement
+from recipe.exporter import iter_recipes
+from recipe.serializers import RecipeDetailSerializer
+
+#The id of a row changed by a transaction is compared with the snapshot of the database taken at the previous sync.
+#Anything the snapshot couldn't see is new to the client, including transactions that were still running then and
+#committed afterwards with a lower id, which a plain "updated_at > since" would miss
+
+
+class InvalidToken(ValueError):
+    """The since token can't be decoded"""
+
+
+def current_token(using=DEFAULT_DB_ALIAS):
+    """Return a token for the database (the user's shard) as it is now"""
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT txid_current_snapshot()::text')
+        snapshot = cursor.fetchone()[0]
+    return base64.urlsafe_b64encode(f'{int(time.time())}:{snapshot}'.encode()).decode().rstrip('=')
+
+
+def decode_token(token):
+    """Return the (issued at, snapshot) of a token"""
+    try:
+        issued, snapshot = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode().split(':', 1)
+        xmin, xmax, xip = snapshot.split(':')
+        int(xmin), int(xmax), [int(xid) for xid in xip.split(',') if xid]
+        return int(issued), snapshot
+    except (binascii.Error, UnicodeDecodeError, ValueError) as error:
+        raise InvalidToken(str(error))
+
+
+def changed_since(queryset, snapshot):
+    """Filter queryset to the rows changed by transactions the snapshot can't see"""
+    xmin = int(snapshot.split(':')[0]) #Everything before the oldest transaction running then was visible to it
+    return queryset.filter(sync_xid__gte=xmin).annotate(
+        seen=Func(
+            F('sync_xid'),
+            RawSQL('%s::txid_snapshot', (snapshot,)),
+            function='txid_visible_in_snapshot',
+            output_field=BooleanField(),
+        ),
+    ).filter(seen=False)
+
+
+def sync(user, since=None):
+    """Return what changed for user since the token since, or everything when since is None or too old"""
+    #The token is taken before anything is read, so a change committed while we read is returned now and again next
+    #time, but never missed. Clients apply the changes as upserts, so getting one twice is harmless
+    placement = get_placement(user.pk)
+    token = current_token(placement.shard)
+    snapshot = None
+    if since is not None:
+        issued, snapshot = decode_token(since)
+        if issued < time.time() - settings.SYNC_TOKEN_MAX_AGE: #Its tombstones may have been deleted already
+            snapshot = None
+        elif placement.moved_at and issued <= placement.moved_at.timestamp(): #A snapshot of another shard
+            snapshot = None
+
+    recipes = Recipe.objects.filter(user=user).order_by('id')
+    tags = Tag.objects.filter(user=user).order_by('id')
+    ingredients = Ingredient.objects.filter(user=user).order_by('id')
+    deleted = {'recipes': [], 'tags': [], 'ingredients': []}
+    if snapshot is not None:
+        recipes, tags, ingredients = (changed_since(queryset, snapshot) for queryset in (recipes, tags, ingredients))
+        tombstones = changed_since(Tombstone.objects.filter(user=user), snapshot).order_by('object_id')
+        for model, object_id in tombstones.values_list('model', 'object_id'):
+            deleted[model + 's'].append(object_id)
+
+    price = RecipeDetailSerializer().fields['price'] #Prices are formatted the same way as the other recipe APIs
+    recipe_rows = list(iter_recipes(recipes, user_id=user.pk))
+    for row in recipe_rows:
+        row['price'] = price.to_representation(row['price'])
+
+    return {
+        'since': token,
+        'full': snapshot is None, #The client should replace everything it has with this, instead of merging it in
+        'recipes': recipe_rows,
+        'tags': list(tags.values('id', 'name')),
+        'ingredients': list(ingredients.values('id', 'name')),
+        'deleted': deleted,
+    }
@@ -0,0 +1,161 @@
+"""Tests for ETags and conditional requests on the recipe APIs"""
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core.models import (
+    Tag,
+    Ingredient,
+)
+from recipe.tests.test_recipe_api import create_recipe, detail_url
+
+RECIPES_URL = reverse('recipe:recipe-list')
+
+
+class RecipeDetailETagTests(TestCase):
+    """Test ETags on the recipe detail API"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        self.client.force_authenticate(self.user)
+        self.recipe = create_recipe(self.user)
+        self.url = detail_url(self.recipe.id)
+
+    def etag(self):
+        return self.client.get(self.url)['ETag']
+
+    def test_not_modified(self):
+        """Test If-None-Match with the current ETag returns a 304 from 1 small query"""
+        etag = self.etag()
+
+        with self.assertNumQueries(1):
+            res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(res.content, b'')
+        self.assertEqual(res['ETag'], etag)
+
+    def test_weak_and_listed_etags_match(self):
+        """Test If-None-Match uses the weak comparison and accepts a list of ETags"""
+        etag = self.etag()
+
+        res = self.client.get(self.url, HTTP_IF_NONE_MATCH=f'"other", W/{etag}')
+
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_modified(self):
+        """Test an old ETag gets the full recipe and the new ETag"""
+        etag = self.etag()
+        self.client.patch(self.url, {'title': 'New title'})
+
+        res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['title'], 'New title')
+        self.assertNotEqual(res['ETag'], etag)
+
+    def test_etag_changes_with_tags_and_ingredients(self):
+        """Test adding, removing, renaming and deleting tags/ingredients changes the recipes ETag"""
+        tag = Tag.objects.create(user=self.user, name='Dinner')
+        ingredient = Ingredient.objects.create(user=self.user, name='Salt')
+        etags = [self.etag()]
+
+        changes = [
+            lambda: self.recipe.tags.add(tag),
+            lambda: Tag.objects.filter(pk=tag.pk).first().save(), #A rename, from a different instance
+            lambda: ingredient.recipe_set.add(self.recipe), #From the ingredient side of the relation
+            lambda: ingredient.recipe_set.clear(),
+            lambda: self.recipe.tags.remove(tag),
+            lambda: self.recipe.tags.add(tag),
+            lambda: tag.delete(),
+        ]
+        for change in changes:
+            change()
+            etags.append(self.etag())
+
+        self.assertEqual(len(set(etags)), len(etags))
+
+    def test_missing_recipe(self):
+        """Test conditional requests for a missing recipe are a 404"""
+        res = self.client.get(detail_url(0), HTTP_IF_NONE_MATCH='"abc"')
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_update_if_match(self):
+        """Test a PATCH with the current ETag is saved and returns the new ETag"""
+        etag = self.etag()
+
+        res = self.client.patch(self.url, {'title': 'New title'}, HTTP_IF_MATCH=etag)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(res['ETag'], etag)
+        self.assertEqual(res['ETag'], self.etag())
+
+    def test_update_with_tags_returns_current_etag(self):
+        """Test the ETag of an update that changes the tags matches the recipe afterwards"""
+        res = self.client.patch(self.url, {'tags': [{'name': 'Dinner'}]}, format='json', HTTP_IF_MATCH=self.etag())
+
+        self.assertEqual(res['ETag'], self.etag())
+
+    def test_update_if_match_stale(self):
+        """Test a PUT/PATCH with an old ETag is rejected and doesn't change the recipe"""
+        etag = self.etag()
+        self.client.patch(self.url, {'title': 'Changed by someone else'})
+        payload = {'title': 'Lost update', 'time_minutes': 5, 'price': '1.00'}
+
+        put = self.client.put(self.url, payload, HTTP_IF_MATCH=etag)
+        patch = self.client.patch(self.url, {'title': 'Lost update'}, HTTP_IF_MATCH=etag)
+
+        self.assertEqual(put.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(patch.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.title, 'Changed by someone else')
+
+    def test_update_if_match_weak_or_any(self):
+        """Test If-Match never matches a weak ETag, and * matches any"""
+        etag = self.etag()
+
+        weak = self.client.patch(self.url, {'title': 'Weak'}, HTTP_IF_MATCH=f'W/{etag}')
+        any_etag = self.client.patch(self.url, {'title': 'Any'}, HTTP_IF_MATCH='*')
+
+        self.assertEqual(weak.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(any_etag.status_code, status.HTTP_200_OK)
+
+
+@override_settings(RESPONSE_CACHE={'CACHE': 'default', 'TTL': 300, 'SINGLE_PROCESS': True})
+class RecipeListETagTests(TestCase):
+    """Test ETags on the recipe list API"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        self.client.force_authenticate(self.user)
+        create_recipe(self.user)
+
+    def test_not_modified_without_queries(self):
+        """Test If-None-Match with the current ETag returns a 304 without touching the database"""
+        etag = self.client.get(RECIPES_URL)['ETag']
+
+        with self.assertNumQueries(0):
+            res = self.client.get(RECIPES_URL, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(res.content, b'')
+
+    def test_etag_changes_with_data_and_params(self):
+        """Test the ETag is different for other query params and after a change"""
+        etag = self.client.get(RECIPES_URL)['ETag']
+
+        self.assertNotEqual(self.client.get(RECIPES_URL, {'page_size': 1})['ETag'], etag)
+
+        create_recipe(self.user)
+        res = self.client.get(RECIPES_URL, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(res.data['results']), 2)
+        self.assertNotEqual(res['ETag'], etag)
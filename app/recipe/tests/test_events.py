@@ -0,0 +1,294 @@
+"""Tests for the change events and their server-sent events feed"""
+
+import asyncio
+import json
+from unittest.mock import patch
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from rest_framework.authtoken.models import Token
+
+from core.models import Recipe, Tag
+from recipe import events, sse
+from recipe.events import RESET, Broker
+
+
+def parse_events(body):
+    """Return the (id, event, data) of every event in a text/event-stream body"""
+    parsed = []
+    for block in body.decode().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines() if not line.startswith(':') and ': ' in line)
+        if 'event' in fields:
+            parsed.append((fields.get('id'), fields['event'], json.loads(fields['data'])))
+    return parsed
+
+
+class BrokerTests(TestCase):
+    """Test the in-process event broker"""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def drain(self, subscription):
+        self.loop.run_until_complete(asyncio.sleep(0)) #Runs the pushes scheduled with call_soon_threadsafe
+        events = []
+        while not subscription.queue.empty():
+            events.append(subscription.queue.get_nowait())
+        return events
+
+    def test_publish_to_user(self):
+        """Test events only go to the subscriptions of their user"""
+        broker = Broker()
+        mine, theirs = broker.subscribe(1, self.loop), broker.subscribe(2, self.loop)
+
+        broker.publish(1, 'recipe.created', {'id': 5})
+
+        self.assertEqual(self.drain(mine), [(f'{broker.boot}-1', 'recipe.created', {'id': 5})])
+        self.assertEqual(self.drain(theirs), [])
+
+    def test_unsubscribe(self):
+        """Test an unsubscribed subscription gets no more events"""
+        broker = Broker()
+        subscription = broker.subscribe(1, self.loop)
+        broker.unsubscribe(subscription)
+
+        broker.publish(1, 'recipe.created', {'id': 5})
+
+        self.assertEqual(self.drain(subscription), [])
+        self.assertEqual(len(broker), 0)
+
+    @override_settings(EVENTS={'QUEUE_SIZE': 2, 'BUFFER_SIZE': 10, 'MAX_CONNECTIONS': 10})
+    def test_slow_subscriber_reset(self):
+        """Test a subscriber that falls behind gets a reset instead of an unbounded queue"""
+        broker = Broker()
+        subscription = broker.subscribe(1, self.loop)
+
+        for i in range(5):
+            broker.publish(1, 'recipe.updated', {'id': i})
+
+        self.assertEqual(self.drain(subscription), [(None, RESET, {})])
+
+    def test_reconnect_with_last_event_id(self):
+        """Test a reconnecting subscriber gets the events after its Last-Event-ID"""
+        broker = Broker()
+        broker.publish(1, 'recipe.created', {'id': 1})
+        broker.publish(2, 'recipe.created', {'id': 2})
+        broker.publish(1, 'recipe.updated', {'id': 1})
+
+        subscription = broker.subscribe(1, self.loop, last_event_id=f'{broker.boot}-1')
+
+        self.assertEqual(self.drain(subscription), [(f'{broker.boot}-3', 'recipe.updated', {'id': 1})])
+
+    @override_settings(EVENTS={'QUEUE_SIZE': 10, 'BUFFER_SIZE': 2, 'MAX_CONNECTIONS': 10})
+    def test_reconnect_too_late(self):
+        """Test a reconnect after its events were dropped, or to another process, gets a reset"""
+        broker = Broker()
+        for i in range(5):
+            broker.publish(1, 'recipe.updated', {'id': i})
+
+        evicted = broker.subscribe(1, self.loop, last_event_id=f'{broker.boot}-1')
+        other_process = broker.subscribe(1, self.loop, last_event_id='abcdef12-4')
+
+        self.assertEqual(self.drain(evicted), [(None, RESET, {})])
+        self.assertEqual(self.drain(other_process), [(None, RESET, {})])
+
+    @override_settings(EVENTS={'QUEUE_SIZE': 10, 'BUFFER_SIZE': 10, 'MAX_CONNECTIONS': 1})
+    def test_max_connections(self):
+        """Test subscribing fails when MAX_CONNECTIONS are open"""
+        broker = Broker()
+        broker.subscribe(1, self.loop)
+
+        self.assertIsNone(broker.subscribe(2, self.loop))
+
+
+@override_settings(EVENTS={**settings.EVENTS, 'PG_NOTIFY': False}) #Published in this process
+class PublishChangeTests(TestCase):
+    """Test changes are published once they're committed"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        patcher = patch.object(events.broker, 'publish')
+        self.publish = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_create_update_delete(self):
+        """Test saving and deleting a recipe publishes events"""
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe = Recipe.objects.create(user=self.user, title='Soup', time_minutes=5, price=1)
+            recipe_id = recipe.id
+            recipe.title = 'Stew'
+            recipe.save()
+            recipe.delete()
+
+        self.assertEqual([call.args for call in self.publish.call_args_list], [
+            (self.user.id, 'recipe.created', {'id': recipe_id}),
+            (self.user.id, 'recipe.updated', {'id': recipe_id}),
+            (self.user.id, 'recipe.deleted', {'id': recipe_id}),
+        ])
+
+    def test_tags_added(self):
+        """Test linking a tag to a recipe publishes a recipe update"""
+        recipe = Recipe.objects.create(user=self.user, title='Soup', time_minutes=5, price=1)
+        tag = Tag.objects.create(user=self.user, name='Dinner')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe.tags.add(tag)
+
+        self.publish.assert_called_once_with(self.user.id, 'recipe.updated', {'id': recipe.id})
+
+    def test_published_on_commit(self):
+        """Test nothing is published before the change is committed"""
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            tag = Tag.objects.create(user=self.user, name='Dinner')
+
+        self.publish.assert_not_called()
+        for callback in callbacks:
+            callback()
+        self.publish.assert_called_once_with(self.user.id, 'tag.created', {'id': tag.id})
+
+
+@override_settings(ASYNC_DB_THREADS=0) #0 keeps the queries inside the test transaction
+class EventStreamTests(TestCase):
+    """Test the server-sent events feed"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        self.token = Token.objects.create(user=self.user)
+        self.broker = Broker()
+        patcher = patch.object(sse, 'broker', self.broker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def scope(self, method='GET', headers=(), query_string=b''):
+        return {
+            'type': 'http',
+            'method': method,
+            'path': sse.EVENTS_PATH,
+            'query_string': query_string,
+            'headers': [*headers],
+        }
+
+    def auth(self):
+        return (b'authorization', f'Token {self.token.key}'.encode())
+
+    async def open(self, scope):
+        """Start a feed, returning its task, the sent messages and a queue for received messages"""
+        received, sent = asyncio.Queue(), []
+
+        async def send(message):
+            sent.append(message)
+
+        task = asyncio.ensure_future(sse.EventStreamRouter(None)(scope, received.get, send))
+        for _ in range(100): #Until it has subscribed and sent the first bytes
+            if task.done() or len(sent) >= 2:
+                break
+            await asyncio.sleep(0.01)
+        return task, sent, received
+
+    def body(self, sent):
+        return b''.join(message.get('body', b'') for message in sent if message['type'] == 'http.response.body')
+
+    async def test_auth_required(self):
+        """Test the feed needs a valid token"""
+        for headers in ([], [(b'authorization', b'Token wrong')]):
+            task, sent, _ = await self.open(self.scope(headers=headers))
+            await task
+
+            self.assertEqual(sent[0]['status'], 401)
+
+    async def test_streams_events(self):
+        """Test the users events are streamed until they disconnect"""
+        task, sent, received = await self.open(self.scope(headers=[self.auth()]))
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), sent[0]['headers'])
+
+        self.broker.publish(self.user.id, 'recipe.created', {'id': 7})
+        self.broker.publish(self.user.id + 1, 'recipe.created', {'id': 8})
+        await asyncio.sleep(0.05)
+        await received.put({'type': 'http.disconnect'})
+        await asyncio.wait_for(task, 1)
+
+        self.assertEqual(parse_events(self.body(sent)), [(f'{self.broker.boot}-1', 'recipe.created', {'id': 7})])
+        self.assertEqual(len(self.broker), 0)
+
+    async def test_heartbeat(self):
+        """Test a comment is sent when there are no events, to keep the connection open"""
+        with self.settings(EVENTS={**sse.settings.EVENTS, 'HEARTBEAT': 0.01}):
+            task, sent, received = await self.open(self.scope(headers=[self.auth()]))
+            await asyncio.sleep(0.05)
+            await received.put({'type': 'http.disconnect'})
+            await asyncio.wait_for(task, 1)
+
+        self.assertIn(b': ping\n\n', self.body(sent))
+
+    async def test_last_event_id(self):
+        """Test a reconnect gets the events it missed, and a reset ends the stream"""
+        self.broker.publish(self.user.id, 'recipe.created', {'id': 1})
+        self.broker.publish(self.user.id, 'recipe.updated', {'id': 1})
+        last_event_id = f'{self.broker.boot}-1'.encode()
+
+        task, sent, received = await self.open(self.scope(headers=[self.auth(), (b'last-event-id', last_event_id)]))
+        await received.put({'type': 'http.disconnect'})
+        await asyncio.wait_for(task, 1)
+        self.assertEqual(parse_events(self.body(sent)), [(f'{self.broker.boot}-2', 'recipe.updated', {'id': 1})])
+
+        task, sent, _ = await self.open(self.scope(headers=[self.auth()], query_string=b'last_event_id=stale-1'))
+        await asyncio.wait_for(task, 1) #Ends without a disconnect
+
+        self.assertEqual(parse_events(self.body(sent)), [(None, RESET, {})])
+        self.assertFalse(sent[-1]['more_body'])
+
+    async def test_too_many_connections(self):
+        """Test the feed is refused when MAX_CONNECTIONS are open"""
+        with self.settings(EVENTS={**sse.settings.EVENTS, 'MAX_CONNECTIONS': 0}):
+            task, sent, _ = await self.open(self.scope(headers=[self.auth()]))
+            await task
+
+        self.assertEqual(sent[0]['status'], 503)
+
+    async def test_other_paths_passed_on(self):
+        """Test requests for other paths go to the wrapped application"""
+        calls = []
+
+        async def application(scope, receive, send):
+            calls.append(scope['path'])
+
+        await sse.EventStreamRouter(application)({'type': 'http', 'path': '/api/recipe/recipes/'}, None, None)
+
+        self.assertEqual(calls, ['/api/recipe/recipes/'])
+
+
+@override_settings(EVENTS={'HEARTBEAT': 15, 'QUEUE_SIZE': 10, 'BUFFER_SIZE': 10, 'MAX_CONNECTIONS': 10, 'PG_NOTIFY': True})
+class PgNotifyTests(TransactionTestCase):
+    """Test events sent through Postgres NOTIFY reach the broker of every process"""
+
+    def test_notify_reaches_broker(self):
+        """Test a committed change is delivered by the listener thread"""
+        user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        subscription = events.broker.subscribe(user.id, loop)
+        self.addCleanup(events.broker.unsubscribe, subscription)
+        events.start_listener()
+        self.addCleanup(events.stop_listener)
+
+        for i in range(20): #The listener may only have started LISTENing after the first notifications
+            Tag.objects.create(user=user, name=f'Tag {i}')
+            try:
+                event_id, event_type, data = loop.run_until_complete(asyncio.wait_for(subscription.queue.get(), 0.5))
+                break
+            except asyncio.TimeoutError:
+                pass
+        else:
+            self.fail('No event was delivered')
+
+        self.assertEqual(event_type, 'tag.created')
+        self.assertTrue(Tag.objects.filter(pk=data['id']).exists())
+
+    def test_notify_several_in_one_query(self):
+        """Test the same change to several objects is sent with 1 query"""
+        with self.assertNumQueries(1):
+            events.publish_changes(1, 'recipe', 'updated', [1, 2, 3])
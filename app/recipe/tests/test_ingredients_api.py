@@ -1,5 +1,7 @@
 """Tests for the ingredients API"""
 
+from decimal import Decimal
+
 from django.contrib.auth import get_user_model
 from django.test import TestCase
 from django.urls import reverse
@@ -8,7 +10,8 @@ from rest_framework import status
 from rest_framework.test import APIClient
 
 from core.models import (
-    Ingredient
+    Ingredient,
+    Recipe,
 )
 from recipe.serializers import (
     IngredientSerializer,
@@ -61,7 +64,7 @@ class PrivateRecipeAPITests(TestCase):
         serializer = IngredientSerializer(ingredients, many=True)
 
         self.assertEqual(res.status_code, status.HTTP_200_OK)
-        self.assertEqual(res.data, serializer.data)
+        self.assertEqual(res.data['results'], serializer.data)
 
     def test_ingredients_limited_to_user(self):
         """Test list of ingredients is limited to authenticated user"""
@@ -74,9 +77,9 @@ class PrivateRecipeAPITests(TestCase):
         res = self.client.get(INGREDIENTS_URL)
 
         self.assertEqual(res.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(res.data), 1) 
-        self.assertEqual(res.data[0]['name'], ingredient.name) 
-        self.assertEqual(res.data[0]['id'], ingredient.id) 
+        self.assertEqual(len(res.data['results']), 1) 
+        self.assertEqual(res.data['results'][0]['name'], ingredient.name) 
+        self.assertEqual(res.data['results'][0]['id'], ingredient.id) 
 
     
     def test_update_ingredient(self):
@@ -104,4 +107,69 @@ class PrivateRecipeAPITests(TestCase):
         ingredients = Ingredient.objects.filter(user=self.user)
         self.assertFalse(ingredients.exists())
 
+    def test_filter_assigned_only(self):
+        """Test listing only ingredients that are assigned to recipes"""
+        used = Ingredient.objects.create(user = self.user, name='Used')
+        Ingredient.objects.create(user = self.user, name='Unused')
+        recipe = Recipe.objects.create(
+            user = self.user, title='Toast', time_minutes=5, price=Decimal('1.00'),
+        )
+        recipe.ingredients.add(used)
+
+        res = self.client.get(INGREDIENTS_URL, {'assigned_only': 1})
+
+        self.assertEqual([ingredient['id'] for ingredient in res.data['results']], [used.id])
+
+    def test_assigned_only_no_duplicates(self):
+        """Test ingredients used by several recipes are only listed once"""
+        ingredient = Ingredient.objects.create(user = self.user, name='Popular')
+        for i in range(3):
+            recipe = Recipe.objects.create(
+                user = self.user, title=f'Recipe {i}', time_minutes=5, price=Decimal('1.00'),
+            )
+            recipe.ingredients.add(ingredient)
+
+        res = self.client.get(INGREDIENTS_URL, {'assigned_only': 1})
+
+        self.assertEqual(len(res.data['results']), 1)
+
+    def test_recipe_count(self):
+        """Test recipe_count=1 adds how many recipes use each ingredient, in 1 query"""
+        used = Ingredient.objects.create(user = self.user, name='Used')
+        unused = Ingredient.objects.create(user = self.user, name='Unused')
+        for i in range(2):
+            recipe = Recipe.objects.create(
+                user = self.user, title=f'Recipe {i}', time_minutes=5, price=Decimal('1.00'),
+            )
+            recipe.ingredients.add(used)
+
+        with self.assertNumQueries(1):
+            res = self.client.get(INGREDIENTS_URL, {'recipe_count': 1})
+        self.assertEqual(res.data['results'], [
+            {'id': used.id, 'name': 'Used', 'recipe_count': 2},
+            {'id': unused.id, 'name': 'Unused', 'recipe_count': 0},
+        ])
+
+        res = self.client.get(INGREDIENTS_URL, {'recipe_count': 1, 'assigned_only': 1})
+        self.assertEqual([ingredient['id'] for ingredient in res.data['results']], [used.id])
+
+    def test_recipe_count_query_budget(self):
+        """Test 5000 ingredients with counts are listed in a single query"""
+        ingredients = Ingredient.objects.bulk_create([Ingredient(user = self.user, name=f'Ingredient {i}') for i in range(5000)])
+        recipe = Recipe.objects.create(
+            user = self.user, title='Everything', time_minutes=5, price=Decimal('1.00'),
+        )
+        recipe.ingredients.add(*ingredients)
+
+        with self.assertNumQueries(1):
+            res = self.client.get(INGREDIENTS_URL, {'recipe_count': 1, 'assigned_only': 1, 'page_size': 1000})
+
+        self.assertEqual(len(res.data['results']), 1000)
+        self.assertTrue(all(ingredient['recipe_count'] == 1 for ingredient in res.data['results']))
+
+    def test_invalid_flag_error(self):
+        """Test assigned_only must be 0 or 1"""
+        res = self.client.get(INGREDIENTS_URL, {'assigned_only': 'yes'})
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
 
@@ -1,9 +1,13 @@
 """Tests for recipe APIs"""
 
+from base64 import b64encode
 from decimal import Decimal
+from unittest.mock import patch
 
 from django.contrib.auth import get_user_model
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from rest_framework import status
@@ -14,6 +18,7 @@ from core.models import (
     Tag,
     Ingredient
 )
+from recipe.pagination import RecipeCursorPagination
 from recipe.serializers import (
     RecipeSerializer,
     RecipeDetailSerializer,
@@ -79,7 +84,7 @@ class PrivateRecipeAPITests(TestCase):
         serializer = RecipeSerializer(recipes, many=True) # We using serializer in our tests because this is how we are going to compare the expected response from the API
         #NB: Serializers can either return a detail which is one item, or a list of items -> many=True says we want to pass in a list of items
         self.assertEqual(res.status_code, status.HTTP_200_OK)
-        self.assertEqual(res.data, serializer.data) #res.data -> data dictionary returned from the response
+        self.assertEqual(res.data['results'], serializer.data) #res.data -> data dictionary returned from the response
                                                     #serializer.data -> data dictionary of the objs passed through serializer
         
     def test_recipes_list_limited_to_user(self):
@@ -95,7 +100,7 @@ class PrivateRecipeAPITests(TestCase):
         recipes = Recipe.objects.filter(user = self.user)
         serializer = RecipeSerializer(recipes, many=True) 
         self.assertEqual(res.status_code, status.HTTP_200_OK)
-        self.assertEqual(res.data, serializer.data) #res.data -> data dictionary returned from the response
+        self.assertEqual(res.data['results'], serializer.data) #res.data -> data dictionary returned from the response
                                                     #serializer.data -> data dictionary of the objs passed through serializer
         
     def test_get_recipe_detail(self):
@@ -312,7 +317,7 @@ class PrivateRecipeAPITests(TestCase):
             'title': 'Cauliflower Tacos',
             'time_minutes': 60,
             'price': Decimal('4.30'),
-            'ingredients': [{'name': 'Cauliflower'}, {'name', 'salt'}],
+            'ingredients': [{'name': 'Cauliflower'}, {'name': 'salt'}],
         }
         res = self.client.post(RECIPES_URL, payload, format='json')
         
@@ -359,3 +364,382 @@ class PrivateRecipeAPITests(TestCase):
             ).exists()
             self.assertTrue(exists)
 
+
+    def test_update_recipe_ingredients(self):
+        """Test replacing a recipes ingredients when updating"""
+
+        salt = Ingredient.objects.create(user=self.user, name='Salt')
+        recipe = create_recipe(user=self.user)
+        recipe.ingredients.add(salt)
+
+        payload = {'ingredients': [{'name': 'Pepper'}, {'name': 'Pepper'}]}
+        url = detail_url(recipe.id)
+        res = self.client.patch(url, payload, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        pepper = Ingredient.objects.get(user=self.user, name='Pepper')
+        self.assertEqual(list(recipe.ingredients.all()), [pepper])
+
+    def test_create_recipe_query_count_is_constant(self):
+        """Test creating a recipe with 3 or 30 tags and ingredients uses the same number of queries"""
+        Tag.objects.create(user=self.user, name='Tag 0')
+        Ingredient.objects.create(user=self.user, name='Ingredient 0')
+
+        query_counts = []
+        for count in [3, 30]:
+            payload = {
+                'title': 'Big recipe',
+                'time_minutes': 30,
+                'price': Decimal('2.50'),
+                'tags': [{'name': f'Tag {i}'} for i in range(count)],
+                'ingredients': [{'name': f'Ingredient {i}'} for i in range(count)],
+            }
+            with CaptureQueriesContext(connection) as queries:
+                res = self.client.post(RECIPES_URL, payload, format='json')
+
+            self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+            recipe = Recipe.objects.get(id=res.data['id'])
+            self.assertEqual(recipe.tags.count(), count)
+            self.assertEqual(recipe.ingredients.count(), count)
+            query_counts.append(len(queries))
+
+        self.assertEqual(query_counts[0], query_counts[1])
+
+
+class RecipePaginationTests(TestCase):
+    """Test cursor pagination of the recipe list"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user(email = 'user@example.com', password = 'testpass123')
+        self.client.force_authenticate(self.user)
+
+    def test_paginate_recipes_with_cursor(self):
+        """Test following the next cursor returns every recipe once, newest first"""
+        recipes = [create_recipe(user=self.user, title=f'Recipe {i}') for i in range(5)]
+
+        ids = []
+        url = RECIPES_URL
+        params = {'page_size': 2}
+        while url:
+            res = self.client.get(url, params)
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(res.data['results']), 2)
+            ids += [recipe['id'] for recipe in res.data['results']]
+            url, params = res.data['next'], None #The next url already has the cursor and page_size in it
+
+        self.assertEqual(ids, [recipe.id for recipe in reversed(recipes)])
+
+    def test_page_size_limited_to_max(self):
+        """Test asking for more than the max page size is capped"""
+        for i in range(3):
+            create_recipe(user=self.user)
+
+        with patch.object(RecipeCursorPagination, 'max_page_size', 2):
+            res = self.client.get(RECIPES_URL, {'page_size': 50})
+
+        self.assertEqual(len(res.data['results']), 2)
+        self.assertIsNotNone(res.data['next'])
+        self.assertIsNone(res.data['previous'])
+
+
+class RecipeFilterTests(TestCase):
+    """Test filtering recipes by tags and ingredients"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user(email = 'user@example.com', password = 'testpass123')
+        self.client.force_authenticate(self.user)
+
+        self.vegan = Tag.objects.create(user=self.user, name='Vegan')
+        self.dinner = Tag.objects.create(user=self.user, name='Dinner')
+        self.rice = Ingredient.objects.create(user=self.user, name='Rice')
+        self.both = create_recipe(user=self.user, title='Vegan dinner')
+        self.both.tags.add(self.vegan, self.dinner)
+        self.both.ingredients.add(self.rice)
+        self.vegan_only = create_recipe(user=self.user, title='Vegan lunch')
+        self.vegan_only.tags.add(self.vegan)
+        self.untagged = create_recipe(user=self.user, title='Plain')
+
+    def filter(self, **params):
+        """Return the ids of the recipes listed for params"""
+        res = self.client.get(RECIPES_URL, params)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return [recipe['id'] for recipe in res.data['results']]
+
+    def test_filter_by_any_tag(self):
+        """Test recipes with any of the tags are returned once each"""
+        ids = self.filter(tags=f'{self.vegan.id},{self.dinner.id}')
+
+        self.assertEqual(ids, [self.vegan_only.id, self.both.id])
+
+    def test_filter_by_all_tags(self):
+        """Test match=all only returns recipes with every tag"""
+        ids = self.filter(tags=f'{self.vegan.id},{self.dinner.id}', match='all')
+
+        self.assertEqual(ids, [self.both.id])
+
+    def test_filter_by_tags_and_ingredients(self):
+        """Test tag and ingredient filters are combined"""
+        self.assertEqual(self.filter(ingredients=str(self.rice.id)), [self.both.id])
+        self.assertEqual(self.filter(tags=str(self.vegan.id), ingredients=str(self.rice.id)), [self.both.id])
+
+    def test_filter_limited_to_user(self):
+        """Test another users recipes with the same tag aren't returned"""
+        other_recipe = create_recipe(user=create_user(email='other@example.com', password='test123'))
+        other_recipe.tags.add(self.vegan)
+
+        self.assertNotIn(other_recipe.id, self.filter(tags=str(self.vegan.id)))
+
+    def test_filter_invalid_params_error(self):
+        """Test non numeric ids or an unknown match mode are rejected"""
+        for params in [{'tags': 'vegan'}, {'tags': '1', 'match': 'most'}]:
+            res = self.client.get(RECIPES_URL, params)
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_filter_query_count(self):
+        """Test filtering doesn't add queries"""
+        with self.assertNumQueries(1):
+            self.client.get(RECIPES_URL, {'tags': f'{self.vegan.id},{self.dinner.id}', 'match': 'all'})
+
+
+class RecipeSearchTests(TestCase):
+    """Test full text search of recipes with ?q="""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user(email = 'user@example.com', password = 'testpass123')
+        self.client.force_authenticate(self.user)
+
+    def search(self, q, **params):
+        """Return the ids of the recipes found for q"""
+        res = self.client.get(RECIPES_URL, {'q': q, **params})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return [recipe['id'] for recipe in res.data['results']]
+
+    def test_search_title_description_tags_and_ingredients(self):
+        """Test recipes are found by title, description, tag names and ingredient names"""
+        curry = create_recipe(user=self.user, title='Thai prawn curry', description='Spicy')
+        soup = create_recipe(user=self.user, title='Soup', description='Warming winter soup')
+        soup.tags.add(Tag.objects.create(user=self.user, name='Vegan'))
+        soup.ingredients.add(Ingredient.objects.create(user=self.user, name='Lentils'))
+        create_recipe(user=create_user(email='other@example.com', password='test123'), title='Thai curry')
+
+        self.assertEqual(self.search('curry'), [curry.id])
+        self.assertEqual(self.search('spicy'), [curry.id])
+        self.assertEqual(self.search('vegan'), [soup.id])
+        self.assertEqual(self.search('lentil'), [soup.id]) #Stemmed, so lentil matches Lentils
+        self.assertEqual(self.search('thai -prawn'), [])
+
+    def test_search_ranks_title_first(self):
+        """Test a match in the title ranks above a match in the description"""
+        in_description = create_recipe(user=self.user, title='Dinner', description='Goes well with rice')
+        in_title = create_recipe(user=self.user, title='Fried rice', description='Quick')
+        self.assertEqual(self.search('rice'), [in_title.id, in_description.id])
+
+    def test_search_updates_with_tags_and_ingredients(self):
+        """Test the search stays up to date when tags and ingredients change"""
+        recipe = create_recipe(user=self.user, title='Pancakes')
+        tag = Tag.objects.create(user=self.user, name='Breakfast')
+        recipe.tags.add(tag)
+        self.assertEqual(self.search('breakfast'), [recipe.id])
+
+        tag.name = 'Brunch'
+        tag.save()
+        self.assertEqual(self.search('breakfast'), [])
+        self.assertEqual(self.search('brunch'), [recipe.id])
+
+        recipe.tags.remove(tag)
+        self.assertEqual(self.search('brunch'), [])
+
+        payload = {'title': 'Crepes', 'ingredients': [{'name': 'Flour'}]}
+        self.client.patch(detail_url(recipe.id), payload, format='json')
+        self.assertEqual(self.search('pancakes'), [])
+        self.assertEqual(self.search('crepes flour'), [recipe.id])
+
+    def test_search_paginates_by_rank(self):
+        """Test following the cursor through search results returns every match once"""
+        recipes = [
+            create_recipe(user=self.user, title='Rice' if i % 2 else 'Dinner', description=f'Rice {i}')
+            for i in range(7)
+        ]
+
+        ids = []
+        res = self.client.get(RECIPES_URL, {'q': 'rice', 'page_size': 2})
+        while True:
+            ids += [recipe['id'] for recipe in res.data['results']]
+            if not res.data['next']:
+                break
+            res = self.client.get(res.data['next'])
+
+        self.assertEqual(len(ids), 7)
+        self.assertEqual(set(ids), {recipe.id for recipe in recipes})
+        self.assertEqual(ids[:3], [recipe.id for recipe in reversed(recipes) if recipe.title == 'Rice'])
+
+    @patch.object(RecipeCursorPagination, 'offset_cutoff', 3)
+    def test_search_paginates_equal_ranks(self):
+        """Test paging through more matches with the same rank than fit on a page, or are skipped by an offset"""
+        recipes = [create_recipe(user=self.user, title='Chicken soup') for _ in range(12)]
+
+        ids = []
+        res = self.client.get(RECIPES_URL, {'q': 'chicken', 'page_size': 5})
+        for _ in range(len(recipes)): #Stops a cursor that never reaches the end
+            ids += [recipe['id'] for recipe in res.data['results']]
+            if not res.data['next']:
+                break
+            res = self.client.get(res.data['next'])
+
+        self.assertEqual(ids, [recipe.id for recipe in reversed(recipes)])
+
+        res = self.client.get(res.data['previous'])
+        self.assertEqual([recipe['id'] for recipe in res.data['results']], ids[5:10])
+
+    def test_search_invalid_cursor(self):
+        """Test a search cursor whose position isn't a (rank, id) returns 404"""
+        create_recipe(user=self.user, title='Chicken soup')
+        cursor = b64encode(b'p=soup').decode()
+
+        res = self.client.get(RECIPES_URL, {'q': 'chicken', 'cursor': cursor})
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class RecipeQueryBudgetTests(TestCase):
+    """Test the recipe APIs run a constant number of queries"""
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def _seed_recipes(self, count):
+        """Create a user with count recipes, each with a tag and an ingredient"""
+        user = create_user(email = f'user{count}@example.com', password = 'testpass123')
+        tag = Tag.objects.create(user=user, name='Dinner')
+        ingredient = Ingredient.objects.create(user=user, name='Salt')
+        recipes = Recipe.objects.bulk_create([ #bulk_create keeps seeding 1000 recipes fast
+            Recipe(
+                user = user,
+                title = f'Recipe {i}',
+                time_minutes = 10,
+                price = Decimal('5.00'),
+            ) for i in range(count)
+        ])
+        Recipe.tags.through.objects.bulk_create([
+            Recipe.tags.through(recipe_id=recipe.id, tag_id=tag.id) for recipe in recipes
+        ])
+        Recipe.ingredients.through.objects.bulk_create([
+            Recipe.ingredients.through(recipe_id=recipe.id, ingredient_id=ingredient.id)
+            for recipe in recipes
+        ])
+        self.client.force_authenticate(user)
+
+        return recipes
+
+    def test_list_recipes_query_count_is_constant(self):
+        """Test listing recipes uses the same number of queries for 10, 100 and 1000 recipes"""
+        for count in [10, 100, 1000]:
+            with self.subTest(count=count):
+                self._seed_recipes(count)
+
+                with self.assertNumQueries(1): #The tags and ingredients come from the recipes' snapshots
+                    res = self.client.get(RECIPES_URL, {'page_size': count})
+
+                self.assertEqual(res.status_code, status.HTTP_200_OK)
+                self.assertEqual(len(res.data['results']), count)
+                self.assertEqual(res.data['results'][0]['tags'][0]['name'], 'Dinner')
+                self.assertEqual(res.data['results'][0]['ingredients'][0]['name'], 'Salt')
+
+    def test_recipe_detail_query_count_is_constant(self):
+        """Test retrieving a recipe uses the same number of queries regardless of recipe count"""
+        for count in [10, 100, 1000]:
+            with self.subTest(count=count):
+                recipes = self._seed_recipes(count)
+
+                with self.assertNumQueries(3):
+                    res = self.client.get(detail_url(recipes[0].id))
+
+                self.assertEqual(res.status_code, status.HTTP_200_OK)
+                self.assertEqual(len(res.data['tags']), 1)
+                self.assertEqual(len(res.data['ingredients']), 1)
+
+
+class RecipeSparseFieldsTests(TestCase):
+    """Test trimming the recipe responses with ?fields= and ?expand="""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user(email = 'user@example.com', password = 'testpass123')
+        self.client.force_authenticate(self.user)
+        self.recipe = create_recipe(user=self.user, title='Thai Curry')
+        self.recipe.tags.add(Tag.objects.create(user=self.user, name='Dinner'))
+        self.recipe.ingredients.add(Ingredient.objects.create(user=self.user, name='Coconut'))
+
+    def test_list_fields(self):
+        """Test the list only returns and selects the fields asked for"""
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(RECIPES_URL, {'fields': 'id,title,price'})
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.json()['results'], [{'id': self.recipe.id, 'title': 'Thai Curry', 'price': '5.25'}])
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('snapshot', queries[0]['sql'])
+        self.assertNotIn('link', queries[0]['sql'])
+
+    def test_list_expand(self):
+        """Test ?expand= adds nested fields, to every other field on its own or to ?fields="""
+        res = self.client.get(RECIPES_URL, {'expand': 'tags'})
+        self.assertEqual(list(res.data['results'][0]), ['id', 'title', 'time_minutes', 'price', 'link', 'tags'])
+        self.assertEqual(res.data['results'][0]['tags'][0]['name'], 'Dinner')
+
+        res = self.client.get(RECIPES_URL, {'fields': 'title', 'expand': 'ingredients'})
+        self.assertEqual(res.json()['results'], [{'title': 'Thai Curry', 'ingredients': [
+            {'id': self.recipe.ingredients.get().id, 'name': 'Coconut'},
+        ]}])
+
+    def test_list_fields_paginate(self):
+        """Test the cursor pagination works when the id isn't returned"""
+        create_recipe(user=self.user, title='Green Soup')
+
+        res = self.client.get(RECIPES_URL, {'fields': 'title', 'page_size': 1})
+        next_page = self.client.get(res.data['next'])
+
+        self.assertEqual(res.data['results'], [{'title': 'Green Soup'}])
+        self.assertEqual(next_page.data['results'], [{'title': 'Thai Curry'}])
+
+    def test_detail_fields(self):
+        """Test the detail only loads the fields asked for, without the prefetch, and has its own ETag"""
+        full = self.client.get(detail_url(self.recipe.id))
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(detail_url(self.recipe.id), {'fields': 'title,description'})
+
+        self.assertEqual(res.json(), {'title': 'Thai Curry', 'description': 'Sample description'})
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('link', queries[0]['sql'])
+        self.assertNotEqual(res['ETag'], full['ETag'])
+        res = self.client.get(
+            detail_url(self.recipe.id), {'fields': 'title,description'}, HTTP_IF_NONE_MATCH=res['ETag'],
+        )
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_detail_expand(self):
+        """Test the detail only prefetches the nested fields asked for"""
+        with self.assertNumQueries(2):
+            res = self.client.get(detail_url(self.recipe.id), {'fields': 'id', 'expand': 'tags'})
+
+        self.assertEqual(res.json(), {'id': self.recipe.id, 'tags': [
+            {'id': self.recipe.tags.get().id, 'name': 'Dinner'},
+        ]})
+
+    def test_unknown_fields_error(self):
+        """Test unknown fields, fields that can't be expanded and empty lists are rejected"""
+        for url, params in [
+            (RECIPES_URL, {'fields': 'id,calories'}),
+            (RECIPES_URL, {'fields': 'description'}), #Only in the detail
+            (RECIPES_URL, {'expand': 'title'}),
+            (RECIPES_URL, {'fields': ''}),
+            (detail_url(self.recipe.id), {'fields': 'user'}),
+        ]:
+            with self.subTest(params=params):
+                res = self.client.get(url, params)
+
+                self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn(list(params)[0], res.data)
@@ -0,0 +1,124 @@
+"""Tests for the recipe export API"""
+
+import csv
+import io
+import json
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core.models import (
+    Tag,
+    Ingredient,
+)
+from recipe.tests.test_recipe_api import create_recipe
+
+EXPORT_URL = reverse('recipe:recipe-export')
+
+
+def clear_snapshots():
+    """Set every recipe's snapshot to NULL, like the recipes from before migration 0016"""
+    #With the trigger on, it would build them again straight away
+    with connection.cursor() as cursor:
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE') #ALTER TABLE fails while the foreign key checks are still pending
+        cursor.execute('ALTER TABLE core_recipe DISABLE TRIGGER core_recipe_search_vector_update')
+        cursor.execute('UPDATE core_recipe SET snapshot = NULL')
+        cursor.execute('ALTER TABLE core_recipe ENABLE TRIGGER core_recipe_search_vector_update')
+
+
+class PrivateRecipeExportAPITests(TestCase):
+    """Test exporting recipes as an authenticated user"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        self.client.force_authenticate(self.user)
+
+    def test_auth_required(self):
+        """Test auth is required to export recipes"""
+        res = APIClient().get(EXPORT_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_export_ndjson(self):
+        """Test recipes are streamed as NDJSON with their tags and ingredients"""
+        recipe = create_recipe(self.user, title='Soup')
+        tag = Tag.objects.create(user=self.user, name='Dinner')
+        ingredient = Ingredient.objects.create(user=self.user, name='Salt')
+        recipe.tags.add(tag)
+        recipe.ingredients.add(ingredient)
+        other_user = get_user_model().objects.create_user('other@example.com', 'testpass123')
+        create_recipe(other_user)
+
+        res = self.client.get(EXPORT_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertTrue(res.streaming)
+        self.assertEqual(res['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(res.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [{
+            'id': recipe.id,
+            'title': 'Soup',
+            'description': 'Sample description',
+            'time_minutes': 22,
+            'price': '5.25',
+            'link': 'http://example.com/recipe.pdf',
+            'tags': [{'id': tag.id, 'name': 'Dinner'}],
+            'ingredients': [{'id': ingredient.id, 'name': 'Salt'}],
+        }])
+
+    def test_export_csv(self):
+        """Test recipes are streamed as CSV, newest first"""
+        first = create_recipe(self.user, title='First, with comma')
+        second = create_recipe(self.user, title='Second')
+        first.tags.add(
+            Tag.objects.create(user=self.user, name='Dinner'),
+            Tag.objects.create(user=self.user, name='Quick'),
+        )
+
+        res = self.client.get(EXPORT_URL, {'type': 'csv'})
+
+        self.assertEqual(res['Content-Type'], 'text/csv')
+        rows = list(csv.reader(io.StringIO(b''.join(res.streaming_content).decode())))
+        self.assertEqual(rows[0], ['id', 'title', 'description', 'time_minutes', 'price', 'link', 'tags', 'ingredients'])
+        self.assertEqual([row[0] for row in rows[1:]], [str(second.id), str(first.id)])
+        self.assertEqual(rows[2][1], 'First, with comma')
+        self.assertEqual(rows[2][6], 'Dinner|Quick')
+
+    def test_export_unknown_type_error(self):
+        """Test an unknown export type is rejected"""
+        res = self.client.get(EXPORT_URL, {'type': 'xml'})
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(RECIPE_EXPORT_CHUNK_SIZE=10)
+    def test_export_queries_per_chunk(self):
+        """Test tags and ingredients come from the snapshots, without a query per chunk or recipe"""
+        for i in range(25):
+            create_recipe(self.user, title=f'Recipe {i}')
+
+        res = self.client.get(EXPORT_URL)
+        with self.assertNumQueries(1): #The recipe cursor
+            lines = b''.join(res.streaming_content).decode().splitlines()
+
+        self.assertEqual(len(lines), 25)
+
+    @override_settings(RECIPE_EXPORT_CHUNK_SIZE=10)
+    def test_export_without_snapshots_queries_per_chunk(self):
+        """Test recipes without a snapshot have their tags and ingredients loaded once per chunk, not per recipe"""
+        for i in range(25):
+            recipe = create_recipe(self.user, title=f'Recipe {i}')
+            recipe.tags.add(Tag.objects.get_or_create(user=self.user, name='Dinner')[0])
+        clear_snapshots()
+
+        res = self.client.get(EXPORT_URL)
+        with self.assertNumQueries(1 + 3 * 2): #The recipe cursor, then tags and ingredients for each of the 3 chunks
+            lines = b''.join(res.streaming_content).decode().splitlines()
+
+        self.assertEqual(len(lines), 25)
+        self.assertEqual(json.loads(lines[0])['tags'][0]['name'], 'Dinner')
@@ -0,0 +1,189 @@
+"""Tests for the bulk recipe import API"""
+
+import io
+import json
+from decimal import Decimal
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.exceptions import ParseError
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+
+from core.models import (
+    Recipe,
+    Tag,
+    Ingredient,
+)
+from recipe.importer import iter_json_array
+from recipe.views import RecipeViewSet
+
+IMPORT_URL = reverse('recipe:recipe-bulk-import')
+
+
+def recipe_payload(i, **params):
+    """Return a valid recipe for the import body"""
+    payload = {
+        'title': f'Recipe {i}',
+        'time_minutes': 10,
+        'price': '2.50',
+        'tags': [{'name': 'Dinner'}, {'name': f'Tag {i}'}],
+        'ingredients': [{'name': 'Salt'}],
+    }
+    payload.update(params)
+    return payload
+
+
+class IterJsonArrayTests(SimpleTestCase):
+    """Test decoding a JSON array from a stream a chunk at a time"""
+
+    @patch('recipe.importer.READ_SIZE', 3) #Tiny reads so items are split across chunks
+    def test_items_split_across_reads(self):
+        """Test items are decoded whatever chunk boundaries they cross"""
+        items = [{'title': 'Crème brûlée'}, 12345, [1, 2], 'text', None]
+        stream = io.BytesIO(json.dumps(items).encode())
+
+        self.assertEqual(list(iter_json_array(stream)), list(enumerate(items, start=1)))
+
+    def test_empty_array(self):
+        """Test an empty array yields nothing"""
+        self.assertEqual(list(iter_json_array(io.BytesIO(b' [ ] '))), [])
+
+    def test_missing_comma(self):
+        """Test items without a comma between them are rejected after the ones before"""
+        rows = iter_json_array(io.BytesIO(b'[{"a": 1} {"a": 2}]'))
+
+        self.assertEqual(next(rows), (1, {'a': 1}))
+        with self.assertRaisesMessage(ParseError, 'Expected , or ] after item 1.'):
+            next(rows)
+
+    def test_malformed_arrays(self):
+        """Test data after the array, a trailing comma and a missing ] are rejected"""
+        for body in [b'[1, 2] [3]', b'[1, 2]x', b'[1, 2,]', b'[1, 2', b'[1 2]', b'[,1]', b'\xff[]']:
+            with self.subTest(body=body), self.assertRaises(ParseError):
+                list(iter_json_array(io.BytesIO(body)))
+
+        self.assertEqual(list(iter_json_array(io.BytesIO(b'[1, 2] \n'))), [(1, 1), (2, 2)])
+
+
+class PublicRecipeImportAPITests(TestCase):
+    """Test unauthenticated import requests"""
+
+    def test_auth_required(self):
+        """Test auth is required to import recipes"""
+        res = APIClient().post(IMPORT_URL, [], format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class PrivateRecipeImportAPITests(TestCase):
+    """Test importing recipes as an authenticated user"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        self.client.force_authenticate(self.user)
+
+    def post_ndjson(self, lines):
+        return self.client.generic(
+            'POST', IMPORT_URL, '\n'.join(lines).encode(), content_type='application/x-ndjson',
+        )
+
+    def test_import_json_array(self):
+        """Test importing a JSON array creates the recipes with their tags and ingredients"""
+        existing = Tag.objects.create(user=self.user, name='Dinner')
+        payload = [recipe_payload(i) for i in range(3)]
+
+        res = self.client.post(IMPORT_URL, payload, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['created'], 3)
+        self.assertEqual(res.data['errors'], [])
+        recipes = Recipe.objects.filter(user=self.user).order_by('id')
+        self.assertEqual([recipe.title for recipe in recipes], ['Recipe 0', 'Recipe 1', 'Recipe 2'])
+        self.assertEqual(recipes[0].price, Decimal('2.50'))
+        for i, recipe in enumerate(recipes):
+            self.assertIn(existing, recipe.tags.all())
+            self.assertTrue(recipe.tags.filter(name=f'Tag {i}').exists())
+            self.assertEqual([ingredient.name for ingredient in recipe.ingredients.all()], ['Salt'])
+        self.assertEqual(Ingredient.objects.filter(user=self.user).count(), 1)
+
+    def test_import_ndjson_reports_row_errors(self):
+        """Test bad rows are reported without stopping the rest of the import"""
+        lines = [
+            json.dumps(recipe_payload(1)),
+            '{not json',
+            json.dumps(recipe_payload(3, time_minutes='soon')),
+            '',
+            json.dumps(['not', 'an', 'object']),
+            json.dumps(recipe_payload(6)),
+        ]
+
+        res = self.post_ndjson(lines)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['created'], 2)
+        self.assertEqual(res.data['error_count'], 3)
+        self.assertEqual([error['row'] for error in res.data['errors']], [2, 3, 5])
+        self.assertIn('time_minutes', res.data['errors'][1]['errors'])
+        self.assertEqual(Recipe.objects.filter(user=self.user).count(), 2)
+
+    def test_import_missing_comma(self):
+        """Test an array missing a comma imports the items before it and reports the error"""
+        body = json.dumps(recipe_payload(1)) + json.dumps(recipe_payload(2))
+
+        res = self.client.generic('POST', IMPORT_URL, f'[{body}]', content_type='application/json')
+
+        self.assertEqual(res.data['created'], 1)
+        self.assertEqual(res.data['detail'], 'Expected , or ] after item 1.')
+
+    def test_import_without_body(self):
+        """Test an empty body is a 400 and a body without a Content-Length, e.g. chunked, a 411"""
+        res = self.client.generic('POST', IMPORT_URL, b'', content_type='application/json', CONTENT_LENGTH='0')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        body = json.dumps([recipe_payload(1)]).encode()
+        request = APIRequestFactory().generic('POST', IMPORT_URL, body, content_type='application/json')
+        del request.META['CONTENT_LENGTH']
+        force_authenticate(request, self.user)
+        res = RecipeViewSet.as_view({'post': 'bulk_import'})(request)
+
+        self.assertEqual(res.status_code, status.HTTP_411_LENGTH_REQUIRED)
+        self.assertFalse(Recipe.objects.exists())
+
+    @override_settings(RECIPE_IMPORT_CHUNK_SIZE=2)
+    def test_import_broken_json_keeps_earlier_rows(self):
+        """Test recipes read before broken JSON are still created"""
+        body = json.dumps([recipe_payload(i) for i in range(3)])[:-30]
+
+        res = self.client.generic('POST', IMPORT_URL, body, content_type='application/json')
+
+        self.assertEqual(res.data['created'], 2)
+        self.assertIn('detail', res.data)
+
+    @override_settings(RECIPE_IMPORT_MAX_ERRORS=2)
+    def test_errors_returned_are_capped(self):
+        """Test only the first errors are returned but all are counted"""
+        res = self.post_ndjson(['{}'] * 5)
+
+        self.assertEqual(res.data['error_count'], 5)
+        self.assertEqual(len(res.data['errors']), 2)
+
+    def test_import_query_count_independent_of_rows(self):
+        """Test a chunk of 5 or 50 recipes uses the same number of queries"""
+        query_counts = []
+        for count in [5, 50]:
+            user = get_user_model().objects.create_user(f'user{count}@example.com', 'testpass123')
+            self.client.force_authenticate(user) #New user so every tag and ingredient has to be created each time
+            payload = [recipe_payload(i) for i in range(count)]
+            with CaptureQueriesContext(connection) as queries:
+                res = self.client.post(IMPORT_URL, payload, format='json')
+            self.assertEqual(res.data['created'], count)
+            query_counts.append(len(queries))
+
+        self.assertEqual(query_counts[0], query_counts[1])
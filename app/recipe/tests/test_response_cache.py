@@ -0,0 +1,176 @@
+"""Tests for the per-user versioned response cache"""
+
+import json
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core.models import (
+    Tag,
+    Ingredient,
+)
+from recipe import cache
+from recipe.tests.test_recipe_api import create_recipe
+
+RECIPES_URL = reverse('recipe:recipe-list')
+TAGS_URL = reverse('recipe:tag-list')
+INGREDIENTS_URL = reverse('recipe:ingredient-list')
+IMPORT_URL = reverse('recipe:recipe-bulk-import')
+
+
+@override_settings(RESPONSE_CACHE={'CACHE': 'default', 'TTL': 300, 'SINGLE_PROCESS': True})
+class ResponseCacheTests(TestCase):
+    """Test list responses are cached until the users data changes"""
+
+    def setUp(self):
+        cache.get_cache().clear()
+        cache.stats.update(hits=0, misses=0)
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def titles(self):
+        return [recipe['title'] for recipe in self.client.get(RECIPES_URL).data['results']]
+
+    def test_second_request_is_a_hit(self):
+        """Test the same list is served from the cache without queries"""
+        recipe = create_recipe(self.user)
+        recipe.tags.add(Tag.objects.create(user=self.user, name='Dinner'))
+        first = self.client.get(RECIPES_URL)
+
+        with self.assertNumQueries(0):
+            second = self.client.get(RECIPES_URL)
+
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(cache.get_stats(), {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+
+    def test_query_params_are_cached_separately(self):
+        """Test different query params don't share a cache entry"""
+        create_recipe(self.user, title='Soup')
+        create_recipe(self.user, title='Salad')
+
+        self.assertEqual(len(self.client.get(RECIPES_URL).data['results']), 2)
+        self.assertEqual(len(self.client.get(RECIPES_URL, {'page_size': 1}).data['results']), 1)
+        self.assertEqual(len(self.client.get(RECIPES_URL, {'q': 'soup'}).data['results']), 1)
+
+    def test_users_are_cached_separately(self):
+        """Test a user never gets another users cached response"""
+        create_recipe(self.user, title='Mine')
+        other = get_user_model().objects.create_user('other@example.com', 'testpass123')
+        create_recipe(other, title='Theirs')
+        self.titles()
+
+        self.client.force_authenticate(other)
+
+        self.assertEqual(self.titles(), ['Theirs'])
+
+    def test_invalidated_by_recipe_changes(self):
+        """Test creating, updating and deleting recipes are seen straight away"""
+        recipe = create_recipe(self.user, title='Soup')
+        self.assertEqual(self.titles(), ['Soup'])
+
+        self.client.post(RECIPES_URL, {'title': 'Salad', 'time_minutes': 5, 'price': '2.50'})
+        self.assertEqual(self.titles(), ['Salad', 'Soup'])
+
+        recipe.title = 'Tomato soup'
+        recipe.save()
+        self.assertEqual(self.titles(), ['Salad', 'Tomato soup'])
+
+        recipe.delete()
+        self.assertEqual(self.titles(), ['Salad'])
+
+    def test_invalidated_by_tag_and_ingredient_changes(self):
+        """Test adding, removing and renaming tags and ingredients are seen straight away"""
+        recipe = create_recipe(self.user)
+        tag = Tag.objects.create(user=self.user, name='Dinner')
+        ingredient = Ingredient.objects.create(user=self.user, name='Salt')
+        self.client.get(RECIPES_URL)
+
+        recipe.tags.add(tag)
+        self.assertEqual(self.client.get(RECIPES_URL).data['results'][0]['tags'], [{'id': tag.id, 'name': 'Dinner'}])
+
+        tag.name = 'Supper'
+        tag.save()
+        self.assertEqual(self.client.get(RECIPES_URL).data['results'][0]['tags'], [{'id': tag.id, 'name': 'Supper'}])
+
+        ingredient.recipe_set.add(recipe) #From the ingredient side of the relation
+        self.assertEqual(len(self.client.get(RECIPES_URL).data['results'][0]['ingredients']), 1)
+
+        recipe.tags.clear()
+        self.assertEqual(self.client.get(RECIPES_URL).data['results'][0]['tags'], [])
+
+    def test_tag_and_ingredient_lists(self):
+        """Test the tag and ingredient lists are cached and invalidated"""
+        Tag.objects.create(user=self.user, name='Dinner')
+        self.client.get(TAGS_URL)
+        with self.assertNumQueries(0):
+            self.client.get(TAGS_URL)
+
+        Tag.objects.create(user=self.user, name='Breakfast')
+        self.assertEqual(len(self.client.get(TAGS_URL).data['results']), 2)
+
+        recipe = create_recipe(self.user)
+        self.client.get(INGREDIENTS_URL, {'recipe_count': 1})
+        recipe.ingredients.add(Ingredient.objects.create(user=self.user, name='Salt'))
+        res = self.client.get(INGREDIENTS_URL, {'recipe_count': 1})
+        self.assertEqual(res.data['results'][0]['recipe_count'], 1)
+
+    def test_invalidated_by_import(self):
+        """Test recipes created with bulk_create by the import are seen straight away"""
+        self.client.get(RECIPES_URL)
+
+        self.client.post(
+            IMPORT_URL,
+            json.dumps([{'title': 'Imported', 'time_minutes': 5, 'price': '1.00', 'tags': [{'name': 'New'}]}]),
+            content_type='application/json',
+        )
+
+        self.assertEqual(self.titles(), ['Imported'])
+        self.assertEqual([tag['name'] for tag in self.client.get(TAGS_URL).data['results']], ['New'])
+
+    def test_version_bumped_again_on_commit(self):
+        """Test a response cached while a write was being committed is never served"""
+        version = cache.get_version(self.user.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            create_recipe(self.user)
+            in_transaction = cache.get_version(self.user.id)
+
+        self.assertNotEqual(in_transaction, version)
+        self.assertNotIn(cache.get_version(self.user.id), (version, in_transaction))
+
+    def test_evicted_version_is_not_reused(self):
+        """Test a user whose version was evicted doesn't get responses cached under an old version"""
+        version = cache.get_version(self.user.id)
+        cache.get_cache().delete(cache.VERSION_KEY_PREFIX + str(self.user.id))
+
+        self.assertNotEqual(cache.get_version(self.user.id), version)
+
+    @override_settings(RESPONSE_CACHE={'CACHE': 'default', 'TTL': 300, 'SINGLE_PROCESS': False})
+    def test_per_process_cache_not_used(self):
+        """Test a per-process cache isn't used for the responses or ETags of more than 1 process"""
+        self.client.get(RECIPES_URL)
+        res = self.client.get(RECIPES_URL)
+
+        self.assertNotIn('ETag', res)
+        self.assertEqual(cache.get_stats()['hits'], 0)
+        res = self.client.get(RECIPES_URL, HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+        with self.settings(
+            CACHES={'shared': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}},
+            RESPONSE_CACHE={'CACHE': 'shared', 'TTL': 300, 'SINGLE_PROCESS': True},
+        ):
+            self.assertFalse(cache.is_usable()) #Stores no versions, whatever SINGLE_PROCESS says
+
+    @override_settings(RESPONSE_CACHE={'CACHE': 'default', 'TTL': 0, 'SINGLE_PROCESS': True})
+    def test_disabled(self):
+        """Test a TTL of 0 turns the cache off"""
+        self.client.get(RECIPES_URL)
+        self.client.get(RECIPES_URL)
+
+        self.assertEqual(cache.get_stats()['hits'], 0)
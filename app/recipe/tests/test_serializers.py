@@ -0,0 +1,72 @@
+"""Tests for the recipe serializers"""
+
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db.models import Prefetch
+from django.test import TestCase
+
+from rest_framework.renderers import JSONRenderer
+
+from core.models import (
+    Recipe,
+    Tag,
+    Ingredient,
+)
+from recipe.serializers import (
+    RecipeSerializer,
+    RecipeListSerializer,
+)
+from recipe.tests.test_recipe_api import create_recipe
+
+
+class RecipeListSerializerParityTests(TestCase):
+    """Test the fast list serializer renders exactly the same JSON as RecipeSerializer"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+
+    def assertSameJSON(self):
+        """Render the users recipes with both serializers and compare the bytes"""
+        recipes = Recipe.objects.filter(user=self.user).order_by('-id')
+        expected = RecipeSerializer(
+            recipes.prefetch_related(
+                Prefetch('tags', queryset=Tag.objects.order_by('id')),
+                Prefetch('ingredients', queryset=Ingredient.objects.order_by('id')),
+            ),
+            many=True,
+        ).data
+        fast = RecipeListSerializer(
+            recipes.values(*RecipeListSerializer.value_fields),
+            many=True,
+        ).data
+
+        self.assertEqual(JSONRenderer().render(fast), JSONRenderer().render(expected))
+
+    def test_no_recipes(self):
+        """Test an empty list"""
+        self.assertSameJSON()
+
+    def test_recipe_without_tags_or_ingredients(self):
+        """Test recipes with empty nested lists"""
+        create_recipe(self.user, link='')
+        self.assertSameJSON()
+
+    def test_recipes_with_tags_and_ingredients(self):
+        """Test nested tags and ingredients are grouped under the right recipe"""
+        tags = [Tag.objects.create(user=self.user, name=name) for name in ['Vegan', 'Dinner', 'Quick']]
+        salt = Ingredient.objects.create(user=self.user, name='Salt')
+        first = create_recipe(self.user, title='First')
+        second = create_recipe(self.user, title='Second')
+        first.tags.add(tags[2], tags[0])
+        first.ingredients.add(salt)
+        second.tags.add(*tags)
+
+        self.assertSameJSON()
+
+    def test_prices_and_text(self):
+        """Test decimal formatting and unicode text match"""
+        for price in ['0.50', '999.99', '10.00', '3.1']:
+            create_recipe(self.user, price=Decimal(price), title='Crème brûlée 🍮', link='https://example.com/ü')
+
+        self.assertSameJSON()
@@ -0,0 +1,206 @@
+"""Tests for the delta sync API"""
+
+import json
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core.models import (
+    Recipe,
+    Tag,
+    Ingredient,
+    Tombstone,
+)
+from recipe.tests.test_recipe_api import create_recipe
+
+SYNC_URL = reverse('recipe:sync')
+
+
+#The changes are tracked by transaction id, so every write has to be committed on its own like in production,
+#instead of all of them being in the 1 transaction TestCase wraps each test in
+class SyncAPITests(TransactionTestCase):
+    """Test the delta sync API"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user('user@example.com', 'testpass123')
+        self.client.force_authenticate(self.user)
+        self.recipe = create_recipe(self.user, title='Soup')
+        self.tag = Tag.objects.create(user=self.user, name='Dinner')
+        self.recipe.tags.add(self.tag)
+
+    def sync(self, since=None):
+        res = self.client.get(SYNC_URL, {'since': since} if since else {})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return res.data
+
+    def test_auth_required(self):
+        """Test auth is required to sync"""
+        res = APIClient().get(SYNC_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_full_sync(self):
+        """Test a sync without a token returns everything"""
+        data = self.sync()
+
+        self.assertTrue(data['full'])
+        self.assertEqual([recipe['title'] for recipe in data['recipes']], ['Soup'])
+        self.assertEqual(data['recipes'][0]['price'], '5.25')
+        self.assertEqual(data['recipes'][0]['tags'], [{'id': self.tag.id, 'name': 'Dinner'}])
+        self.assertEqual(data['tags'], [{'id': self.tag.id, 'name': 'Dinner'}])
+        self.assertEqual(data['deleted'], {'recipes': [], 'tags': [], 'ingredients': []})
+
+    def test_nothing_changed(self):
+        """Test syncing again without changes returns nothing, in a few hundred bytes"""
+        for i in range(50):
+            create_recipe(self.user, title=f'Recipe {i}', description='A long description ' * 20)
+        full = self.client.get(SYNC_URL)
+
+        res = self.client.get(SYNC_URL, {'since': full.data['since']})
+
+        self.assertFalse(res.data['full'])
+        self.assertEqual(res.data['recipes'], [])
+        self.assertEqual(res.data['tags'], [])
+        self.assertLess(len(res.content), 300)
+        self.assertGreater(len(full.content), 50 * 400)
+
+    def test_created_and_updated(self):
+        """Test only the created and updated rows are returned"""
+        other = create_recipe(self.user, title='Salad')
+        since = self.sync()['since']
+
+        created = create_recipe(self.user, title='Cake')
+        other.title = 'Green salad'
+        other.save()
+        ingredient = Ingredient.objects.create(user=self.user, name='Salt')
+        data = self.sync(since)
+
+        self.assertEqual([recipe['id'] for recipe in data['recipes']], [other.id, created.id])
+        self.assertEqual(data['recipes'][0]['title'], 'Green salad')
+        self.assertEqual(data['tags'], [])
+        self.assertEqual(data['ingredients'], [{'id': ingredient.id, 'name': 'Salt'}])
+
+    def test_links_and_renames(self):
+        """Test changing a recipes tags, or renaming one of its tags, returns the recipe"""
+        since = self.sync()['since']
+        self.recipe.ingredients.add(Ingredient.objects.create(user=self.user, name='Salt'))
+        data = self.sync(since)
+        self.assertEqual([recipe['id'] for recipe in data['recipes']], [self.recipe.id])
+        self.assertEqual(len(data['recipes'][0]['ingredients']), 1)
+
+        since = data['since']
+        self.tag.name = 'Supper'
+        self.tag.save()
+        data = self.sync(since)
+
+        self.assertEqual(data['tags'], [{'id': self.tag.id, 'name': 'Supper'}])
+        self.assertEqual(data['recipes'][0]['tags'], [{'id': self.tag.id, 'name': 'Supper'}])
+
+    def test_deleted(self):
+        """Test deleted rows are returned as tombstones"""
+        since = self.sync()['since']
+
+        tag_id = self.tag.id
+        self.tag.delete()
+        data = self.sync(since)
+        self.assertEqual(data['deleted']['tags'], [tag_id])
+        self.assertEqual(data['recipes'][0]['tags'], []) #The recipe lost the tag
+
+        since = data['since']
+        recipe_id = self.recipe.id
+        self.recipe.delete()
+        data = self.sync(since)
+        self.assertEqual(data['deleted'], {'recipes': [recipe_id], 'tags': [], 'ingredients': []})
+        self.assertEqual(data['recipes'], [])
+
+    def test_limited_to_user(self):
+        """Test other users changes aren't returned"""
+        since = self.sync()['since']
+        other = get_user_model().objects.create_user('other@example.com', 'testpass123')
+        create_recipe(other).delete()
+        Tag.objects.create(user=other, name='Theirs')
+
+        data = self.sync(since)
+
+        self.assertEqual(data['recipes'], [])
+        self.assertEqual(data['tags'], [])
+        self.assertEqual(data['deleted'], {'recipes': [], 'tags': [], 'ingredients': []})
+
+    def test_change_committed_after_sync(self):
+        """Test a transaction that was running during a sync and commits afterwards isn't missed"""
+        changed, commit = threading.Event(), threading.Event()
+
+        def slow_update():
+            with transaction.atomic():
+                Recipe.objects.filter(pk=self.recipe.pk).update(title='Slow update')
+                changed.set()
+                commit.wait(5)
+            connection.close()
+
+        thread = threading.Thread(target=slow_update)
+        thread.start()
+        changed.wait(5)
+        since = self.sync()['since'] #Can't see the update yet
+        create_recipe(self.user, title='Committed in between')
+        commit.set()
+        thread.join()
+
+        data = self.sync(since)
+
+        self.assertIn('Slow update', [recipe['title'] for recipe in data['recipes']])
+
+    def test_invalid_token(self):
+        """Test a token that can't be decoded is rejected"""
+        res = self.client.get(SYNC_URL, {'since': 'not-a-token'})
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_expired_token_gets_full_sync(self):
+        """Test a token older than SYNC_TOKEN_MAX_AGE gets everything again"""
+        since = self.sync()['since']
+
+        with self.settings(SYNC_TOKEN_MAX_AGE=60), patch('recipe.sync.time.time', return_value=time.time() + 120):
+            data = self.sync(since)
+
+        self.assertTrue(data['full'])
+        self.assertEqual(len(data['recipes']), 1)
+
+    def test_prune_tombstones(self):
+        """Test the prune_tombstones command deletes only the old tombstones"""
+        create_recipe(self.user).delete()
+        recipe_id = self.recipe.id
+        self.recipe.delete()
+        Tombstone.objects.filter(object_id=recipe_id).update(deleted_at=timezone.now() - timedelta(days=60))
+
+        out = StringIO()
+        call_command('prune_tombstones', stdout=out)
+
+        self.assertEqual(Tombstone.objects.count(), 1)
+        self.assertIn('Deleted 1 tombstones.', out.getvalue())
+
+    def test_payload_is_json(self):
+        """Test the sync payload renders as JSON"""
+        res = self.client.get(SYNC_URL)
+
+        self.assertEqual(json.loads(res.content)['recipes'][0]['title'], 'Soup')
+
+    def test_api_schema(self):
+        """Test the API schema, with the sync response, is generated without warnings or errors"""
+        out = StringIO()
+        call_command('spectacular', '--fail-on-warn', stdout=out, stderr=StringIO())
+
+        self.assertIn('/api/recipe/sync/', out.getvalue())
+        self.assertIn('deleted:', out.getvalue())
@@ -1,5 +1,7 @@
 """Tests for the tags API"""
 
+from decimal import Decimal
+
 from django.contrib.auth import get_user_model
 from django.urls import reverse #To figure out URLs that we need to test
 from django.test import TestCase
@@ -7,7 +9,10 @@ from django.test import TestCase
 from rest_framework import status
 from rest_framework.test import APIClient
 
-from core.models import Tag
+from core.models import (
+    Tag,
+    Recipe,
+)
 
 from recipe.serializers import TagSerializer
 
@@ -54,7 +59,7 @@ class PrivateTagsApiClient(TestCase):
         serializer = TagSerializer(tags, many=True)
 
         self.assertEqual(res.status_code, status.HTTP_200_OK)
-        self.assertEqual(res.data, serializer.data)
+        self.assertEqual(res.data['results'], serializer.data)
 
     def test_tags_limited_to_user(self):
         """List of tags is limited to authenticated user"""
@@ -65,9 +70,9 @@ class PrivateTagsApiClient(TestCase):
         res = self.client.get(TAGS_URL)
 
         self.assertEqual(res.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(res.data), 1)
-        self.assertEqual(res.data[0]['name'], tag.name)
-        self.assertEqual(res.data[0]['id'], tag.id)
+        self.assertEqual(len(res.data['results']), 1)
+        self.assertEqual(res.data['results'][0]['name'], tag.name)
+        self.assertEqual(res.data['results'][0]['id'], tag.id)
 
     def test_update_tag(self):
         """Test updating a tag"""
@@ -90,4 +95,95 @@ class PrivateTagsApiClient(TestCase):
 
         self.assertEqual(res.status_code, status.HTTP_204_NO_CONTENT)
         tags = Tag.objects.filter(user = self.user)
-        self.assertFalse(tags.exists())
\ No newline at end of file
+        self.assertFalse(tags.exists())
+    def test_update_tag_to_existing_name_error(self):
+        """Test renaming a tag to the name of another of the users tags fails"""
+        Tag.objects.create(user = self.user, name='Dessert')
+        tag = Tag.objects.create(user = self.user, name='After Dinner')
+
+        payload = {'name': 'Dessert'}
+        url = detail_url(tag.id)
+        res = self.client.patch(url, payload)
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        tag.refresh_from_db()
+        self.assertEqual(tag.name, 'After Dinner')
+
+    def test_paginate_tags_by_name(self):
+        """Test tags are paginated with a cursor in reverse name order"""
+        for name in ['Apple', 'Banana', 'Cherry']:
+            Tag.objects.create(user = self.user, name=name)
+
+        res = self.client.get(TAGS_URL, {'page_size': 2})
+
+        self.assertEqual([tag['name'] for tag in res.data['results']], ['Cherry', 'Banana'])
+        res = self.client.get(res.data['next'])
+        self.assertEqual([tag['name'] for tag in res.data['results']], ['Apple'])
+        self.assertIsNone(res.data['next'])
+
+    def test_filter_assigned_only(self):
+        """Test listing only tags that are assigned to recipes"""
+        used = Tag.objects.create(user = self.user, name='Used')
+        Tag.objects.create(user = self.user, name='Unused')
+        recipe = Recipe.objects.create(
+            user = self.user, title='Toast', time_minutes=5, price=Decimal('1.00'),
+        )
+        recipe.tags.add(used)
+
+        res = self.client.get(TAGS_URL, {'assigned_only': 1})
+
+        self.assertEqual([tag['id'] for tag in res.data['results']], [used.id])
+
+    def test_assigned_only_no_duplicates(self):
+        """Test tags used by several recipes are only listed once"""
+        tag = Tag.objects.create(user = self.user, name='Popular')
+        for i in range(3):
+            recipe = Recipe.objects.create(
+                user = self.user, title=f'Recipe {i}', time_minutes=5, price=Decimal('1.00'),
+            )
+            recipe.tags.add(tag)
+
+        res = self.client.get(TAGS_URL, {'assigned_only': 1})
+
+        self.assertEqual(len(res.data['results']), 1)
+
+    def test_recipe_count(self):
+        """Test recipe_count=1 adds how many recipes use each tag, in 1 query"""
+        used = Tag.objects.create(user = self.user, name='Used')
+        unused = Tag.objects.create(user = self.user, name='Unused')
+        for i in range(2):
+            recipe = Recipe.objects.create(
+                user = self.user, title=f'Recipe {i}', time_minutes=5, price=Decimal('1.00'),
+            )
+            recipe.tags.add(used)
+
+        with self.assertNumQueries(1):
+            res = self.client.get(TAGS_URL, {'recipe_count': 1})
+        self.assertEqual(res.data['results'], [
+            {'id': used.id, 'name': 'Used', 'recipe_count': 2},
+            {'id': unused.id, 'name': 'Unused', 'recipe_count': 0},
+        ])
+
+        res = self.client.get(TAGS_URL, {'recipe_count': 1, 'assigned_only': 1})
+        self.assertEqual([tag['id'] for tag in res.data['results']], [used.id])
+
+    def test_recipe_count_query_budget(self):
+        """Test 5000 tags with counts are listed in a single query"""
+        tags = Tag.objects.bulk_create([Tag(user = self.user, name=f'Tag {i}') for i in range(5000)])
+        recipe = Recipe.objects.create(
+            user = self.user, title='Everything', time_minutes=5, price=Decimal('1.00'),
+        )
+        recipe.tags.add(*tags)
+
+        with self.assertNumQueries(1):
+            res = self.client.get(TAGS_URL, {'recipe_count': 1, 'assigned_only': 1, 'page_size': 1000})
+
+        self.assertEqual(len(res.data['results']), 1000)
+        self.assertTrue(all(tag['recipe_count'] == 1 for tag in res.data['results']))
+
+    def test_invalid_flag_error(self):
+        """Test assigned_only must be 0 or 1"""
+        res = self.client.get(TAGS_URL, {'assigned_only': 'yes'})
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
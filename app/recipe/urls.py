@@ -20,4 +20,5 @@ app_name = 'recipe' #We define the name that is used to identify the name when w
 
 urlpatterns = [
     path('', include(router.urls)), #include the URLs that are automatically generated by the router
-]
\ No newline at end of file
+    path('sync/', views.SyncView.as_view(), name='sync'),
+]
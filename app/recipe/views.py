@@ -1,76 +1,345 @@
 """Views for the Recipe APIs"""
 
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.db.models import Count, Exists, F, OuterRef, Prefetch
+from django.http import StreamingHttpResponse
+
+from drf_spectacular.utils import OpenApiParameter, extend_schema
+
 from rest_framework import (
+    status,
     viewsets, 
     mixins #Things you can mix-in to a view to add extra functionality
 )
-from rest_framework.authentication import TokenAuthentication
+from rest_framework.decorators import action
+from rest_framework.exceptions import ParseError, ValidationError
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
 from core.models import (
     Recipe, 
     Tag,
     Ingredient
 )
+from core.async_db import iter_on_thread
+from core.sharding import ShardRoutingMixin, current_db
 from recipe import serializers
+from recipe.cache import CachedListMixin
+from recipe.conditional import (
+    PreconditionFailed,
+    etag_matches,
+    recipe_etag,
+)
+from recipe.exporter import (
+    csv_lines,
+    iter_recipes,
+    ndjson_lines,
+)
+from recipe.importer import (
+    import_recipes,
+    iter_json_array,
+    iter_ndjson,
+)
+from recipe.pagination import (
+    RecipeCursorPagination,
+    NameCursorPagination,
+    SearchPosition,
+)
+from recipe.sync import InvalidToken, sync
+from user.authentication import CachedTokenAuthentication
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(ShardRoutingMixin, CachedListMixin, viewsets.ModelViewSet):
     """View for manage recipe APIs"""
 
     serializer_class = serializers.RecipeDetailSerializer
     queryset = Recipe.objects.all() #queryset represents the objs that are available for this viewset. Because its a ModelViewset, 
                                     #its expected to work with a model. The way we tell it what model to use is, you sepcify the queryset
                                     #i.e. this is the queryset of objs that is going to be manageable through this API, or the APIs through our ModelViewset  
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
+    pagination_class = RecipeCursorPagination
+    export_types = {
+        'ndjson': ('application/x-ndjson', ndjson_lines),
+        'csv': ('text/csv', csv_lines),
+    }
+    expandable_fields = ['tags', 'ingredients'] #Nested fields, only returned with ?fields= when named there or in ?expand=
 
     def get_queryset(self): # We're overriding the default get method because we only want to get the authenticated users recipes 
         """Retrieve recipes for authenticated user"""
-        return self.queryset.filter(user = self.request.user).order_by('-id')
+        queryset = self.queryset.filter(user = self.request.user).order_by('-id')
+        fields = self._sparse_fields()
+        if self.action == 'list': #The list serializer works from plain .values() rows and loads the tags and ingredients itself
+            queryset = self._search(self._filter(queryset))
+            #The cursor pagination needs the position of search results
+            extra_fields = ['search_position'] if 'search_position' in queryset.query.annotations else []
+            return queryset.values(*serializers.RecipeListSerializer.value_fields_for(fields), *extra_fields)
+
+        prefetches = { #Loads the tags and ingredients for every recipe in 1 extra query each, instead of 2 queries per recipe
+            'tags': Prefetch('tags', queryset=Tag.objects.order_by('id')), #when the nested serializers render them. Keeps the number of queries constant however many recipes there are
+            'ingredients': Prefetch('ingredients', queryset=Ingredient.objects.order_by('id')),
+        }
+        if fields is not None: #Only the columns of the fields asked for, and updated_at for the ETag
+            queryset = queryset.only(*[field for field in fields if field not in prefetches], 'updated_at')
+            prefetches = {field: prefetch for field, prefetch in prefetches.items() if field in fields}
+        return queryset.prefetch_related(*prefetches.values())
+
+    def _sparse_fields(self):
+        """Return the fields asked for with ?fields= and ?expand= in the serializer's order, or None for all of them"""
+        #?fields=id,title,price returns just those, nested fields included only when named. ?expand=tags adds nested
+        #fields, on its own to every other field. Only the list and retrieve responses can be trimmed
+        params = self.request.query_params
+        if self.action not in ('list', 'retrieve') or ('fields' not in params and 'expand' not in params):
+            return None
+
+        available = self.get_serializer_class().Meta.fields
+        if 'fields' in params:
+            fields = self._params_to_names('fields', available)
+        else:
+            fields = [field for field in available if field not in self.expandable_fields]
+        if 'expand' in params:
+            fields += self._params_to_names('expand', self.expandable_fields)
+        return [field for field in available if field in fields]
+
+    def _params_to_names(self, name, allowed):
+        """Convert a comma separated list of field names from the query params to a list, rejecting unknown ones"""
+        names = [field.strip() for field in self.request.query_params[name].split(',') if field.strip()]
+        if not names or not set(names) <= set(allowed):
+            raise ValidationError({name: [f'Must be a comma separated list of: {", ".join(allowed)}.']})
+        return names
+
+    def get_serializer_context(self):
+        """Return the serializer context, with the fields to render for ?fields= and ?expand="""
+        context = super().get_serializer_context()
+        context['fields'] = self._sparse_fields()
+        return context
     
+    def _params_to_ints(self, name):
+        """Convert a comma separated list of ids from the query params to a list of ints"""
+        value = self.request.query_params.get(name, '')
+        try:
+            return [int(str_id) for str_id in value.split(',') if str_id.strip()]
+        except ValueError:
+            raise ValidationError({name: ['Must be a comma separated list of ids.']})
+
+    def _filter(self, queryset):
+        """Filter recipes by ?tags=1,2 and ?ingredients=3, matching any (default) or all of the ids with ?match=all"""
+        match = self.request.query_params.get('match', 'any')
+        if match not in ('any', 'all'):
+            raise ValidationError({'match': ['Must be one of: any, all.']})
+
+        #Joining the through tables with filter(tags__id__in=...) gives a row per matching tag, so it would need an
+        #expensive distinct(). EXISTS is a semi-join instead, each recipe is returned once and Postgres stops at the first
+        #matching row in the through table index
+        for field, through_field in [('tags', 'tag_id'), ('ingredients', 'ingredient_id')]:
+            ids = self._params_to_ints(field)
+            if not ids:
+                continue
+            links = getattr(Recipe, field).through.objects.filter(recipe_id=OuterRef('pk'))
+            if match == 'any':
+                queryset = queryset.filter(Exists(links.filter(**{through_field + '__in': ids})))
+            else: #1 EXISTS per id, each is a lookup on the unique (recipe_id, tag_id) index
+                for related_id in set(ids):
+                    queryset = queryset.filter(Exists(links.filter(**{through_field: related_id})))
+
+        return queryset
+
+    def _search(self, queryset):
+        """Filter recipes matching the ?q= search, best match first"""
+        search = self.request.query_params.get('q', '').strip()
+        if not search:
+            return queryset
+
+        #websearch accepts what people type in a search box, e.g. "thai curry" -coconut. The match uses the GIN index
+        #on search_vector, and the rank weights title over tag/ingredient names over the description
+        query = SearchQuery(search, config='english', search_type='websearch')
+        return queryset.filter(
+            search_vector = query,
+        ).annotate(
+            rank = SearchRank(F('search_vector'), query),
+        ).annotate(
+            search_position = SearchPosition('rank', 'id'), #Pages by rank, then id, see RecipeCursorPagination
+        ).order_by('-search_position')
+
     def get_serializer_class(self): #Overriding default get_serializer_class to return the serilizer based on endpoint
         """Return the serializer class for request"""
         if self.action == 'list':
-            return serializers.RecipeSerializer
+            return serializers.RecipeListSerializer
         
         return self.serializer_class
     
+    def _current_etag(self, lock=False, fields=None):
+        """Return the ETag of the requested recipe from just its updated_at column, or None if it doesn't exist"""
+        queryset = self.queryset.filter(user = self.request.user)
+        if lock: #Holds the row until the end of the transaction, so nobody can change it between the check and the save
+            queryset = queryset.select_for_update()
+        try:
+            row = queryset.filter(pk=self.kwargs['pk']).values_list('id', 'updated_at').first()
+        except (TypeError, ValueError): #Not a valid id, get_object() returns the 404
+            return None
+        return recipe_etag(*row, fields) if row else None
+
+    def retrieve(self, request, *args, **kwargs):
+        """Return a recipe, or a 304 without loading it when If-None-Match has its current ETag"""
+        fields = self._sparse_fields() #A response with only some of the fields gets its own ETag
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etag = self._current_etag(fields=fields)
+            if etag and etag_matches(if_none_match, etag, weak=True):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        instance = self.get_object()
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data, headers={'ETag': recipe_etag(instance.id, instance.updated_at, fields)})
+
+    def update(self, request, *args, **kwargs):
+        """Update a recipe, if If-Match is sent only when it has the recipes current ETag"""
+        partial = kwargs.pop('partial', False)
+        with transaction.atomic(using=current_db()): #The user's shard
+            if_match = request.META.get('HTTP_IF_MATCH')
+            if if_match:
+                etag = self._current_etag(lock=True)
+                if etag and not etag_matches(if_match, etag): #Someone else changed it since the client read it
+                    raise PreconditionFailed()
+
+            instance = self.get_object()
+            serializer = self.get_serializer(instance, data=request.data, partial=partial)
+            serializer.is_valid(raise_exception=True)
+            self.perform_update(serializer)
+
+        if getattr(instance, '_prefetched_objects_cache', None): #Same as UpdateModelMixin, the prefetched tags
+            instance._prefetched_objects_cache = {} #and ingredients may have changed
+
+        return Response(serializer.data, headers={'ETag': recipe_etag(instance.id, instance.updated_at)})
+
     def perform_create(self, serializer):#perform_create method is the way we override the behaviour for when DRF saves a model in a Viewset
         #Essentially, when we perform a creation of a new obj through this Model Viewset, i.e. when we create a new recipe through the
         #create feature of the Viewset, we're going to call this method as part of that obj creation. It accepts 1 param, serializer
         #which is the validated serializer
         """Create new recipe"""
         serializer.save(user=self.request.user) #Will set the user value to the current authenticated user when we save the obj
+
+    @action(methods=['POST'], detail=False, url_path='import') #Adds the recipes/import/ endpoint to the router
+    def bulk_import(self, request):
+        """Create recipes in bulk from a JSON array or an NDJSON (application/x-ndjson) body"""
+        #We read request.stream ourselves instead of request.data, which would parse the whole upload into memory
+        stream = request.stream
+        if stream is None: #Django reads a body without a Content-Length, e.g. a chunked upload, as no body at all
+            if 'CONTENT_LENGTH' not in request.META:
+                return Response({'detail': 'A Content-Length header is required.'}, status=status.HTTP_411_LENGTH_REQUIRED)
+            raise ParseError('The body is empty.')
+        if request.content_type.startswith('application/x-ndjson'):
+            rows = iter_ndjson(stream)
+        else:
+            rows = iter_json_array(stream)
+
+        return Response(import_recipes(request.user, rows))
+
+    @action(methods=['GET'], detail=False) #Adds the recipes/export/ endpoint to the router
+    def export(self, request):
+        """Stream all the users recipes as NDJSON, or as CSV with ?type=csv"""
+        #?format= is taken by DRF to pick a renderer, so the export type has its own param
+        export_type = request.query_params.get('type', 'ndjson')
+        if export_type not in self.export_types:
+            raise ValidationError({'type': [f'Must be one of: {", ".join(self.export_types)}.']})
+
+        content_type, to_lines = self.export_types[export_type]
+        #for_user() picks the shard itself, the recipes are read after the view has returned
+        recipes = iter_recipes(Recipe.objects.for_user(request.user).order_by('-id'), user_id=request.user.pk)
+        lines = to_lines(recipes)
+        if isinstance(request._request, ASGIRequest): #The lines are read on the event loop, see iter_on_thread
+            lines = iter_on_thread(lines)
+        #The response is written as the generator produces it, so the first byte goes out before all recipes are read
+        response = StreamingHttpResponse(lines, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="recipes.{export_type}"'
+
+        return response
     
-class TagViewSet(mixins.UpdateModelMixin, 
-                 mixins.DestroyModelMixin, 
-                 mixins.ListModelMixin, 
-                 viewsets.GenericViewSet):
+class BaseRecipeAttrViewSet(ShardRoutingMixin,
+                            CachedListMixin,
+                            mixins.UpdateModelMixin, 
+                            mixins.DestroyModelMixin, 
+                            mixins.ListModelMixin, 
+                            viewsets.GenericViewSet):
     #mixins.ListModelMixin -> Allows you to add the list functionality for listing models
     #viewsets.GenericViewSet -> Allows us to add in mixins so tha we can have the viewset fucntionality that we desire for your API
+    """Base viewset for recipe attributes, i.e. tags and ingredients"""
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    pagination_class = NameCursorPagination
+
+    count_serializer_class = None #Serializer with the recipe_count field, used for ?recipe_count=1
+    through = None #The Recipe through table that links recipes to this model
+    through_field = None #The column of the through table that points to this model
+
+    def _flag(self, name):
+        """Return whether a 0/1 query param is set"""
+        try:
+            return bool(int(self.request.query_params.get(name, 0)))
+        except ValueError:
+            raise ValidationError({name: ['Must be 0 or 1.']})
+
+    def get_queryset(self): # We're overriding the default get method because we only want to get the authenticated users recipes 
+        """Filter queryset to authenticated user"""
+        queryset = self.queryset.filter(user = self.request.user).order_by('-name')
+        if self.action != 'list':
+            return queryset
+
+        assigned_only = self._flag('assigned_only')
+        if self._flag('recipe_count'):
+            #Count('recipe') is a LEFT JOIN to the through table grouped by tag/ingredient, so all the counts come back
+            #in the same query as the list. The (tag_id, recipe_id) index lets Postgres count from the index alone
+            queryset = queryset.annotate(recipe_count = Count('recipe'))
+            if assigned_only:
+                queryset = queryset.filter(recipe_count__gt = 0)
+        elif assigned_only: #Without the counts, EXISTS only has to find the first recipe
+            queryset = queryset.filter(
+                Exists(self.through.objects.filter(**{self.through_field: OuterRef('pk')}))
+            )
+
+        return queryset
+
+    def get_serializer_class(self):
+        """Return the serializer class for request"""
+        if self.action == 'list' and self._flag('recipe_count'):
+            return self.count_serializer_class
+
+        return self.serializer_class
+
+
+class TagViewSet(BaseRecipeAttrViewSet):
     """Manage tags in the DB"""
     serializer_class = serializers.TagSerializer
+    count_serializer_class = serializers.TagCountSerializer
     queryset = Tag.objects.all()
+    through = Recipe.tags.through
+    through_field = 'tag_id'
 
-    authentication_classes = [TokenAuthentication]
-    permission_classes = [IsAuthenticated]
 
-    def get_queryset(self): # We're overriding the default get method because we only want to get the authenticated users recipes 
-        """Filter queryset to authenticated user"""
-        return self.queryset.filter(user = self.request.user).order_by('-name')
-    
-class IngredientViewSet(mixins.DestroyModelMixin,
-                        mixins.UpdateModelMixin,
-                        mixins.ListModelMixin, 
-                        viewsets.GenericViewSet):
+class IngredientViewSet(BaseRecipeAttrViewSet):
     """Manage ingredients in the DB"""
-
     serializer_class = serializers.IngredientSerializer
+    count_serializer_class = serializers.IngredientCountSerializer
     queryset = Ingredient.objects.all()
+    through = Recipe.ingredients.through
+    through_field = 'ingredient_id'
 
-    authentication_classes = [TokenAuthentication]
+
+class SyncView(ShardRoutingMixin, APIView):
+    """Return the users recipes, tags and ingredients changed or deleted since ?since=, or all of them without it"""
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
-    def get_queryset(self): # We're overriding the default get method because we only want to get the authenticated users recipes 
-        """Filter queryset to authenticated user"""
-        return self.queryset.filter(user = self.request.user).order_by('-name')
\ No newline at end of file
+    @extend_schema(
+        parameters=[OpenApiParameter('since', str, description='Sync token of the last sync, omit it for everything')],
+        responses=serializers.SyncSerializer,
+    )
+    def get(self, request):
+        #The response has a new since token to send next time. Each sync only returns what changed, instead of the
+        #whole list, so a client that's up to date gets a few hundred bytes back
+        try:
+            return Response(sync(request.user, request.query_params.get('since')))
+        except InvalidToken:
+            raise ValidationError({'since': ['Invalid sync token.']})
@@ -0,0 +1,150 @@
+"""
+Cached token authentication for the APIs
+"""
+import copy
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+SHARED_KEY_PREFIX = 'auth-token:'
+
+stats = {'hits': 0, 'shared_hits': 0, 'misses': 0} #Exported counters, read them with get_stats()
+
+
+class LRUCache:
+    """Thread safe in-process LRU cache where every entry expires after ttl seconds"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict() #Keeps keys in the order they were last used, so the oldest is first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value for key, or None if it's missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key) #Mark as most recently used
+            return value
+
+    def set(self, key, value):
+        """Store value for key, evicting the least recently used entry when full"""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove key from the cache"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove everything from the cache"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+local_cache = LRUCache(
+    max_size=settings.AUTH_TOKEN_CACHE['MAX_SIZE'],
+    ttl=settings.AUTH_TOKEN_CACHE['TTL'],
+)
+
+
+def get_shared_cache():
+    """Return the shared (cross process) cache tier, or None if it isn't configured"""
+    alias = settings.AUTH_TOKEN_CACHE['SHARED_CACHE']
+    return caches[alias] if alias else None
+
+
+def invalidate_token(key):
+    """Remove a token from every cache tier"""
+    #Only this process' local tier can be cleared here, other processes drop it when the TTL runs out
+    local_cache.delete(key)
+    shared_cache = get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.delete(SHARED_KEY_PREFIX + key)
+
+
+def _shared_fields():
+    """Return the user fields kept in the shared cache, in the model's order, everything but the password hash"""
+    return [field.attname for field in get_user_model()._meta.concrete_fields if field.attname != 'password']
+
+
+def _to_shared(user, token, version):
+    return {'user': [getattr(user, name) for name in _shared_fields()], 'created': token.created, 'version': version}
+
+
+def _from_shared(key, entry):
+    """Return the (user, token) of a shared cache entry"""
+    #The password is deferred, it's loaded if it's used, and saving the user only writes the fields that are loaded
+    user = get_user_model().from_db('default', _shared_fields(), entry['user'])
+    token = Token(key=key, user=user, created=entry['created'])
+    return user, token
+
+
+def get_stats():
+    """Return the hit/miss counters and current size of the local cache"""
+    return dict(stats, size=len(local_cache))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """Drop-in replacement for TokenAuthentication that caches the token lookup"""
+    #TokenAuthentication joins authtoken_token to core_user on every request. Here we keep the (user, token) pair
+    #in memory for a short TTL, with an optional shared cache (e.g. Redis/Memcached) so other processes can reuse it.
+    #Entries are invalidated by the signals in user/signals.py when a token is deleted or a user is changed. Those can
+    #only clear this process' local tier, so with more than 1 process every local hit is checked against the shared
+    #entry's version, and without a shared cache there is no local tier unless AUTH_TOKEN_CACHE['SINGLE_PROCESS']
+
+    def authenticate_credentials(self, key):
+        shared_cache = get_shared_cache()
+        if shared_cache is None and not settings.AUTH_TOKEN_CACHE['SINGLE_PROCESS']:
+            return super().authenticate_credentials(key) #The other processes couldn't be told a token was revoked
+
+        shared = shared_cache.get(SHARED_KEY_PREFIX + key) if shared_cache is not None else None
+        local = local_cache.get(key)
+        if local is not None and (shared_cache is None or (shared is not None and shared['version'] == local[2])):
+            stats['hits'] += 1
+            user, token = local[:2]
+        elif shared is not None:
+            stats['shared_hits'] += 1
+            user, token = _from_shared(key, shared)
+            local_cache.set(key, (user, token, shared['version']))
+        else:
+            stats['misses'] += 1
+            user, token = super().authenticate_credentials(key) #Raises AuthenticationFailed for bad or inactive users
+            version = uuid.uuid4().hex #A new one, so the local entries of the user from before don't match it
+            if shared_cache is not None:
+                entry = _to_shared(user, token, version)
+                shared_cache.set(SHARED_KEY_PREFIX + key, entry, settings.AUTH_TOKEN_CACHE['TTL'])
+            local_cache.set(key, (user, token, version))
+
+        if not user.is_active: #Same check TokenAuthentication does, in case the user was cached before being deactivated
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        #Every request gets copies, the cached ones are shared by all requests with this token, so a view changing
+        #request.user (e.g. a PATCH to /me that then fails to save) would otherwise change it for the next requests too
+        user = copy.copy(user)
+        token = copy.copy(token)
+        token.user = user
+        return user, token
@@ -0,0 +1,25 @@
+"""
+Signals that keep the token authentication cache up to date
+"""
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from rest_framework.authtoken.models import Token
+
+from user.authentication import invalidate_token
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    """Stop accepting a token as soon as it's deleted"""
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=get_user_model())
+def user_saved(sender, instance, created, **kwargs):
+    """Drop the cached user when it changes, e.g. it's deactivated or its profile is updated"""
+    if created:
+        return
+    for key in Token.objects.filter(user_id=instance.id).values_list('key', flat=True):
+        invalidate_token(key)
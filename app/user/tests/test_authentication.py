@@ -0,0 +1,191 @@
+"""Tests for the cached token authentication"""
+
+from unittest.mock import patch
+
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError
+from django.urls import reverse
+
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from rest_framework import status
+
+from user import authentication
+from user.authentication import LRUCache
+
+ME_URL = reverse('user:me')
+SINGLE_PROCESS = {'TTL': 30, 'MAX_SIZE': 100, 'SHARED_CACHE': None, 'SINGLE_PROCESS': True}
+SHARED = {
+    'CACHES': {'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    'AUTH_TOKEN_CACHE': {'TTL': 30, 'MAX_SIZE': 100, 'SHARED_CACHE': 'shared', 'SINGLE_PROCESS': False},
+}
+
+
+class LRUCacheTests(SimpleTestCase):
+    """Test the in-process LRU cache"""
+
+    def test_evicts_least_recently_used(self):
+        """Test the oldest unused entry is evicted when the cache is full"""
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    @patch('user.authentication.time.monotonic')
+    def test_entries_expire_after_ttl(self, patched_monotonic):
+        """Test entries are not returned once their TTL has passed"""
+        cache = LRUCache(max_size=2, ttl=30)
+        patched_monotonic.return_value = 100
+        cache.set('a', 1)
+
+        patched_monotonic.return_value = 129
+        self.assertEqual(cache.get('a'), 1)
+        patched_monotonic.return_value = 131
+        self.assertIsNone(cache.get('a'))
+
+
+@override_settings(AUTH_TOKEN_CACHE=SINGLE_PROCESS)
+class CachedTokenAuthenticationTests(TestCase):
+    """Test authenticating with a token through the cache"""
+
+    def setUp(self):
+        authentication.local_cache.clear()
+        self.user = get_user_model().objects.create_user(
+            email='test@example.com',
+            password='testpass123',
+            name='Test Name',
+        )
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def test_second_request_uses_cache(self):
+        """Test the token is only looked up in the DB on the first request"""
+        stats = authentication.get_stats()
+
+        with self.assertNumQueries(1):
+            res = self.client.get(ME_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(0):
+            res = self.client.get(ME_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['email'], self.user.email)
+        new_stats = authentication.get_stats()
+        self.assertEqual(new_stats['misses'], stats['misses'] + 1)
+        self.assertEqual(new_stats['hits'], stats['hits'] + 1)
+
+    def test_deleted_token_rejected(self):
+        """Test a cached token stops working once it's deleted"""
+        self.client.get(ME_URL)
+        self.token.delete()
+
+        res = self.client.get(ME_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivated_user_rejected(self):
+        """Test a cached token stops working once the user is deactivated"""
+        self.client.get(ME_URL)
+        self.user.is_active = False
+        self.user.save()
+
+        res = self.client.get(ME_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_cached_inactive_user_rejected(self):
+        """Test an inactive user in the local tier is rejected"""
+        self.client.get(ME_URL)
+        authentication.local_cache.get(self.token.key)[0].is_active = False
+
+        res = self.client.get(ME_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_updated_profile_not_stale(self):
+        """Test updating the profile refreshes the cached user"""
+        self.client.get(ME_URL)
+        self.client.patch(ME_URL, {'name': 'Updated name'})
+
+        res = self.client.get(ME_URL)
+
+        self.assertEqual(res.data['name'], 'Updated name')
+
+    def test_failed_update_not_cached(self):
+        """Test a profile change that fails to save isn't seen by the next requests"""
+        self.client.get(ME_URL)
+
+        with patch.object(get_user_model(), 'save', side_effect=DatabaseError), self.assertRaises(DatabaseError):
+            self.client.patch(ME_URL, {'name': 'Unsaved name'})
+
+        res = self.client.get(ME_URL)
+
+        self.assertEqual(res.data['name'], 'Test Name')
+
+    @override_settings(**SHARED)
+    def test_shared_cache_used_when_local_empty(self):
+        """Test another process can reuse the token from the shared cache"""
+        self.client.get(ME_URL)
+        authentication.local_cache.clear() #Same as a request landing on a different process
+        stats = authentication.get_stats()
+
+        with self.assertNumQueries(0):
+            res = self.client.get(ME_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(authentication.get_stats()['shared_hits'], stats['shared_hits'] + 1)
+
+    @override_settings(**SHARED)
+    def test_revoked_in_another_process(self):
+        """Test a token deleted by another process stops working here, though it's still in this process' local tier"""
+        self.client.get(ME_URL)
+
+        with patch.object(authentication.local_cache, 'delete'): #Only the shared entry is deleted, as by another process
+            self.token.delete()
+        res = self.client.get(ME_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(**SHARED)
+    def test_changed_in_another_process(self):
+        """Test the local entry isn't used once another process has cached the user again"""
+        self.client.get(ME_URL)
+        stale = authentication.local_cache.get(self.token.key)
+        self.client.patch(ME_URL, {'name': 'Updated name'})
+        self.client.get(ME_URL) #Caches the new name in the shared tier
+        authentication.local_cache.set(self.token.key, stale) #This process' entry from before, as another process has
+
+        res = self.client.get(ME_URL)
+
+        self.assertEqual(res.data['name'], 'Updated name')
+
+    @override_settings(**SHARED)
+    def test_shared_cache_without_password(self):
+        """Test the shared cache doesn't have the password hash, and a user from it can still be saved"""
+        self.client.get(ME_URL)
+        entry = authentication.get_shared_cache().get(authentication.SHARED_KEY_PREFIX + self.token.key)
+        self.assertNotIn(self.user.password, entry['user'])
+        authentication.local_cache.clear()
+
+        res = self.client.patch(ME_URL, {'name': 'Updated name'})
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password('testpass123'))
+
+    @override_settings(AUTH_TOKEN_CACHE={**SINGLE_PROCESS, 'SINGLE_PROCESS': False})
+    def test_no_local_tier_without_shared_cache(self):
+        """Test the token is looked up every time when there may be other processes and no shared cache"""
+        self.client.get(ME_URL)
+
+        with self.assertNumQueries(1):
+            res = self.client.get(ME_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)